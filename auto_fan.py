@@ -1,6 +1,30 @@
+# -*- coding: utf-8 -*-
+import bisect
+import collections
+import cProfile
 import datetime
+import functools
+import hashlib
+import heapq
+import json
+import numbers
+import os
+import pstats
+import sqlite3
+import threading
 import time
 
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+try:
+	import tracemalloc
+except ImportError:
+	# Python 2: profiles are made without the memory allocations
+	tracemalloc = None
+
 '''
 ##############################################################
 CHANGE LOG:
@@ -54,6 +78,55 @@ Recommended setup in Indigo:
 
 	With the Group Change Listener, select all the variables and devices that are configured in the LoadConfig(), set the trigger to execute the action group that runs this script.
 
+Resident engine mode:
+
+Instead of executing the script for every trigger, it can be kept loaded by a plugin.  The config is then loaded once and the fan zones are
+re-evaluated as soon as Indigo reports a change to a device or variable, so no trigger is needed.  Changes that arrive close together
+are handled by a single evaluation of each zone (see evaluation_delay in the config), so the 2-3 second trigger delay is not needed either.  Put auto_fan.py next to
+your plugin.py and forward the change notifications to an AutoComfortEngine:
+
+	import auto_fan
+
+	class Plugin(indigo.PluginBase):
+		def startup(self):
+			self.engine = auto_fan.AutoComfortEngine()
+			self.engine.start()
+
+		def shutdown(self):
+			self.engine.stop()
+
+		def deviceUpdated(self, origDev, newDev):
+			indigo.PluginBase.deviceUpdated(self, origDev, newDev)
+			self.engine.deviceUpdated(origDev, newDev)
+
+		def variableUpdated(self, origVar, newVar):
+			indigo.PluginBase.variableUpdated(self, origVar, newVar)
+			self.engine.variableUpdated(origVar, newVar)
+
+The zones are also evaluated when nothing has changed, at the moments their decision can change on its own: when a lock or a
+change limit expires, when nighttime starts and ends, and at midnight (when LoadConfig() is run again, for its month and time of day
+rules).  So no schedule is needed to run the script every few minutes.
+
+In this mode the decisions are written to the Event Log by a background thread, a few seconds later and at most LOG_MAX_PER_MINUTE
+of them per minute, so a burst of changes with debug on does not flood the Event Log or slow down the evaluations.  The last
+DECISION_HISTORY_SIZE decisions of every zone are kept in memory, whether they were written to the Event Log or not.  To see them,
+add an action to your plugin that writes them to the Event Log:
+
+		def dumpDecisions(self, action):
+			self.engine.dumpDecisions(action.props["zone"], int(action.props.get("count", 10)))
+
+Config file:
+
+Instead of editing LoadConfig(), the config can be kept in a file named auto_fan.json next to auto_fan.py (see auto_fan.example.json).
+When that file is there, LoadConfig() is not used.  The file has the same settings as LoadConfig(), with a list of "zones", and each
+TempStep written as [min_temp, max_temp, impact, min_target, max_target].  Instead of the if statements in LoadConfig(), a zone can
+have "overrides": settings that only apply at nighttime ("nighttime": true), during the day ("nighttime": false), and/or in some
+"months" (1-12).
+
+The file is checked when it is loaded, and any mistake (an unknown or missing setting, a TempStep with too many values) stops the
+script with an error that says what is wrong.  The checked file, with its TempSteps compiled, is saved as auto_fan.json.plan and
+reused until auto_fan.json changes, so the file is not checked again on every run.
+
 Troubleshooting the behavior:
 
 Is your fan running faster or slower than you wanted?  First, make sure you have created a variable in Indigo for the script debug.  
@@ -64,6 +137,32 @@ Create a new action called "Run Auto Comfort w/ Debug" that sets the debug varia
 Executing this will run the script, in debug mode, then turn off debug mode.  You'll see the target speed for each fan, and the logic that contributed.  
 Adjust your TempSteps appropriately.
 
+Decision history:
+
+Set config.history_file to a file name (for example "/Users/you/auto_fan_history.sqlite") to keep every decision of every zone
+in a SQLite database: the time, the inputs of the rules, which rules applied, the current and target speed, and whether the
+fan was changed.  One decision takes a few dozen bytes.  Decisions older than HISTORY_DOWNSAMPLE_DAYS are thinned out, and the
+ones older than HISTORY_MAX_DAYS (or over HISTORY_MAX_RECORDS) are deleted, once a day.  When the script is run from an action
+group, the decisions are first collected in a file next to the database (ending in .pending), and moved into the database
+together once there are HISTORY_SPOOL_KB of them.  To read them back, oldest first:
+
+	import auto_fan
+	store = auto_fan.HistoryStore("/Users/you/auto_fan_history.sqlite")
+	for record in store.read("MBR", start = datetime.datetime(2018, 7, 1)):
+		print(record.taken_at, record.room_temperature, record.rules, record.target_speed)
+
+Is the script slow?  Create a variable for the instrumentation (config.instrumentation_varId) and set it to true.  Every run then logs, for each
+zone, how many milliseconds were spent reading the devices and variables, in the lock logic, the rules (the HVAC, temperature and
+season, and minimum and maximum rules separately, when the decision was not already known), building the log text and changing
+the fan, how many devices and variables were read and written, and how many decisions were already known (memo hits, see DecisionMemo).
+It costs nothing while it is set to false.
+
+To find out where the time goes, create a variable for profiling (config.profiling_varId) and set it to true.  The next
+PROFILING_RUNS runs (or the runs in the next PROFILING_MINUTES, whichever ends first) are run under the Python profiler, which
+makes them slower.  LoadConfig() (run a second time when profiling) and AutoComfort() each write the functions that took the
+longest, and where the most memory was allocated, to a file in config.profiling_dir, and a one line summary to the Event Log.
+The variable counts down the runs that are left, and is set back to false when they are done.  Set it to false to stop sooner.
+
 
 ##############################################################
 How the logic works:
@@ -133,21 +232,57 @@ MBR fan: increasing from 2 to 3 due to the change to Master Bedroom Presence, re
 def LoadConfig(config):
 	###################### BEGIN CONFIG #################
 
-	# script debug mode.  Create a variable for this, or set it statically to True or False
-	config.script_debug = indigo.variables[1757362760].getValue(bool)
+	# script debug mode.  Create a variable for this and put its VarId here, or set this to None and set config.script_debug statically to True or False
+	config.script_debug_varId = 1757362760
 
 	config.BEDTIME_HIGH_FEELSLIKE_TEMPERATURE = 70 # In the summer, a temperature above this while sleeping will raise the fan level
 	config.BEDTIME_HIGH_HUMIDITY = 80 # In the summer, a humidity above this level while sleeping will raise the fan level
 	config.NIGHTTIME_START_HOUR = 22 # 10pm starts nighttime hours
 	config.NIGHTTIME_END_HOUR = 8 # 8am ends nighttime hours
 	config.MINIMUM_CHANGE_FREQUENCY = 2 # the number of minutes that a change to a fan's speed will lock changes from this script
-
-	# Whether or not someone is home at the house.  If no one is home, the script does not turn on the fan.
-	config.someone_home = indigo.variables[1451030242].getValue(bool) # "someone_home"
+	config.FAN_COMMAND_TIMEOUT = 10 # the number of seconds to wait for a fan to accept a command before giving up on it
+	config.FAN_COMMAND_WORKERS = 8 # the number of fans that are sent commands at the same time
+	config.FAN_SETTLE_SECONDS = 5 # the fan's changes in this many seconds after the script changed it are the script's own, not someone using the remote.  Resident engine mode only.
+	config.DEVICE_FAILURE_THRESHOLD = 3 # after this many failures in a row, a device is left alone until it is retried.  A zone with a failing fan is skipped, a failing sensor is treated as having no value.  Resident engine mode only.
+	config.DEVICE_RETRY_MINUTES = 1 # the number of minutes before a failing device is retried.  This doubles after every failed retry...  Resident engine mode only.
+	config.DEVICE_MAX_RETRY_MINUTES = 60 # ...up to this many minutes.  Resident engine mode only.
+	config.SHARED_INPUT_TTL = 30 # the number of seconds the weather device and the variables above are remembered, instead of being read again for every zone.  Resident engine mode only, a script run reads them once per run.
+	config.WEATHER_STALE_MINUTES = 180 # if the weather device has not updated in this many minutes, always_on_outside_temp is ignored until it updates.  In resident engine mode, this is also reported in the Event Log.
+	config.DECISION_MEMO_SIZE = 256 # the number of decisions remembered for each zone, so a run with the same inputs as an earlier one does not evaluate the rules again.  Resident engine mode only.
+	config.DECISION_PRECISION = 1 # the number of decimals the temperatures and humidity are rounded to before the rules are evaluated.  Match it to your sensors.
+	config.DECISION_HISTORY_SIZE = 100 # the number of decisions kept in memory for each zone, see dumpDecisions().  Resident engine mode only.
+	config.LOG_FLUSH_SECONDS = 2 # resident engine mode writes the decisions to the Event Log together, every this many seconds...
+	config.LOG_MAX_PER_MINUTE = 30 # ...and at most this many of them per minute.  The ones over the limit are only kept in the decision history.
+
+	# Whether or not someone is home at the house.  If no one is home, the script does not turn on the fan.  The VarId of a variable with a boolean value, or set this to None and set config.someone_home statically.
+	config.someone_home_varId = 1451030242 # "someone_home"
 
 	# The Indigo devId for a weather device.  Will look for the "feelslike" state.
 	config.weather_devId = 56720865
 
+	# Optional.  A Indigo VarId to remember which device ID belongs to each thermostat name, so the script does not have to search through all of your devices to find them on every run.  Set to None to keep the index in memory only.
+	config.thermostat_index_varId = None
+
+	# Optional.  Instrumentation logs, for each zone, how long each part of the run took and how many devices and variables were read and written.  Create a variable for this and put its VarId here, or set this to None and set config.instrumentation statically to True or False
+	config.instrumentation_varId = None
+
+	# Optional.  A Indigo VarId to hold the instrumentation of the last run (as JSON), in addition to the Event Log.
+	config.instrumentation_summary_varId = None
+
+	# Optional.  A variable to turn on profiling with (see "Is the script slow?" at the top of this file).  Set to None to not use profiling.
+	config.profiling_varId = None
+	config.profiling_dir = None # the folder to write the profiles to.  None for a folder named auto_fan_profiles next to auto_fan.py
+	config.PROFILING_RUNS = 10 # the number of runs that are profiled after the variable is set to true...
+	config.PROFILING_MINUTES = 30 # ...or the number of minutes, whichever ends first
+
+	# Optional.  A file to keep every decision in, for tuning your TempSteps (see "Decision history" at the top of this file).  Set to None to not keep them.
+	config.history_file = None
+	config.HISTORY_MAX_DAYS = 365 # decisions older than this are deleted...
+	config.HISTORY_MAX_RECORDS = 5000000 # ...and the oldest ones once there are more than this many
+	config.HISTORY_DOWNSAMPLE_DAYS = 30 # of the decisions older than this, only the first one of each zone in every HISTORY_DOWNSAMPLE_MINUTES is kept, and the ones that changed the fan
+	config.HISTORY_DOWNSAMPLE_MINUTES = 15
+	config.HISTORY_FLUSH_SECONDS = 10 # resident engine mode writes the decisions to the file together, every this many seconds
+	config.HISTORY_SPOOL_KB = 64 # when the script is run from an action group, the decisions are moved into the database once this many KB of them (about 1000) have been collected
 	###################
 	# Define each of your Fan Zones.  Copy this section for each fan you have.
 	###################
@@ -182,7 +317,7 @@ def LoadConfig(config):
 	# Set the inside temperature that the fan will always remain on a minimum level speed (1)
 	sunroomFan.always_on_inside_temp = 86
 
-	# Configure the temperature steps (I couldnt come up with a better name for them).  Each step is processed sequentially until one is matched.  It's recommended to make them chronological and sequential, where the max_temp for the previous is the min_temp for the next... see example.
+	# Configure the temperature steps (I couldnt come up with a better name for them).  Each step is processed sequentially until one is matched.  It's recommended to make them chronological and sequential, where the max_temp for the previous is the min_temp for the next... see example.  Steps that overlap, or gaps between steps, are reported in the Event Log when the config is loaded.
 	# Constructor for the object:
 	#		min_temp = The beginning of the range for that step.  You can use None to indicate no floor.
 	#		max_temp = The end of the range for that step.  You can use None to indicate no ceiling.
@@ -218,14 +353,25 @@ def LoadConfig(config):
 	# Setting this to true will make the lock disable when presence is no longer detected in the room
 	sunroomFan.reset_lock_when_no_presence = True
 
-	# Enable Woosh mode when the fan is above a level 2 and when presence is detected.  Note: Woosh mode disables the external lock detection, since it is impossible to tell if the fan was changed outside of the script (woosh mode changes the speed within the fan itself, no way to understand if it came from the remote, app, etc.)
+	# Enable Woosh mode when the fan is above a level 2 and when presence is detected.  Note: Woosh mode disables the external lock detection, since it is impossible to tell if the fan was changed outside of the script (woosh mode changes the speed within the fan itself, no way to understand if it came from the remote, app, etc.).  In resident engine mode, changes are detected from the fan's change notifications instead, so the lock still works with woosh mode, except for the speed changes woosh mode makes.
 	sunroomFan.enable_woosh_mode_when_present = True
 
 	# devId of the sensor with the humidity value for the fan/zone
 	sunroomFan.humidity_devId = 155284095
 
+	# Resident engine mode only: the number of seconds to wait after a change before evaluating the zone.  Any other changes within that window are handled by the same evaluation.
+	sunroomFan.evaluation_delay = 0.5
+
+	# Limits how often the script changes the speed of the fan, so it does not keep going back and forth when someone walks in and out of the room, or the temperature sits right at the edge of a TempStep.  Changes that are held back are not sent to the fan or logged (except in debug mode).
+	# The number of minutes the fan stays at a speed before the script changes it.  Either one number for every speed, or a different number for each speed, like {0: 0, 1: 5, 2: 10}
+	sunroomFan.min_dwell_minutes = 0
+	# The same, but only for lowering the speed, so the fan can speed up quickly and slow down slowly.  None to use min_dwell_minutes.
+	sunroomFan.min_dwell_down_minutes = None
+	# The most speed changes the script makes within an hour.  None for no limit.  Resident engine mode only, since the changes have to be remembered between runs.
+	sunroomFan.max_changes_per_hour = None
+
 	# this is a way to force your fan to have a minimum speed based on the month / time of day
-	if not config.isNighttime() and (datetime.date.today().month < 11 and datetime.date.today().month > 3):
+	if not config.isNighttime() and (Now().month < 11 and Now().month > 3):
 		sunroomFan.min_target = 1
 
 	############## END FAN ZONE
@@ -254,21 +400,20 @@ def LoadConfig(config):
 		TempStep(7.0, None, 5, 4, None)
 	]
 
-	# use the isNighttime() to adjust the TempSteps for nighttime.  These are slightly more aggressive than the defaults.
-	if config.isNighttime():
-		MBRFan.temp_steps = [
-			TempStep(None, -1.0, None, None, 1),
-			TempStep(-1.0, 1.0, 1, None, None),
-			TempStep(1.0, 2.5, 2, None, None),
-			TempStep(2.5, 3.5, 2, None, None),
-			TempStep(3.5, 4.5, 3, 2, None),
-			TempStep(4.5, 6.0, 4, 2, None),
-			TempStep(6.0, 7.0, 5, 4, None),
-			TempStep(7.0, None, 6, 4, None)
-		]
+	# Optional: TempSteps to use instead during nighttime hours (see isNighttime()).  These are slightly more aggressive than the defaults.
+	MBRFan.night_temp_steps = [
+		TempStep(None, -1.0, None, None, 1),
+		TempStep(-1.0, 1.0, 1, None, None),
+		TempStep(1.0, 2.5, 2, None, None),
+		TempStep(2.5, 3.5, 2, None, None),
+		TempStep(3.5, 4.5, 3, 2, None),
+		TempStep(4.5, 6.0, 4, 2, None),
+		TempStep(6.0, 7.0, 5, 4, None),
+		TempStep(7.0, None, 6, 4, None)
+	]
 
 	# this is a way to force your fan to have a minimum speed based on the month / time of day.  Optional, feel free to comment out.
-	if config.isNighttime() and (datetime.date.today().month < 11 and datetime.date.today().month > 3):
+	if config.isNighttime() and (Now().month < 11 and Now().month > 3):
 		MBRFan.min_target = 1
 
 	# MBR Fan -- Optional items
@@ -280,26 +425,691 @@ def LoadConfig(config):
 	return [sunroomFan, MBRFan]
 
 ###################### END CONFIG --- STOP EDITING #################
+
+# The clock used everywhere in the script.  simulate.py replaces it to replay recorded data faster than real time.
+def Now():
+	return datetime.datetime.now()
+
+######################
+#	Indigo API calls.  Everything the script reads from or writes to Indigo goes through these, so the calls can be
+#	counted when instrumentation is on (see RunStats).  When it is off, the only added cost is the check of Instrumented.
+#	Fan commands are sent from other threads, so they are counted by SendFanCommands() instead.
+######################
+
+Instrumented = False
+CurrentRunStats = threading.local()
+
+def CountCall(name):
+	stats = getattr(CurrentRunStats, "stats", None)
+
+	if stats is not None:
+		stats.count(name)
+
+def StartPhase(phase):
+	# for the phases of DecideTargetSpeed(), which is not given the RunStats of the zone
+	stats = getattr(CurrentRunStats, "stats", None)
+
+	if stats is not None:
+		stats.startPhase(phase)
+
+def GetDevice(devId):
+	if Instrumented:
+		CountCall("device_reads")
+
+	return indigo.devices[devId]
+
+def GetVariable(varId):
+	if Instrumented:
+		CountCall("variable_reads")
+
+	return indigo.variables[varId]
+
+def UpdateVariable(varId, value):
+	if Instrumented:
+		CountCall("variable_writes")
+
+	indigo.variable.updateValue(varId, value=value)
+
+def ExecuteAction(plugin, action, deviceId, props):
+	plugin.executeAction(action, deviceId=deviceId, props=props)
+
+# The time spent in each phase of AutoComfort() for one zone, and the number of Indigo API calls made for it.  Only
+# created while config.instrumentation is on.  Calls are counted for the RunStats that is current on the calling thread.
+class RunStats(object):
+	COUNTS = ["device_reads", "variable_reads", "variable_writes", "fan_commands", "memo_hits", "memo_misses"]
+
+	def __init__(self, zoneName):
+		self.zoneName = zoneName
+		self.counts = dict((name, 0) for name in self.COUNTS)
+		self.phases = collections.OrderedDict()
+		self.phase = None
+		self.phase_started = None
+
+	def count(self, name):
+		self.counts[name] = self.counts[name] + 1
+
+	def startPhase(self, phase):
+		# ends the current phase (if any) and starts the next one.  The same phase can be started more than once.
+		now = time.time()
+
+		if self.phase is not None:
+			self.phases[self.phase] = self.phases.get(self.phase, 0.0) + now - self.phase_started
+
+		self.phase = phase
+		self.phase_started = now
+
+	def stop(self):
+		self.startPhase(None)
+
+	def addPhase(self, phase, seconds):
+		# for time measured somewhere else, like a fan command sent from another thread
+		self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+	def activate(self):
+		CurrentRunStats.stats = self
+
+	@staticmethod
+	def deactivate():
+		CurrentRunStats.stats = None
+
+	def getTotal(self):
+		return sum(self.phases.values())
+
+	def asDict(self):
+		return {
+			"total_ms": round(self.getTotal() * 1000, 3),
+			"phases_ms": dict((phase, round(seconds * 1000, 3)) for phase, seconds in self.phases.items()),
+			"counts": dict(self.counts)
+		}
+
+	def getSummary(self):
+		phases = ", ".join(phase + " " + "%.2f" % (seconds * 1000) for phase, seconds in self.phases.items())
+		counts = ", ".join(str(self.counts[name]) + " " + name.replace("_", " ") for name in self.COUNTS)
+
+		return self.zoneName + " fan script timing: " + "%.2f" % (self.getTotal() * 1000) + " ms (" + phases + "), " + counts
+
+def LoadZones(config):
+	# the zones from the config file, if there is one (see "Config file" at the top of this file), otherwise from LoadConfig()
+	plan = LoadRulePlan(CONFIG_FILE)
+
+	if plan is not None:
+		return CreateZones(plan, config)
+
+	fanZones = LoadConfig(config)
+
+	for fan in fanZones:
+		fan.compileTempSteps()
+
+	return fanZones
+
+######################
+#	Profiling
+######################
+
+PROFILING_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Runs LoadConfig() and AutoComfort() under cProfile (and tracemalloc, where there is one) while config.profiling_varId
+# is on.  The variable is "true" to start, and then holds what is left: "9 runs left until 2018-07-15 14:30:00".  Only
+# one profiled call runs at a time, so the memory allocations of concurrent zone evaluations are not mixed up.
+class Profiler(object):
+	def __init__(self, config):
+		self.config = config
+		self.lock = threading.Lock()
+		self.profiles = 0
+
+	def getDirectory(self):
+		if self.config.profiling_dir is not None:
+			return self.config.profiling_dir
+
+		return os.path.join(os.path.dirname(CONFIG_FILE), "auto_fan_profiles")
+
+	def startRun(self):
+		# whether this run is profiled.  Counts it against the runs that are left.
+		if self.config.profiling_varId is None:
+			return False
+
+		with self.lock:
+			value = GetVariable(self.config.profiling_varId).value.strip().lower()
+
+			if value in ("", "false", "0", "off", "no"):
+				return False
+
+			now = Now()
+
+			if value in ("true", "1", "on", "yes"):
+				runs = self.config.PROFILING_RUNS
+				until = now + datetime.timedelta(minutes = self.config.PROFILING_MINUTES)
+				indigo.server.log("fan script: profiling the next " + str(runs) + " runs, until " + until.strftime(PROFILING_TIME_FORMAT) + ", to " + self.getDirectory())
+			else:
+				try:
+					runs, until = value.split(" runs left until ")
+					runs = int(runs)
+					until = datetime.datetime.strptime(until, PROFILING_TIME_FORMAT)
+				except ValueError:
+					indigo.server.log("fan script: the profiling variable should be true or false, not " + value)
+					return False
+
+			if runs <= 0 or now >= until:
+				UpdateVariable(self.config.profiling_varId, "false")
+				indigo.server.log("fan script: profiling finished")
+				return False
+
+			UpdateVariable(self.config.profiling_varId, str(runs - 1) + " runs left until " + until.strftime(PROFILING_TIME_FORMAT))
+			return True
+
+	def profile(self, label, function, *args):
+		with self.lock:
+			directory = self.getDirectory()
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+
+			tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+			if tracing:
+				tracemalloc.start()
+
+			profile = cProfile.Profile()
+			started = time.time()
+
+			try:
+				return profile.runcall(function, *args)
+			finally:
+				seconds = time.time() - started
+				memory = None
+
+				if tracing:
+					memory = (tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()[1])
+					tracemalloc.stop()
+
+				self.report(directory, label, profile, seconds, memory)
+
+	def report(self, directory, label, profile, seconds, memory):
+		# numbered, since a run can make more than one profile within a second
+		self.profiles = self.profiles + 1
+		path = os.path.join(directory, Now().strftime("%Y%m%d-%H%M%S-") + str(self.profiles) + "-" + "".join(c if c.isalnum() else "_" for c in label) + ".txt")
+
+		text = StringIO()
+		stats = pstats.Stats(profile, stream = text)
+		stats.sort_stats("cumulative").print_stats(40)
+
+		summary = "fan script profile: " + label + " took " + "%.1f" % (seconds * 1000) + " ms, " + str(stats.total_calls) + " function calls"
+
+		if memory is not None:
+			snapshot, peak = memory
+			summary = summary + ", " + "%.1f" % (peak / 1024.0) + " KB peak memory"
+
+			text.write("\nTop memory allocations:\n\n")
+			for statistic in snapshot.statistics("lineno")[:20]:
+				text.write(str(statistic) + "\n")
+
+		with open(path, "w") as output:
+			output.write(summary + "\n\n" + text.getvalue())
+
+		indigo.server.log(summary + ".  Details in " + path)
+
+######################
+#	Config file
+######################
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(globals().get("__file__", "auto_fan.py"))), "auto_fan.json")
+
+# changed whenever the rule plan changes, so plans cached by an older version of the script are compiled again
+RULE_PLAN_VERSION = 2
+
+CONFIG_SETTINGS = set([
+	"script_debug", "script_debug_varId", "someone_home", "someone_home_varId", "weather_devId", "thermostat_index_varId",
+	"instrumentation", "instrumentation_varId", "instrumentation_summary_varId",
+	"BEDTIME_HIGH_FEELSLIKE_TEMPERATURE", "BEDTIME_HIGH_HUMIDITY", "NIGHTTIME_START_HOUR", "NIGHTTIME_END_HOUR", "MINIMUM_CHANGE_FREQUENCY",
+	"FAN_COMMAND_TIMEOUT", "FAN_COMMAND_WORKERS", "FAN_SETTLE_SECONDS", "DEVICE_FAILURE_THRESHOLD", "DEVICE_RETRY_MINUTES", "DEVICE_MAX_RETRY_MINUTES",
+	"SHARED_INPUT_TTL", "WEATHER_STALE_MINUTES", "DECISION_MEMO_SIZE", "DECISION_PRECISION",
+	"DECISION_HISTORY_SIZE", "LOG_FLUSH_SECONDS", "LOG_MAX_PER_MINUTE",
+	"profiling_varId", "profiling_dir", "PROFILING_RUNS", "PROFILING_MINUTES",
+	"history_file", "HISTORY_MAX_DAYS", "HISTORY_MAX_RECORDS", "HISTORY_DOWNSAMPLE_DAYS", "HISTORY_DOWNSAMPLE_MINUTES", "HISTORY_FLUSH_SECONDS",
+	"HISTORY_SPOOL_KB"
+])
+
+ZONE_REQUIRED_SETTINGS = set([
+	"target_speed_varId", "ideal_temperature_varId", "temperature_devId", "presence_devId", "zone_thermostat_name", "locked_varId", "lastchanged_varId"
+])
+
+ZONE_SETTINGS = ZONE_REQUIRED_SETTINGS | set([
+	"min_target", "max_target", "bedtimeMaxSpeed", "summer_fan_at_bedtime", "reset_lock_when_no_presence", "enable_woosh_mode_when_present",
+	"humidity_devId", "always_on_outside_temp", "always_on_inside_temp", "locktime", "current_event_varId", "evaluation_delay",
+	"min_dwell_minutes", "min_dwell_down_minutes", "max_changes_per_hour"
+])
+
+OVERRIDE_CONDITIONS = set(["nighttime", "months"])
+
+# The kind of value of each setting, checked when the config file is compiled so a mistake is reported then, and not
+# half way through a run
+SETTING_KINDS = {
+	"script_debug": "bool", "someone_home": "bool", "instrumentation": "bool",
+	"script_debug_varId": "optional id", "someone_home_varId": "optional id", "weather_devId": "optional id",
+	"thermostat_index_varId": "optional id", "instrumentation_varId": "optional id", "instrumentation_summary_varId": "optional id",
+	"profiling_varId": "optional id", "profiling_dir": "optional text", "history_file": "optional text",
+	"NIGHTTIME_START_HOUR": "hour", "NIGHTTIME_END_HOUR": "hour",
+	"FAN_COMMAND_WORKERS": "integer", "DEVICE_FAILURE_THRESHOLD": "integer", "DECISION_MEMO_SIZE": "integer",
+	"DECISION_PRECISION": "integer", "DECISION_HISTORY_SIZE": "integer", "LOG_MAX_PER_MINUTE": "integer",
+	"PROFILING_RUNS": "integer", "HISTORY_MAX_RECORDS": "integer",
+	"BEDTIME_HIGH_FEELSLIKE_TEMPERATURE": "number", "BEDTIME_HIGH_HUMIDITY": "number", "MINIMUM_CHANGE_FREQUENCY": "number",
+	"FAN_COMMAND_TIMEOUT": "number", "FAN_SETTLE_SECONDS": "number", "DEVICE_RETRY_MINUTES": "number",
+	"DEVICE_MAX_RETRY_MINUTES": "number", "SHARED_INPUT_TTL": "number", "WEATHER_STALE_MINUTES": "number",
+	"LOG_FLUSH_SECONDS": "number", "PROFILING_MINUTES": "number", "HISTORY_MAX_DAYS": "number",
+	"HISTORY_DOWNSAMPLE_DAYS": "number", "HISTORY_DOWNSAMPLE_MINUTES": "number", "HISTORY_FLUSH_SECONDS": "number",
+	"HISTORY_SPOOL_KB": "number",
+	"target_speed_varId": "id", "ideal_temperature_varId": "id", "temperature_devId": "id", "presence_devId": "id",
+	"locked_varId": "id", "lastchanged_varId": "id", "humidity_devId": "id", "current_event_varId": "optional id",
+	"zone_thermostat_name": "text", "min_target": "speed", "max_target": "speed", "bedtimeMaxSpeed": "optional speed",
+	"summer_fan_at_bedtime": "bool", "reset_lock_when_no_presence": "bool", "enable_woosh_mode_when_present": "bool",
+	"always_on_outside_temp": "number", "always_on_inside_temp": "number", "locktime": "number", "evaluation_delay": "number",
+	"min_dwell_minutes": "minutes", "min_dwell_down_minutes": "optional minutes", "max_changes_per_hour": "optional integer",
+	"nighttime": "bool", "months": "months"
+}
+
+SETTING_KIND_DESCRIPTIONS = {
+	"bool": "true or false",
+	"id": "an Indigo ID",
+	"text": "text",
+	"integer": "a whole number",
+	"number": "a number",
+	"hour": "an hour from 0 to 23",
+	"speed": "a speed from 0 to 7",
+	"minutes": "a number of minutes, or an object with the minutes for each speed",
+	"months": "a list of months from 1 to 12"
+}
+
+def IsNumber(value):
+	# JSON true and false are ints to Python
+	return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+def IsInteger(value):
+	return isinstance(value, numbers.Integral) and not isinstance(value, bool) or isinstance(value, float) and value.is_integer()
+
+def IsValueOfKind(value, kind):
+	if kind.startswith("optional "):
+		return value is None or IsValueOfKind(value, kind[len("optional "):])
+
+	if kind == "bool":
+		return isinstance(value, bool)
+	elif kind == "text":
+		return isinstance(value, basestring)
+	elif kind in ("id", "integer"):
+		return IsInteger(value)
+	elif kind == "number":
+		return IsNumber(value)
+	elif kind == "hour":
+		return IsInteger(value) and 0 <= value <= 23
+	elif kind == "speed":
+		return IsInteger(value) and 0 <= value <= 7
+	elif kind == "minutes":
+		if isinstance(value, dict):
+			return all(IsInteger(ParseInt(speed)) and IsNumber(minutes) for speed, minutes in value.items())
+
+		return IsNumber(value)
+	elif kind == "months":
+		return isinstance(value, list) and len(value) > 0 and all(IsInteger(month) and 1 <= month <= 12 for month in value)
+
+	return False
+
+def ParseInt(text):
+	# the speeds of min_dwell_minutes are object keys, which are always text in JSON
+	try:
+		return int(text)
+	except (TypeError, ValueError):
+		return None
+
+def LoadRulePlan(path):
+	# The config file compiled into a rule plan: checked, with its TempSteps compiled into TempStepTables.  The plan is
+	# cached next to the config file, and only compiled again when the config file changes.  Returns None if there is no
+	# config file.
+	try:
+		with open(path, "rb") as configFile:
+			contents = configFile.read()
+	except IOError:
+		return None
+
+	key = hashlib.sha1(contents).hexdigest() + "-" + str(RULE_PLAN_VERSION)
+	cachePath = path + ".plan"
+
+	try:
+		with open(cachePath, "r") as cacheFile:
+			cached = json.load(cacheFile)
+
+		if cached["key"] == key:
+			return cached["plan"]
+	except (IOError, ValueError, KeyError, TypeError):
+		pass
+
+	try:
+		data = json.loads(contents.decode("utf-8"))
+	except ValueError as e:
+		raise ValueError("fan script: " + path + " is not valid JSON.  error: " + str(e))
+
+	plan = CompileRulePlan(data, path)
+
+	try:
+		with open(cachePath, "w") as cacheFile:
+			json.dump({"key": key, "plan": plan}, cacheFile)
+	except IOError as e:
+		indigo.server.log("fan script: could not save the compiled config to " + cachePath + ".  error: " + str(e))
+
+	return plan
+
+def CheckSettings(settings, allowed, where):
+	if not isinstance(settings, dict):
+		raise ValueError("fan script: " + where + " must be an object")
+
+	unknown = sorted(set(settings.keys()) - allowed)
+	if len(unknown) > 0:
+		raise ValueError("fan script: unknown setting in " + where + ": " + ", ".join(unknown))
+
+	for key in sorted(settings.keys()):
+		kind = SETTING_KINDS.get(key)
+
+		if kind is not None and not IsValueOfKind(settings[key], kind):
+			description = SETTING_KIND_DESCRIPTIONS[kind.replace("optional ", "")]
+
+			if kind.startswith("optional "):
+				description = description + " or null"
+
+			raise ValueError("fan script: " + key + " in " + where + " must be " + description + ", not " + json.dumps(settings[key]))
+
+def CompileTempSteps(steps, where):
+	if not isinstance(steps, list) or len(steps) == 0:
+		raise ValueError("fan script: " + where + " must be a list of TempSteps")
+
+	temp_steps = []
+	for values in steps:
+		if not isinstance(values, list) or len(values) < 3 or len(values) > 5:
+			raise ValueError("fan script: every TempStep in " + where + " must be a list of min_temp, max_temp, impact and optionally min_target and max_target")
+
+		if not all(value is None or IsNumber(value) for value in values):
+			raise ValueError("fan script: every value of a TempStep in " + where + " must be a number or null, not " + json.dumps(values))
+
+		temp_steps.append(TempStep(*values))
+
+	table = TempStepTable(temp_steps)
+
+	for problem in table.problems:
+		indigo.server.log("fan script: " + where + ": " + problem)
+
+	return table.asCompiled()
+
+def CompileRulePlan(data, path):
+	CheckSettings(data, CONFIG_SETTINGS | set(["zones"]), path)
+
+	if not isinstance(data.get("zones"), list) or len(data["zones"]) == 0:
+		raise ValueError("fan script: " + path + " has no zones")
+
+	zones = []
+	names = set()
+
+	for zone in data["zones"]:
+		if not isinstance(zone, dict) or "name" not in zone or "fanId" not in zone:
+			raise ValueError("fan script: every zone in " + path + " needs a name and a fanId")
+
+		if not isinstance(zone["name"], basestring) or not IsInteger(zone["fanId"]):
+			raise ValueError("fan script: the name of every zone in " + path + " must be text, and its fanId an Indigo ID")
+
+		where = "zone " + str(zone["name"])
+
+		if zone["name"] in names:
+			raise ValueError("fan script: there is more than one " + where)
+		names.add(zone["name"])
+
+		settings = dict((key, value) for key, value in zone.items() if key not in ("name", "fanId", "temp_steps", "night_temp_steps", "overrides"))
+		CheckSettings(settings, ZONE_SETTINGS, where)
+
+		missing = sorted(ZONE_REQUIRED_SETTINGS - set(settings.keys()))
+		if len(missing) > 0:
+			raise ValueError("fan script: " + where + " is missing " + ", ".join(missing))
+
+		overrides = []
+		for override in zone.get("overrides", []):
+			CheckSettings(override, ZONE_SETTINGS | OVERRIDE_CONDITIONS, where + " override")
+			overrides.append({
+				"nighttime": override.get("nighttime"),
+				"months": override.get("months"),
+				"settings": dict((key, value) for key, value in override.items() if key not in OVERRIDE_CONDITIONS)
+			})
+
+		day = CompileTempSteps(zone.get("temp_steps"), where + " temp_steps")
+		night = None
+		if zone.get("night_temp_steps") is not None:
+			night = CompileTempSteps(zone["night_temp_steps"], where + " night_temp_steps")
+
+		zones.append({
+			"name": zone["name"],
+			"fanId": zone["fanId"],
+			"settings": settings,
+			"overrides": overrides,
+			"temp_steps": day,
+			"night_temp_steps": night
+		})
+
+	return {
+		"config": dict((key, value) for key, value in data.items() if key != "zones"),
+		"zones": zones
+	}
+
+def ApplySettings(target, settings):
+	for key, value in settings.items():
+		# JSON object keys are always strings, min_dwell_minutes is keyed by speed
+		if key in ("min_dwell_minutes", "min_dwell_down_minutes") and isinstance(value, dict):
+			value = dict((int(speed), minutes) for speed, minutes in value.items())
+
+		setattr(target, key, value)
+
+def CreateZones(plan, config):
+	ApplySettings(config, plan["config"])
+
+	now = Now()
+	is_nighttime = config.isNighttime(now)
+
+	fanZones = []
+	for zone in plan["zones"]:
+		fan = FanZone(zone["name"], zone["fanId"])
+		ApplySettings(fan, zone["settings"])
+
+		for override in zone["overrides"]:
+			if override["nighttime"] is not None and override["nighttime"] != is_nighttime:
+				continue
+
+			if override["months"] is not None and now.month not in override["months"]:
+				continue
+
+			ApplySettings(fan, override["settings"])
+
+		day = TempStepTable.fromCompiled(zone["temp_steps"])
+		night = day
+		if zone["night_temp_steps"] is not None:
+			night = TempStepTable.fromCompiled(zone["night_temp_steps"])
+
+		fan.temp_steps = day.temp_steps
+		fan.night_temp_steps = night.temp_steps if night is not day else None
+		fan.temp_step_tables = {False: day, True: night}
+		fanZones.append(fan)
+
+	return fanZones
+
 class AutoConfortConfig(object):
 	def __init__(self):
-		pass
+		self.script_debug = False
+		self.script_debug_varId = None
+		self.someone_home = True
+		self.someone_home_varId = None
+		self.weather_devId = None
+		self.thermostat_index_varId = None
+		self.thermostat_index = None
+		self.instrumentation = False
+		self.instrumentation_varId = None
+		self.instrumentation_summary_varId = None
+		self.history_file = None
+		self.profiling_varId = None
+		self.profiling_dir = None
+		self.PROFILING_RUNS = 10
+		self.PROFILING_MINUTES = 30
+		self.profiler = None
+		self.HISTORY_MAX_DAYS = 365
+		self.HISTORY_MAX_RECORDS = 5000000
+		self.HISTORY_DOWNSAMPLE_DAYS = 30
+		self.HISTORY_DOWNSAMPLE_MINUTES = 15
+		self.HISTORY_FLUSH_SECONDS = 10
+		self.HISTORY_SPOOL_KB = 64
+		self.history_store = None
+		self.FAN_COMMAND_TIMEOUT = 10
+		self.FAN_COMMAND_WORKERS = 8
+		self.FAN_SETTLE_SECONDS = 5
+		self.DEVICE_FAILURE_THRESHOLD = 3
+		self.DEVICE_RETRY_MINUTES = 1
+		self.DEVICE_MAX_RETRY_MINUTES = 60
+		self.device_health = None
+		self.SHARED_INPUT_TTL = 30
+		self.WEATHER_STALE_MINUTES = 180
+		self.shared_inputs = None
+		self.weather_stale = False
+		self.DECISION_MEMO_SIZE = 256
+		self.DECISION_PRECISION = 1
+		self.DECISION_HISTORY_SIZE = 100
+		self.LOG_FLUSH_SECONDS = 2
+		self.LOG_MAX_PER_MINUTE = 30
+		self.decision_history = None
+		self.event_log = None
+		self.fan_tracker = None
+		self.resident_engine = False
+
+	def getDependencies(self):
+		# the Indigo devices and variables that every zone depends on
+		return set([self.weather_devId, self.someone_home_varId, self.script_debug_varId, self.instrumentation_varId])
+
+	def getSharedInputs(self):
+		if self.shared_inputs is None:
+			self.shared_inputs = SharedInputs(self.SHARED_INPUT_TTL)
+
+		return self.shared_inputs
+
+	def sharedInputChanged(self, objId):
+		# called by the AutoComfortEngine for every change notification, so a change is used right away instead of after the TTL
+		if objId is not None and objId in self.getDependencies():
+			self.getSharedInputs().clear()
+
+	def readVariables(self):
+		global Instrumented
+
+		shared = self.getSharedInputs()
+
+		if self.script_debug_varId is not None:
+			self.script_debug = shared.get("script_debug", lambda: GetVariable(self.script_debug_varId).getValue(bool))
+
+		if self.instrumentation_varId is not None:
+			self.instrumentation = shared.get("instrumentation", lambda: GetVariable(self.instrumentation_varId).getValue(bool))
+
+		Instrumented = self.instrumentation
+
+		if self.someone_home_varId is not None:
+			self.someone_home = shared.get("someone_home", lambda: GetVariable(self.someone_home_varId).getValue(bool))
+
+	def getThermostatIndex(self):
+		if self.thermostat_index is None:
+			self.thermostat_index = ThermostatIndex(self.thermostat_index_varId)
+
+		return self.thermostat_index
+
+	def getDecisionHistory(self):
+		if self.decision_history is None:
+			self.decision_history = DecisionHistory(self.DECISION_HISTORY_SIZE)
+
+		return self.decision_history
+
+	def getHistoryStore(self):
+		# None when no history_file is set
+		if self.history_store is None and self.history_file is not None:
+			self.history_store = HistoryStore(self.history_file, self)
+
+		return self.history_store
+
+	def getProfiler(self):
+		if self.profiler is None:
+			self.profiler = Profiler(self)
+
+		return self.profiler
+
+	def getFanTracker(self):
+		if self.fan_tracker is None:
+			self.fan_tracker = FanStateTracker(self.FAN_SETTLE_SECONDS)
+
+		return self.fan_tracker
+
+	def getEventLog(self):
+		if self.event_log is None:
+			self.event_log = EventLog(self.LOG_FLUSH_SECONDS, self.LOG_MAX_PER_MINUTE)
+
+		return self.event_log
+
+	def getDeviceHealth(self):
+		if self.device_health is None:
+			self.device_health = DeviceHealth(self.DEVICE_FAILURE_THRESHOLD, self.DEVICE_RETRY_MINUTES, self.DEVICE_MAX_RETRY_MINUTES)
+
+		return self.device_health
 
 	def getFeelsLikeTemp(self):
-		try:
-			if "feelslike" in indigo.devices[self.weather_devId].states:
-				return indigo.devices[self.weather_devId].states["feelslike"]
-			elif "temp" in indigo.devices[self.weather_devId].states:
-				return indigo.devices[self.weather_devId].states["temp"]
+		return self.getSharedInputs().get("weather", self.readWeather)[0]
 
-			indigo.server.log("could not determine the feels like temp")
-			return -1
+	def readWeather(self):
+		# the feels like temperature, and when the weather device last changed (None if that is not known)
+		health = self.getDeviceHealth()
 
+		if not health.isAvailable(self.weather_devId):
+			return (-1, None)
+
+		try:
+			weatherDev = GetDevice(self.weather_devId)
+
+			if "feelslike" in weatherDev.states:
+				feelslike = weatherDev.states["feelslike"]
+			else:
+				feelslike = weatherDev.states["temp"]
 		except:
-			indigo.server.log("could not determine the feels like temp")
-			return -1
+			if health.failure(self.weather_devId, "fan script: the weather device"):
+				indigo.server.log("could not determine the feels like temp")
+			return (-1, None)
+
+		health.success(self.weather_devId)
+		return (feelslike, getattr(weatherDev, "lastChanged", None))
+
+	def isWeatherStale(self, now):
+		# a weather device that stopped updating should not keep deciding the always_on_outside_temp rule.  Logged once when it goes stale, and once when it updates again.
+		# A script run does not know what the last run saw, so only the resident engine logs it.
+		last_changed = self.getSharedInputs().get("weather", self.readWeather)[1]
+		stale = last_changed is not None and now - last_changed > datetime.timedelta(minutes = self.WEATHER_STALE_MINUTES)
+
+		if stale != self.weather_stale:
+			self.weather_stale = stale
+
+			if not self.resident_engine:
+				return stale
 
-	def isNighttime(self):
-		return (not (datetime.datetime.now().time() >= datetime.time(self.NIGHTTIME_END_HOUR,00) and datetime.datetime.now().time() <= datetime.time(self.NIGHTTIME_START_HOUR,00)))
+			if stale:
+				indigo.server.log("fan script: the weather device has not updated since " + str(last_changed) + ", the outside temperature will not be used to keep the fans on")
+			else:
+				indigo.server.log("fan script: the weather device is updating again")
+
+		return stale
+
+	def getNextDaypartChange(self, now):
+		# the first moment after now when isNighttime() changes.  Nighttime starts just after NIGHTTIME_START_HOUR:00 and ends at NIGHTTIME_END_HOUR:00.
+		candidates = []
+
+		for day in [now.date(), now.date() + datetime.timedelta(days = 1)]:
+			candidates.append(datetime.datetime.combine(day, datetime.time(self.NIGHTTIME_END_HOUR, 0)))
+			candidates.append(datetime.datetime.combine(day, datetime.time(self.NIGHTTIME_START_HOUR, 0)) + datetime.timedelta(seconds = 1))
+
+		return min(candidate for candidate in candidates if candidate > now)
+
+	def isNighttime(self, now = None):
+		if now is None:
+			now = Now()
+
+		return (not (now.time() >= datetime.time(self.NIGHTTIME_END_HOUR,00) and now.time() <= datetime.time(self.NIGHTTIME_START_HOUR,00)))
 
 class TempStep(object):
 	def __init__(self, min_temp, max_temp, impact, min_target = None, max_target = None):
@@ -309,6 +1119,437 @@ class TempStep(object):
 		self.min_target = min_target
 		self.max_target = max_target
 
+	def matches(self, temp_delta):
+		if self.min_temp is None:
+			return temp_delta <= self.max_temp
+		elif self.max_temp is None:
+			return temp_delta >= self.min_temp
+		else:
+			return temp_delta > self.min_temp and temp_delta <= self.max_temp
+
+# A list of TempSteps compiled into sorted ranges, so the step for a temperature delta is found with a binary search instead
+# of checking every step.  The result is the same as checking the steps in order and taking the first match: every
+# boundary value and every range between two boundaries is resolved to its first matching step when the table is built.
+class TempStepTable(object):
+	def __init__(self, temp_steps):
+		self.temp_steps = list(temp_steps)
+		self.boundaries = sorted(set([entry.min_temp for entry in self.temp_steps if entry.min_temp is not None] + [entry.max_temp for entry in self.temp_steps if entry.max_temp is not None]))
+
+		# at_boundary[i] is the step for a delta equal to boundaries[i], below_boundary[i] the step for a delta between
+		# boundaries[i - 1] and boundaries[i].  below_boundary has one more entry, for anything above the last boundary.
+		self.at_boundary = []
+		self.below_boundary = []
+		self.problems = []
+
+		for i in range(len(self.boundaries) + 1):
+			if i < len(self.boundaries):
+				self.at_boundary.append(self.firstMatch(self.boundaries[i], str(self.boundaries[i]) + "°F", False))
+
+			if len(self.boundaries) == 0:
+				continue
+			elif i == 0:
+				self.below_boundary.append(self.firstMatch(self.boundaries[0] - 1, "below " + str(self.boundaries[0]) + "°F", True))
+			elif i == len(self.boundaries):
+				self.below_boundary.append(self.firstMatch(self.boundaries[-1] + 1, "above " + str(self.boundaries[-1]) + "°F", True))
+			else:
+				self.below_boundary.append(self.firstMatch((self.boundaries[i - 1] + self.boundaries[i]) / 2.0, "between " + str(self.boundaries[i - 1]) + "°F and " + str(self.boundaries[i]) + "°F", True))
+
+	def firstMatch(self, temp_delta, description, checkOverlap):
+		matched = [entry for entry in self.temp_steps if entry.matches(temp_delta)]
+
+		if len(matched) == 0:
+			self.problems.append("no TempStep matches a temperature delta " + ("of " if not checkOverlap else "") + description)
+			return None
+
+		# steps are allowed to share a boundary value, only report steps that overlap over a range
+		if checkOverlap and len(matched) > 1:
+			self.problems.append(str(len(matched)) + " TempSteps match a temperature delta " + description + ", only the first one is used")
+
+		return matched[0]
+
+	def asCompiled(self):
+		# the table as plain values (steps are referred to by their position), to be saved in the rule plan cache
+		def index(entry):
+			return None if entry is None else self.temp_steps.index(entry)
+
+		return {
+			"steps": [[entry.min_temp, entry.max_temp, entry.impact, entry.min_target, entry.max_target] for entry in self.temp_steps],
+			"boundaries": self.boundaries,
+			"at_boundary": [index(entry) for entry in self.at_boundary],
+			"below_boundary": [index(entry) for entry in self.below_boundary]
+		}
+
+	@classmethod
+	def fromCompiled(cls, compiled):
+		# the reverse of asCompiled(), without checking the steps again
+		table = cls.__new__(cls)
+		table.temp_steps = [TempStep(*values) for values in compiled["steps"]]
+		table.boundaries = compiled["boundaries"]
+		table.at_boundary = [None if i is None else table.temp_steps[i] for i in compiled["at_boundary"]]
+		table.below_boundary = [None if i is None else table.temp_steps[i] for i in compiled["below_boundary"]]
+		table.problems = []
+		return table
+
+	def lookup(self, temp_delta):
+		if len(self.boundaries) == 0:
+			return None
+
+		i = bisect.bisect_left(self.boundaries, temp_delta)
+
+		if i < len(self.boundaries) and self.boundaries[i] == temp_delta:
+			return self.at_boundary[i]
+
+		return self.below_boundary[i]
+
+# Keeps track of the devices that keep failing to be read or to accept commands, so a fan or sensor that is offline
+# does not cost a failed call and a log line on every run.  After DEVICE_FAILURE_THRESHOLD failures in a row, the
+# device's circuit is opened: it is left alone (and its zone is skipped, or uses a default value) until it is retried
+# after DEVICE_RETRY_MINUTES.  Every failed retry doubles that time, up to DEVICE_MAX_RETRY_MINUTES.  Opening and
+# closing a circuit is logged once, the failures while it is open are not logged at all.
+#
+# Resident engine mode only: a script run from an action group starts with no failures every time, so it only skips a
+# device that fails more than once in the same run.
+class DeviceHealth(object):
+	def __init__(self, threshold, retry_minutes, max_retry_minutes):
+		self.threshold = threshold
+		self.retry_minutes = retry_minutes
+		self.max_retry_minutes = max_retry_minutes
+		self.lock = threading.Lock()
+		self.failures = {}
+		self.descriptions = {}
+		self.retry_at = {}
+		self.backoff = {}
+
+	def isAvailable(self, key):
+		retry_at = self.retry_at.get(key)
+		return retry_at is None or Now() >= retry_at
+
+	def isOpen(self, key):
+		return key in self.retry_at
+
+	def getFailures(self, key):
+		return self.failures.get(key, 0)
+
+	def success(self, key):
+		if key not in self.failures:
+			return
+
+		with self.lock:
+			wasOpen = key in self.retry_at
+			description = self.descriptions.pop(key, str(key))
+			self.failures.pop(key, None)
+			self.retry_at.pop(key, None)
+			self.backoff.pop(key, None)
+
+		if wasOpen:
+			indigo.server.log(description + " is responding again")
+
+	def failure(self, key, description):
+		# returns whether the caller should log the failure
+		with self.lock:
+			self.failures[key] = self.failures.get(key, 0) + 1
+			self.descriptions[key] = description
+
+			if self.failures[key] < self.threshold:
+				return True
+
+			opened = key not in self.retry_at
+			if opened:
+				self.backoff[key] = self.retry_minutes
+			else:
+				self.backoff[key] = min(self.backoff[key] * 2, self.max_retry_minutes)
+
+			self.retry_at[key] = Now() + datetime.timedelta(minutes = self.backoff[key])
+
+		if opened:
+			indigo.server.log(description + " has failed " + str(self.failures[key]) + " times in a row, it will not be used until it responds again (next try in " + str(self.backoff[key]) + " minutes)")
+
+		return False
+
+# The inputs that every zone shares (the weather device, someone_home, script_debug and instrumentation) are read at
+# most once every SHARED_INPUT_TTL seconds, no matter how many zones use them or how many runs there are.  A script run
+# has a new config every time, so there they are read once per run.  Each value
+# is read by the function given to get() when it is not cached or has expired.
+class SharedInputs(object):
+	def __init__(self, ttl):
+		self.ttl = datetime.timedelta(seconds = ttl)
+		self.values = {}
+
+	def get(self, name, read):
+		now = Now()
+		cached = self.values.get(name)
+
+		if cached is not None and cached[1] <= now < cached[1] + self.ttl:
+			return cached[0]
+
+		value = read()
+		self.values[name] = (value, now)
+		return value
+
+	def clear(self):
+		self.values = {}
+
+# Remembers the device ID for each thermostat name that has been looked up.  The index is saved to a variable (if one is
+# configured) so it survives between runs, and is only rebuilt by scanning all devices when a name is not in the index or
+# the remembered device no longer exists or was renamed (the NEST plugin sometimes re-creates its devices).
+class ThermostatIndex(object):
+	def __init__(self, varId = None):
+		self.varId = varId
+		self.ids = None
+
+	def load(self):
+		self.ids = {}
+
+		if self.varId is None:
+			return
+
+		try:
+			self.ids = dict(json.loads(GetVariable(self.varId).value))
+		except:
+			self.ids = {}
+
+	def save(self):
+		if self.varId is None:
+			return
+
+		try:
+			UpdateVariable(self.varId, value=unicode(json.dumps(self.ids, sort_keys = True)))
+		except Exception as e:
+			indigo.server.log("fan script: could not save the thermostat index.  error: " + str(e))
+
+	def rebuild(self, name):
+		wanted = set(self.ids.keys())
+		wanted.add(name.lower())
+
+		self.ids = {}
+		for dev in indigo.devices:
+			if dev.name.lower() in wanted:
+				self.ids[dev.name.lower()] = dev.id
+
+		self.save()
+
+	def lookup(self, name):
+		if self.ids is None:
+			self.load()
+
+		key = name.lower()
+		devId = self.ids.get(key)
+
+		if devId is not None:
+			try:
+				dev = GetDevice(devId)
+				if dev.name.lower() == key:
+					return dev
+			except:
+				pass
+
+		self.rebuild(name)
+		devId = self.ids.get(key)
+
+		if devId is None:
+			return None
+
+		return GetDevice(devId)
+
+def ParseLockTime(value):
+	try:
+		return datetime.datetime.fromtimestamp(float(value))
+	except ValueError:
+		# written by an older version of the script
+		return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+def FormatLockTime(when):
+	return str(int(time.mktime(when.timetuple())))
+
+# A time kept in a variable: when the lock of a zone expires (locked_varId), or when the script last changed its fan
+# (lastchanged_varId).  It is saved as seconds since the epoch, and only parsed again when the value of the variable has
+# changed since it was last read.
+class LockTime(object):
+	def __init__(self, varId):
+		self.varId = varId
+		self.value = None
+		self.time = None
+
+	def read(self):
+		value = GetVariable(self.varId).value
+
+		if value != self.value:
+			self.time = ParseLockTime(value)
+			self.value = value
+
+		return self.time
+
+	def write(self, writes, when):
+		value = unicode(FormatLockTime(when))
+		writes.update(self.varId, value)
+
+		self.value = value
+		self.time = ParseLockTime(value)
+
+# The speed and whoosh mode of a fan, from its Indigo states.  A fan that is on at speed 0 counts as speed 1, like getCurrentSpeed().
+def ParseFanState(states):
+	speed = int(states["speed"])
+
+	if speed == 0 and states["fan"]:
+		speed = 1
+
+	whoosh = states["whoosh"]
+
+	if isinstance(whoosh, basestring):
+		whoosh = whoosh.lower() == "on"
+
+	return (speed, bool(whoosh))
+
+# A change to a fan that the script did not make: the fan state before and after, and the version of the fan state it
+# replaced (see FanStateTracker)
+ManualChange = collections.namedtuple("ManualChange", ["at", "version", "speed_before", "speed", "whoosh_before", "whoosh"])
+
+# Tells the changes the script made to a fan from the ones made with the remote or the app, from the fan's change
+# notifications instead of comparing the fan's speed to target_speed_varId on every run.  That comparison does not work
+# while whoosh mode is on, so it is skipped then.  Here every notification is compared with the last state of the fan.
+# The plugin reports the speed, the fan on / off and whoosh in separate notifications, so the states in between do not
+# tell anything: every change from command() until settle_seconds after commandSent() is the script's own.  Any other
+# change is a ManualChange, except for the speed changes the fan makes by itself while whoosh mode is on.
+#
+# Only used once the AutoComfortEngine has started it, since it relies on the notifications.  Every change to a fan's
+# known state gets a new version.  Until a fan has a known state, its zone reads it from the device.
+class FanStateTracker(object):
+	def __init__(self, settle_seconds = 5):
+		self.lock = threading.Lock()
+		self.settle_seconds = settle_seconds
+		self.active = False
+		self.states = {}
+		self.commanded = {}
+		self.settling = {}
+		self.manual = {}
+		self.version = 0
+
+	def start(self):
+		self.active = True
+
+	def isActive(self):
+		return self.active
+
+	def getState(self, fanId):
+		# the (speed, whoosh) of the fan, or None if it has to be read from the device
+		if not self.active:
+			return None
+
+		with self.lock:
+			state = self.states.get(fanId)
+
+		return None if state is None else state[1:]
+
+	def setState(self, fanId, speed, whoosh):
+		# must be called while holding self.lock
+		self.version = self.version + 1
+		self.states[fanId] = (self.version, speed, whoosh)
+
+	def read(self, fanId, speed, whoosh):
+		# the state read from the device, when it was not known
+		if not self.active:
+			return
+
+		with self.lock:
+			if fanId not in self.states:
+				self.setState(fanId, speed, whoosh)
+
+	def command(self, fanId, speed, whoosh):
+		# called before the commands are sent, so their notifications are recognized even if they arrive first
+		with self.lock:
+			self.commanded[fanId] = (speed, whoosh)
+
+	def commandSent(self, fanId, accepted):
+		# accepted: the fan is now in the commanded state.  Otherwise its state is not known until it is read again.  The
+		# notifications of the commands can still arrive for a while (or, for a command that timed out, still happen).
+		with self.lock:
+			commanded = self.commanded.pop(fanId, None)
+
+			if accepted and commanded is not None:
+				self.setState(fanId, commanded[0], commanded[1])
+			else:
+				self.states.pop(fanId, None)
+
+			self.settling[fanId] = Now() + datetime.timedelta(seconds = self.settle_seconds)
+
+	def notify(self, fanId, states):
+		# a change notification for the fan.  Returns the ManualChange, if it was one.
+		if not self.active:
+			return None
+
+		try:
+			speed, whoosh = ParseFanState(states)
+		except:
+			return None
+
+		with self.lock:
+			state = self.states.get(fanId)
+
+			if state is None:
+				self.setState(fanId, speed, whoosh)
+				return None
+
+			version, speed_before, whoosh_before = state
+
+			# a change to another state of the fan
+			if (speed, whoosh) == (speed_before, whoosh_before):
+				return None
+
+			self.setState(fanId, speed, whoosh)
+
+			# the script's own commands, still being sent or settling
+			if fanId in self.commanded:
+				return None
+
+			settling = self.settling.get(fanId)
+			if settling is not None:
+				if Now() < settling:
+					return None
+
+				del self.settling[fanId]
+
+			# whoosh mode changes the speed by itself
+			if whoosh_before and whoosh:
+				return None
+
+			change = ManualChange(Now(), version, speed_before, speed, whoosh_before, whoosh)
+			self.manual[fanId] = change
+			return change
+
+	def takeManualChange(self, fanId):
+		# the last ManualChange of the fan since this was last called, or None
+		with self.lock:
+			return self.manual.pop(fanId, None)
+
+# Everything AutoComfort() needs to know about a zone, read from Indigo once at the start of a run.  All of the rules
+# for that run are evaluated against this, so they all see the same values and no device or variable is read twice.
+ZoneSnapshot = collections.namedtuple("ZoneSnapshot", [
+	"taken_at",
+	"is_nighttime",
+	"someone_home",
+	"feelslike",
+	"feelslike_stale",
+	"room_temperature",
+	"ideal_temperature",
+	"temp_delta",
+	"ideal_cooler_than_outside",
+	"humidity",
+	"presence",
+	"cool_setpoint",
+	"heat_setpoint",
+	"hvac_running",
+	"current_speed",
+	"whoosh",
+	"previous_target_speed",
+	"lock_expires",
+	"last_changed",
+	"change_hold_expires",
+	"locked_until",
+	"locked",
+	"event_changed",
+	"manual_change"
+])
+
 class FanZone(object):
 	def __init__(self, zoneName, fanId):
 		self.zoneName = zoneName
@@ -316,7 +1557,7 @@ class FanZone(object):
 		self.max_target = 7
 		self.debug = False
 		self.fanId = fanId
-		self.fanDev = indigo.devices[fanId]
+		self.fanDev = None  # read at the start of every run, by takeSnapshot()
 		self.bedtimeMaxSpeed = None
 		self.summer_fan_at_bedtime = False
 		self.reset_lock_when_no_presence = False
@@ -327,398 +1568,1709 @@ class FanZone(object):
 		self.locktime = 60  # in minutes, default value
 		self.zone_thermostat_id = None
 		self.zone_thermostat_name = None
+		self.current_event_varId = None
+		self.evaluation_delay = 0.5  # in seconds, resident engine mode only
+		self.temp_steps = []
+		self.night_temp_steps = None
+		self.temp_step_tables = None
+		self.lock_state = None
+		self.lastchanged_state = None
+		self.min_dwell_minutes = 0
+		self.min_dwell_down_minutes = None
+		self.max_changes_per_hour = None
+		self.change_times = collections.deque()
+		self.decision_memo = None
+
+	def compileTempSteps(self):
+		# builds the day and night TempStepTables once, when the config is loaded, and reports any problems with them
+		day = TempStepTable(self.temp_steps)
+		night = day
+
+		if self.night_temp_steps is not None:
+			night = TempStepTable(self.night_temp_steps)
+
+		for problem in day.problems:
+			indigo.server.log(self.zoneName + " fan script: " + problem)
+
+		if night is not day:
+			for problem in night.problems:
+				indigo.server.log(self.zoneName + " fan script: nighttime " + problem)
+
+		self.temp_step_tables = {False: day, True: night}
+
+	def getTempStepTable(self, is_nighttime):
+		return self.temp_step_tables[is_nighttime]
+
+	def getDecisionMemo(self, config):
+		if self.decision_memo is None:
+			self.decision_memo = DecisionMemo(config.DECISION_MEMO_SIZE)
+
+		return self.decision_memo
+
+	def getDependencies(self):
+		# the Indigo devices and variables that this zone depends on.  The thermostat is only known once it has been found.
+		# The variables the zone writes (target speed, locked and last changed) are left out, so its own changes do not
+		# cause another evaluation.  The lock and change hold expiring are handled by its wake-ups instead.
+		return set([
+			self.fanId,
+			self.temperature_devId,
+			self.presence_devId,
+			self.humidity_devId,
+			self.ideal_temperature_varId,
+			self.zone_thermostat_id
+		])
+
+	def takeSnapshot(self, config, now, is_nighttime, feelslike, feelslike_stale = False):
+		# returns None when the zone has to be skipped, because its fan is not responding
+		health = config.getDeviceHealth()
+
+		if not health.isAvailable(self.fanId) or not health.isAvailable(("commands", self.fanId)):
+			return None
 
-	def getMinTarget(self):
-		if self.getCurrentRoomTemperature() > self.always_on_inside_temp and self.min_target < 1:
-			self.min_target = 1
-
-		if config.getFeelsLikeTemp() > self.always_on_outside_temp and self.min_target < 1:
-			self.min_target = 1
-
-		if config.someone_home and config.isNighttime() and config.getFeelsLikeTemp() > 69:
-			self.min_target = 3
-
-		if config.someone_home and not config.isNighttime() and config.getFeelsLikeTemp() > 80:
-			self.min_target = 3
-
-		return self.min_target
-
-	def getMaxTarget(self):
-		if config.isNighttime():
-			return self.getBedtimeMaxSpeed()
-
-		if self.getMinTarget() > self.max_target:
-			return self.getMinTarget()
-
-		return self.max_target
+		# in resident engine mode the state of the fan is known from its change notifications, so it is not read again
+		tracker = config.getFanTracker()
+		fanState = tracker.getState(self.fanId)
+
+		if fanState is None:
+			try:
+				self.fanDev = GetDevice(self.fanId)
+			except:
+				if health.failure(self.fanId, self.zoneName + " fan script: the fan"):
+					indigo.server.log(self.zoneName + " fan script: could not find the fan")
+				return None
+
+			# the fan is only responding if every state could be read
+			failures = health.getFailures(self.fanId)
+			fanState = (self.getCurrentSpeed(health), self.wooshMode(health))
+
+			if health.getFailures(self.fanId) == failures:
+				health.success(self.fanId)
+
+			tracker.read(self.fanId, fanState[0], fanState[1])
+
+		room_temperature = self.getCurrentRoomTemperature(health)
+		ideal_temperature = self.getIdealTemperature()
+		thermostat = self.getThermostat(config)
+
+		presence = (is_nighttime and self.summer_fan_at_bedtime) or self.getPresence(health)
+		lock_expires = self.getLockExpiration()
+		last_changed = self.getLastChanged()
+		change_hold_expires = last_changed + datetime.timedelta(minutes = config.MINIMUM_CHANGE_FREQUENCY)
+		locked_until = max([lock_expires, change_hold_expires])
+
+		return ZoneSnapshot(
+			taken_at = now,
+			is_nighttime = is_nighttime,
+			someone_home = config.someone_home,
+			feelslike = feelslike,
+			feelslike_stale = feelslike_stale,
+			room_temperature = room_temperature,
+			ideal_temperature = ideal_temperature,
+			temp_delta = room_temperature - ideal_temperature,
+			ideal_cooler_than_outside = ideal_temperature < feelslike,
+			humidity = self.getHumidity(health),
+			presence = presence,
+			cool_setpoint = self.getCoolSetpoint(thermostat),
+			heat_setpoint = self.getHeatSetpoint(thermostat),
+			hvac_running = self.HVAC_Running(health, thermostat),
+			current_speed = fanState[0],
+			whoosh = fanState[1],
+			previous_target_speed = int(GetVariable(self.target_speed_varId).value),
+			lock_expires = lock_expires,
+			last_changed = last_changed,
+			change_hold_expires = change_hold_expires,
+			locked_until = locked_until,
+			locked = self.isLocked(presence, locked_until, now),
+			event_changed = self.getEventChanged(),
+			manual_change = tracker.takeManualChange(self.fanId)
+		)
 
 	def getIdealTemperature(self):
 		try:
-			return float(indigo.variables[self.ideal_temperature_varId].value)
+			return float(GetVariable(self.ideal_temperature_varId).value)
 		except:
-			indigo.server.log(fan.zoneName + " fan script: could not determine the ideal temperature")
+			indigo.server.log(self.zoneName + " fan script: could not determine the ideal temperature")
 			return -1.0
 
-	def getCurrentRoomTemperature(self):
-		try:
-			return float(indigo.devices[self.temperature_devId].sensorValue)
-		except:
-			indigo.server.log(self.zoneName + " fan script: could not determine the current room temperature")
+	def getCurrentRoomTemperature(self, health):
+		if not health.isAvailable(self.temperature_devId):
 			return -1.0
 
-	def getCoolSetpoint(self):
 		try:
-			return indigo.devices[self.zone_thermostat_id].coolSetpoint
+			room_temperature = float(GetDevice(self.temperature_devId).sensorValue)
 		except:
-			if self.findThermostat():
-				return indigo.devices[self.zone_thermostat_id].coolSetpoint
+			if health.failure(self.temperature_devId, self.zoneName + " fan script: the room temperature sensor"):
+				indigo.server.log(self.zoneName + " fan script: could not determine the current room temperature")
+			return -1.0
 
-			return None
+		health.success(self.temperature_devId)
+		return room_temperature
 
-	def getHeatSetpoint(self):
-		try:
-			return indigo.devices[self.zone_thermostat_id].heatSetpoint
-		except:
-			if self.findThermostat():
-				return indigo.devices[self.zone_thermostat_id].heatSetpoint
+	def getThermostat(self, config):
+		if self.zone_thermostat_id is not None:
+			try:
+				return GetDevice(self.zone_thermostat_id)
+			except:
+				pass
 
+		return self.findThermostat(config)
+
+	def getCoolSetpoint(self, thermostat):
+		if thermostat is None:
 			return None
 
-	def getSummerAtBedtime(self):
-		if self.config.isNighttime() and self.summer_fan_at_bedtime:
-			return True
+		return thermostat.coolSetpoint
 
-		return False
+	def getHeatSetpoint(self, thermostat):
+		if thermostat is None:
+			return None
 
-	def getPresence(self):
-		if self.getSummerAtBedtime():
-			return True
+		return thermostat.heatSetpoint
+
+	def getPresence(self, health):
+		if not health.isAvailable(self.presence_devId):
+			return False
 
 		try:
-			if "onOffState" in indigo.devices[self.presence_devId].states:
-				return bool(indigo.devices[self.presence_devId].states["onOffState"])
+			presenceDev = GetDevice(self.presence_devId)
+
+			if "onOffState" in presenceDev.states:
+				presence = bool(presenceDev.states["onOffState"])
 			else:
-				return (indigo.devices[presence_devId].onOffState)
+				presence = (presenceDev.onOffState)
 		except:
-			indigo.server.log(self.zoneName + " fan script: could not determine the local presence")
+			if health.failure(self.presence_devId, self.zoneName + " fan script: the presence sensor"):
+				indigo.server.log(self.zoneName + " fan script: could not determine the local presence")
+			return False
+
+		health.success(self.presence_devId)
+		return presence
+
+	def HVAC_Running(self, health, thermostat):
+		if thermostat is None:
+			return
+
+		if not health.isAvailable(thermostat.id):
 			return False
 
-	def HVAC_Running(self):
-		if self.zone_thermostat_id is None:
-			if not self.findThermostat():
-				return
-			
 		try:
-			return indigo.devices[self.zone_thermostat_id].states["hvac_state"] == "cooling" or indigo.devices[self.zone_thermostat_id].states["hvac_state"] == "heating"
+			hvac_running = thermostat.states["hvac_state"] == "cooling" or thermostat.states["hvac_state"] == "heating"
 		except Exception as e:
-			indigo.server.log(self.zoneName + " fan script: could not determine the HVAC status.  error: " + str(e))
+			if health.failure(thermostat.id, self.zoneName + " fan script: the thermostat"):
+				indigo.server.log(self.zoneName + " fan script: could not determine the HVAC status.  error: " + str(e))
 			return False
 
-	def findThermostat(self):
+		health.success(thermostat.id)
+		return hvac_running
+
+	def findThermostat(self, config):
 		if self.zone_thermostat_name is None or len(self.zone_thermostat_name) == 0:
 			indigo.server.log(self.zoneName + " fan script: no thermostat name is set")
-			return False
+			return None
 
-		for dev in indigo.devices:
-			if dev.name.lower() == self.zone_thermostat_name.lower():
-				self.zone_thermostat_id = dev.id
-				return True
+		thermostat = config.getThermostatIndex().lookup(self.zone_thermostat_name)
 
-		indigo.server.log(self.zoneName + " fan script: could not find the thermostat")
-		return False
+		if thermostat is None:
+			indigo.server.log(self.zoneName + " fan script: could not find the thermostat")
+			return None
+
+		self.zone_thermostat_id = thermostat.id
+		return thermostat
 
 	def getEventChanged(self):
 		try:
-			return str(indigo.variables[self.current_event_varId].value)
+			return str(GetVariable(self.current_event_varId).value)
 		except:
-#			indigo.server.log(fan.zoneName + " fan script: could not determine the event changed")
+#			indigo.server.log(self.zoneName + " fan script: could not determine the event changed")
 			return "unknown event"
 
-	def isIdealTempIsCoolerThanOutside(self):
-		return self.getIdealTemperature() < config.getFeelsLikeTemp()
-
-	def getTemperatureDelta(self):
-		return self.getCurrentRoomTemperature() - self.getIdealTemperature()
-
-	def getCurrentSpeed(self):
+	def getCurrentSpeed(self, health):
 		try:
 			currentSpeed = int(self.fanDev.states["speed"])
+			fanIsOn = self.fanDev.states["fan"]
 		except:
-			indigo.server.log(fan.zoneName + " fan script: could not determine the current fan speed")
-			currentSpeed = 0
-
-		fanIsOn = self.fanDev.states["fan"]
+			if health.failure(self.fanId, self.zoneName + " fan script: the fan"):
+				indigo.server.log(self.zoneName + " fan script: could not determine the current fan speed")
+			return 0
 
 		if currentSpeed == 0 and fanIsOn:
-			indigo.server.log(fan.zoneName + " fan script: fan speed/onState mismatch (currentSpeed: " + str(currentSpeed) + ", fanIsOn: " + str(fanIsOn))
+			indigo.server.log(self.zoneName + " fan script: fan speed/onState mismatch (currentSpeed: " + str(currentSpeed) + ", fanIsOn: " + str(fanIsOn))
 			return 1
 		elif not fanIsOn and currentSpeed > 0:
-			indigo.server.log(fan.zoneName + " fan script: fan speed/onState mismatch (currentSpeed: " + str(currentSpeed) + ", fanIsOn: " + str(fanIsOn))
+			indigo.server.log(self.zoneName + " fan script: fan speed/onState mismatch (currentSpeed: " + str(currentSpeed) + ", fanIsOn: " + str(fanIsOn))
 
 		return currentSpeed
 
 
-	def wooshMode(self):
+	def wooshMode(self, health):
 		try:
 			if isinstance(self.fanDev.states["whoosh"], basestring):
 				return self.fanDev.states["whoosh"].lower() == "on" # State "whoosh" of "Sunroom Ceiling Fan"
 			elif isinstance(self.fanDev.states["whoosh"], bool):
 				return bool(self.fanDev.states["whoosh"])
 		except:
-			indigo.server.log(fan.zoneName + " fan script: could not determine the woosh mode")
+			if health.failure(self.fanId, self.zoneName + " fan script: the fan"):
+				indigo.server.log(self.zoneName + " fan script: could not determine the woosh mode")
 			return False
 
-	def getBedtimeMaxSpeed(self):
-		if self.bedtimeMaxSpeed is not None:
-			return self.bedtimeMaxSpeed
-		else:
-			return self.max_target
-
-	def isLocked(self):
-		if self.reset_lock_when_no_presence and not self.getPresence():
+	def isLocked(self, presence, locked_until, now):
+		if self.reset_lock_when_no_presence and not presence:
 			return False
 
-		return self.isLockedTime() > datetime.datetime.now()
+		return locked_until > now
 
-		try:
-			pass
-		except Exception as e:
-			indigo.server.log(self.zoneName + " fan script: could not determine the fan lock status.  error: " + str(e))
-			indigo.variable.updateValue(self.locked_varId, value=unicode((datetime.datetime.now() - datetime.timedelta(minutes = self.locktime)).strftime("%Y-%m-%d %H:%M:%S")))
-			return False
+	def getLockState(self):
+		if self.lock_state is None:
+			self.lock_state = LockTime(self.locked_varId)
+
+		return self.lock_state
+
+	def getLastChangedState(self):
+		if self.lastchanged_state is None:
+			self.lastchanged_state = LockTime(self.lastchanged_varId)
+
+		return self.lastchanged_state
+
+	def getLockExpiration(self):
+		return self.getLockState().read()
+
+	def getLastChanged(self):
+		return self.getLastChangedState().read()
+
+	def getDwellMinutes(self, current_speed, target_speed):
+		minutes = self.min_dwell_minutes
+
+		if target_speed < current_speed and self.min_dwell_down_minutes is not None:
+			minutes = self.min_dwell_down_minutes
+
+		if isinstance(minutes, dict):
+			return minutes.get(current_speed, 0)
 
-	def isLockedTime(self):
-		date1 = datetime.datetime.strptime(indigo.variables[self.locked_varId].value, "%Y-%m-%d %H:%M:%S")
-		date2 = datetime.datetime.strptime(indigo.variables[self.lastchanged_varId].value, "%Y-%m-%d %H:%M:%S") + datetime.timedelta(minutes = config.MINIMUM_CHANGE_FREQUENCY)
+		return minutes
 
-		return max([date1, date2])
+	def getChangeHold(self, snapshot, target_speed):
+		# when the change policy allows the fan to be changed from its current speed to target_speed, or None if it is allowed now
+		now = snapshot.taken_at
+		hold = snapshot.last_changed + datetime.timedelta(minutes = self.getDwellMinutes(snapshot.current_speed, target_speed))
+
+		if self.max_changes_per_hour is not None:
+			while len(self.change_times) > 0 and self.change_times[0] <= now - datetime.timedelta(hours = 1):
+				self.change_times.popleft()
+
+			if len(self.change_times) >= self.max_changes_per_hour:
+				hold = max(hold, self.change_times[-self.max_changes_per_hour] + datetime.timedelta(hours = 1))
+
+		if hold > now:
+			return hold
+
+		return None
+
+	def recordChange(self, when):
+		self.change_times.append(when)
+
+	def getHumidity(self, health):
+		if not health.isAvailable(self.humidity_devId):
+			return -1.0
 
-	def getHumidity(self):
 		try:
-			return float(indigo.devices[self.humidity_devId].sensorValue)
+			humidity = float(GetDevice(self.humidity_devId).sensorValue)
 		except:
-			indigo.server.log(fan.zoneName + " fan script: could not determine the current humidity")
+			if health.failure(self.humidity_devId, self.zoneName + " fan script: the humidity sensor"):
+				indigo.server.log(self.zoneName + " fan script: could not determine the current humidity")
 			return -1.0
 
+		health.success(self.humidity_devId)
+		return humidity
+
 
 ######################
 
+# Collects the variable writes of a run, so they are made together once a zone has been evaluated.  Only the last value
+# written to each variable is kept, and it is not written at all if the variable already has that value.  Every write
+# is a call to the Indigo server and causes a variable changed event, which can trigger the script again.
+class VariableWrites(object):
+	def __init__(self):
+		self.current = {}
+		self.pending = collections.OrderedDict()
+
+	def setCurrent(self, varId, value):
+		self.current[varId] = unicode(value)
+
+	def update(self, varId, value):
+		self.pending[varId] = unicode(value)
+
+	def flush(self):
+		pending = self.pending
+		self.pending = collections.OrderedDict()
+
+		for varId, value in pending.items():
+			if self.current.get(varId) != value:
+				UpdateVariable(varId, value=value)
+				self.current[varId] = value
+
+# One rule that influenced the target speed of a zone: which rule it was, and the values it was based on.  They are only
+# turned into text by FormatDecision(), when the decision is written to the Event Log.
+class Reason(object):
+	FORMATS = {
+		"hvac_running": "%(zone)s HVAC is running [Impact: +1]",
+		"hvac_not_running": "HVAC is not running [Impact: 0]",
+		"mode": "Mode: %(mode)s mode",
+		"presence": "presence is detected [Impact: +1]",
+		"bedtime_humidity": "humidity (%(humidity)s%%) or outside feels like temperature (%(feelslike)s°F) is high during sleeping hours.  [Impact: +1]",
+		"temp_step": "current temperature (%(room_temperature)s°F) is between %(min_temp)s°F and %(max_temp)s°F (%(temp_delta)s°F) from the desired temperature of %(ideal_temperature)s°F [Impact: %(impact)s]",
+		"summer_cool_day": "ideal temperature of %(ideal_temperature)s°F is warmer than the current outside temperature (%(feelslike)s°F) [max_target: 0]",
+		"winter": "Fall, spring and winter mode [max_target: 1]",
+		"nobody_home": "no one is home [Maximum Target = 1]",
+		"min_target": "target speed set adjusted for the fan minimum speed [Minimum: %(min_target)s]",
+		"max_target": "target speed is adjusted for the fan maximum speed [Maximum: %(max_target)s]",
+		"whoosh": "turned on woosh mode",
+		"change_held": "a change to %(target_speed)s is held back by the change limits until %(held_until)s"
+	}
+
+	def __init__(self, rule, **inputs):
+		self.rule = rule
+		self.inputs = inputs
+
+	def format(self):
+		values = self.inputs
+
+		if self.rule == "temp_step":
+			step = values["step"]
+			impact = ""
+
+			if step.impact is not None:
+				impact = "target_speed: +" + str(step.impact) + "  "
+
+			if step.max_target is not None:
+				impact = impact + "max_target: " + str(step.max_target) + "  "
+
+			if step.min_target is not None:
+				impact = impact + "min_target: " + str(step.min_target)
+
+			values = dict(values, min_temp = step.min_temp, max_temp = step.max_temp, impact = impact)
+
+		return self.FORMATS[self.rule] % values
+
+def FormatDecision(zoneName, snapshot, target_speed, reasons):
+	current_speed = snapshot.current_speed
+
+	if target_speed > current_speed:
+		action_str = zoneName + " fan: increasing from " + str(current_speed) + " to " + str(target_speed)
+	elif target_speed == current_speed:
+		action_str = zoneName + " fan: no change (current speed: " + str(current_speed) + ")"
+	else:
+		action_str = zoneName + " fan: decreasing from " + str(current_speed) + " to " + str(target_speed)
+
+	reasons_str = ""
+	if len(reasons) > 0:
+		reasons_str = "\n" + "".join("     " + reason.format() + "\n" for reason in reasons)
+
+	return zoneName + " fan script: \n\n" + action_str + " due to the change to " + snapshot.event_changed + ", reasons influencing the target speed: " + reasons_str
+
+def FormatDebug(zoneName, snapshot, min_target, max_target, target_speed):
+	lines = [
+		" current speed: " + str(snapshot.current_speed),
+		" min_target speed: " + str(min_target),
+		" max_target speed: " + str(max_target),
+		" target speed: " + str(target_speed),
+		" room temp: " + str(snapshot.room_temperature) + "°F",
+		" outside temp: " + str(snapshot.feelslike) + "°F" + (" (stale)" if snapshot.feelslike_stale else ""),
+		" ideal temp: " + str(snapshot.ideal_temperature) + "°F",
+		" getCoolSetpoint: " + str(snapshot.cool_setpoint) + "°F",
+		" getHeatSetpoint: " + str(snapshot.heat_setpoint) + "°F",
+		" temp delta (current - ideal): " + str(snapshot.temp_delta) + "°F",
+		" isIdealTempIsCoolerThanOutside: " + str(snapshot.ideal_cooler_than_outside),
+		" getPresence: " + str(snapshot.presence),
+		" is_nighttime: " + str(snapshot.is_nighttime),
+		" fan.HVAC_Running(): " + str(snapshot.hvac_running),
+		" fan.wooshMode(): " + str(snapshot.whoosh)
+	]
+
+	return "\n\n" + zoneName + "fan script debug: \n\n" + "".join(line + "\n" for line in lines)
+
+# What came of the evaluation of a zone: "locked", "manual change" (the fan was changed outside of the script, and is
+# now locked), "change", "held" (by the change limits) or "no change".  expires is when the lock or change limit that
+# decided it runs out, so the zone has to be evaluated again then.
+DecisionRecord = collections.namedtuple("DecisionRecord", ["zoneName", "outcome", "snapshot", "target_speed", "min_target", "max_target", "reasons", "expires"])
+
+def FormatRecord(record):
+	line = str(record.snapshot.taken_at) + " " + record.outcome + ": speed " + str(record.snapshot.current_speed)
+
+	if record.target_speed is not None:
+		line = line + ", target " + str(record.target_speed) + " (min " + str(record.min_target) + ", max " + str(record.max_target) + ")"
+
+	return line + "".join("; " + reason.format() for reason in record.reasons if reason.rule != "mode")
+
+# The last decisions of every zone, oldest first.  Recording one is only an append to a deque, so every evaluation is
+# recorded, not just the ones written to the Event Log.
+class DecisionHistory(object):
+	def __init__(self, size):
+		self.size = size
+		self.records = {}
+		self.lock = threading.Lock()
+
+	def add(self, record):
+		with self.lock:
+			if record.zoneName not in self.records:
+				self.records[record.zoneName] = collections.deque(maxlen = self.size)
+
+			self.records[record.zoneName].append(record)
+
+	def getRecent(self, zoneName, count):
+		with self.lock:
+			records = list(self.records.get(zoneName, []))
+
+		return records[-count:] if count > 0 else []
+
+def DumpDecisions(config, zoneName, count = 10):
+	records = config.getDecisionHistory().getRecent(zoneName, count)
+
+	if len(records) == 0:
+		indigo.server.log(zoneName + " fan script: no decisions recorded")
+		return
+
+	indigo.server.log(zoneName + " fan script: the last " + str(len(records)) + " decisions:\n" + "".join("     " + FormatRecord(record) + "\n" for record in records))
+
+# Writes the decisions to the Event Log.  Until start() is called (by the AutoComfortEngine), every message is written
+# right away, like indigo.server.log().  Once started, a background thread writes the messages every flush_seconds, all
+# of them in one Event Log entry, and only max_per_minute messages per minute: the others are counted and left out.
+# Important messages (a fan being locked, or changed outside of the script) are always written, and count towards the
+# limit.  Errors are not written through here at all.  A message can be a function that returns the text, so the text
+# is built by the background thread.
+class EventLog(object):
+	def __init__(self, flush_seconds, max_per_minute):
+		self.flush_seconds = flush_seconds
+		self.max_per_minute = max_per_minute
+		self.lock = threading.Lock()
+		self.wakeup = threading.Event()
+		self.pending = []
+		self.written_at = collections.deque()
+		self.skipped = 0
+		self.thread = None
+		self.running = False
+
+	def write(self, message, important = False):
+		if self.thread is None:
+			indigo.server.log(self.getText(message))
+			return
+
+		with self.lock:
+			self.pending.append((message, important))
+
+	def getText(self, message):
+		if callable(message):
+			return message()
+
+		return message
+
+	def start(self):
+		if self.thread is not None:
+			return
+
+		self.running = True
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		if self.thread is None:
+			return
+
+		self.running = False
+		self.wakeup.set()
+		self.thread.join()
+		self.thread = None
+		self.flush()
+
+	def run(self):
+		while self.running:
+			self.wakeup.wait(self.flush_seconds)
+			self.wakeup.clear()
+
+			try:
+				self.flush()
+			except Exception as e:
+				indigo.server.log("fan script: could not write to the Event Log.  error: " + str(e))
+
+	def flush(self):
+		with self.lock:
+			pending = self.pending
+			self.pending = []
+
+		now = time.time()
+		while len(self.written_at) > 0 and self.written_at[0] <= now - 60:
+			self.written_at.popleft()
+
+		texts = []
+		for message, important in pending:
+			if len(self.written_at) >= self.max_per_minute and not important:
+				self.skipped = self.skipped + 1
+				continue
+
+			self.written_at.append(now)
+			texts.append(self.getText(message))
+
+		# reported once there is room for it again
+		if self.skipped > 0 and len(self.written_at) < self.max_per_minute:
+			self.written_at.append(now)
+			texts.append("fan script: " + str(self.skipped) + " decisions were not written to the Event Log (more than " + str(self.max_per_minute) + " per minute), see dumpDecisions()")
+			self.skipped = 0
+
+		if len(texts) > 0:
+			indigo.server.log("\n".join(texts))
+
+# One decision read back from a HistoryStore.  The temperatures are rounded to a tenth of a degree, the setpoints are
+# None when the thermostat of the zone was not found, target_speed is None when the fan was locked, and rules is the
+# set of the Reasons that applied.  commanded is whether the fan accepted the change ("change failed" and "change
+# timed out" are the outcomes of the ones it did not).
+HistoryRecord = collections.namedtuple("HistoryRecord", [
+	"taken_at", "zoneName", "outcome", "commanded", "room_temperature", "ideal_temperature", "feelslike", "humidity",
+	"cool_setpoint", "heat_setpoint", "presence", "hvac_running", "is_nighttime", "someone_home", "whoosh",
+	"current_speed", "target_speed", "rules"
+])
+
+# Keeps DecisionRecords in a SQLite database, one row of integers each: the temperatures in tenths of a degree, the
+# true / false inputs and the rules that applied as bits.  add() only appends the record to a list.  Once start() is
+# called (by the AutoComfortEngine), a background thread writes the records together in one transaction every
+# HISTORY_FLUSH_SECONDS.  A script run does not open the database: at its end, its records are appended to a file next
+# to it (history_file + ".pending"), which is moved into the database once it is HISTORY_SPOOL_KB big, or when the
+# history is read.
+#
+# Old records are thinned out and deleted once a day, when they are written.  The time of that is kept in the
+# database, since every run of the script has a new HistoryStore.  A connection is opened for every write or read, so
+# they can be made from any thread.
+class HistoryStore(object):
+	OUTCOMES = ["no change", "change", "held", "locked", "manual change", "change failed", "change timed out"]
+	FLAGS = ["presence", "hvac_running", "is_nighttime", "someone_home", "whoosh"]
+	RULES = ["hvac_running", "presence", "bedtime_humidity", "temp_step", "summer_cool_day", "winter", "nobody_home", "min_target", "max_target", "whoosh", "change_held"]
+	COLUMNS = ["taken_at", "zone", "outcome", "room_temperature", "ideal_temperature", "feelslike", "humidity", "cool_setpoint", "heat_setpoint", "flags", "rules", "current_speed", "target_speed"]
+
+	def __init__(self, path, config = None):
+		self.path = path
+		self.spool_path = path + ".pending"
+		self.config = config or AutoConfortConfig()
+		self.lock = threading.Lock()
+		self.pending = []
+		self.zones = None
+		self.pruned_at = None
+		self.thread = None
+		self.running = False
+		self.wakeup = threading.Event()
+
+	def connect(self):
+		connection = sqlite3.connect(self.path)
+		connection.execute("CREATE TABLE IF NOT EXISTS zones (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+		connection.execute("CREATE TABLE IF NOT EXISTS decisions (" + ", ".join(column + " INTEGER" for column in self.COLUMNS) + ")")
+		connection.execute("CREATE INDEX IF NOT EXISTS decisions_by_zone ON decisions (zone, taken_at)")
+		connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+		return connection
+
+	def add(self, record):
+		with self.lock:
+			self.pending.append(record)
+
+	def isStarted(self):
+		return self.thread is not None
+
+	def start(self):
+		if self.thread is not None:
+			return
+
+		self.running = True
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		if self.thread is None:
+			return
+
+		self.running = False
+		self.wakeup.set()
+		self.thread.join()
+		self.flush()
+		self.thread = None
+
+	def run(self):
+		while self.running:
+			self.wakeup.wait(self.config.HISTORY_FLUSH_SECONDS)
+			self.wakeup.clear()
+
+			try:
+				self.flush()
+			except Exception as e:
+				indigo.server.log("fan script: could not save the decision history to " + self.path + ".  error: " + str(e))
+
+	def getZoneId(self, connection, zoneName):
+		if self.zones is None:
+			self.zones = dict((name, zoneId) for zoneId, name in connection.execute("SELECT id, name FROM zones"))
+
+		if zoneName not in self.zones:
+			self.zones[zoneName] = connection.execute("INSERT INTO zones (name) VALUES (?)", (zoneName,)).lastrowid
+
+		return self.zones[zoneName]
+
+	def encode(self, record):
+		# the row of the record, with the name of the zone instead of its id
+		snapshot = record.snapshot
+
+		def tenths(value):
+			if value is None:
+				return None
+
+			return int(round(float(value) * 10))
+
+		flags = 0
+		for i, name in enumerate(self.FLAGS):
+			if getattr(snapshot, name):
+				flags = flags | (1 << i)
+
+		rules = 0
+		for reason in record.reasons:
+			if reason.rule in self.RULES:
+				rules = rules | (1 << self.RULES.index(reason.rule))
+
+		return [
+			int(time.mktime(snapshot.taken_at.timetuple())),
+			record.zoneName,
+			self.OUTCOMES.index(record.outcome),
+			tenths(snapshot.room_temperature),
+			tenths(snapshot.ideal_temperature),
+			tenths(snapshot.feelslike),
+			tenths(snapshot.humidity),
+			tenths(snapshot.cool_setpoint),
+			tenths(snapshot.heat_setpoint),
+			flags,
+			rules,
+			snapshot.current_speed,
+			record.target_speed
+		]
+
+	def flush(self):
+		with self.lock:
+			pending = self.pending
+			self.pending = []
+
+		if len(pending) == 0:
+			return
+
+		rows = [self.encode(record) for record in pending]
+
+		if self.thread is None:
+			self.spool(rows)
+		else:
+			self.importSpool(rows)
+
+	def spool(self, rows):
+		# a line of JSON for each row.  Appending to the file costs a lot less than a transaction.
+		with open(self.spool_path, "a") as spoolFile:
+			spoolFile.write("".join(json.dumps(row) + "\n" for row in rows))
+			size = spoolFile.tell()
+
+		if size >= self.config.HISTORY_SPOOL_KB * 1024:
+			self.importSpool()
+
+	def importSpool(self, rows = ()):
+		# writes the rows in the spool file, and rows, to the database.  The file is renamed before it is read, so the
+		# rows appended to it in the meantime are left for the next time.  If the write fails, it is tried again then.
+		reading = self.spool_path + ".reading"
+
+		if not os.path.exists(reading):
+			try:
+				os.rename(self.spool_path, reading)
+			except OSError:
+				reading = None
+
+		spooled = []
+		if reading is not None:
+			with open(reading, "r") as spoolFile:
+				for line in spoolFile:
+					try:
+						spooled.append(json.loads(line))
+					except ValueError:
+						pass # a line cut off by a run that was stopped part of the way through
+
+		self.write(spooled + list(rows))
+
+		if reading is not None:
+			os.remove(reading)
+
+	def write(self, rows):
+		if len(rows) == 0:
+			return
+
+		connection = self.connect()
+
+		try:
+			with connection:
+				for row in rows:
+					row[1] = self.getZoneId(connection, row[1])
+
+				connection.executemany("INSERT INTO decisions VALUES (" + ", ".join("?" for column in self.COLUMNS) + ")", rows)
+
+				now = Now()
+				if self.pruned_at is None:
+					row = connection.execute("SELECT value FROM meta WHERE name = 'pruned_at'").fetchone()
+					self.pruned_at = datetime.datetime.fromtimestamp(row[0] if row is not None else 0)
+
+				if now - self.pruned_at > datetime.timedelta(days = 1):
+					self.prune(connection, now)
+					connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('pruned_at', ?)", (int(time.mktime(now.timetuple())),))
+					self.pruned_at = now
+		except:
+			# the zones added in the transaction, and the time of the prune, were rolled back
+			self.zones = None
+			self.pruned_at = None
+			raise
+		finally:
+			connection.close()
+
+	def prune(self, connection, now):
+		def seconds(days):
+			return int(time.mktime((now - datetime.timedelta(days = days)).timetuple()))
+
+		connection.execute("DELETE FROM decisions WHERE taken_at < ?", (seconds(self.config.HISTORY_MAX_DAYS),))
+
+		# the first decision of each zone in every HISTORY_DOWNSAMPLE_MINUTES, and the ones that changed the fan, are kept
+		cutoff = seconds(self.config.HISTORY_DOWNSAMPLE_DAYS)
+		bucket = max(1, int(self.config.HISTORY_DOWNSAMPLE_MINUTES * 60))
+		connection.execute(
+			"DELETE FROM decisions WHERE taken_at < ? AND outcome != ? AND rowid NOT IN "
+			"(SELECT MIN(rowid) FROM decisions WHERE taken_at < ? GROUP BY zone, taken_at / ?)",
+			(cutoff, self.OUTCOMES.index("change"), cutoff, bucket))
+
+		count = connection.execute("SELECT COUNT(*) FROM decisions").fetchone()[0]
+		if count > self.config.HISTORY_MAX_RECORDS:
+			connection.execute("DELETE FROM decisions WHERE rowid IN (SELECT rowid FROM decisions ORDER BY taken_at LIMIT ?)", (count - self.config.HISTORY_MAX_RECORDS,))
+
+	def read(self, zoneName = None, start = None, end = None):
+		# HistoryRecords, oldest first.  The rows are read from the database as they are used, not all at once.
+		self.importSpool()
+		connection = self.connect()
+
+		try:
+			zones = dict((zoneId, name) for zoneId, name in connection.execute("SELECT id, name FROM zones"))
+
+			query = "SELECT " + ", ".join(self.COLUMNS) + " FROM decisions"
+			conditions = []
+			parameters = []
+
+			if zoneName is not None:
+				conditions.append("zone = ?")
+				parameters.append(dict((name, zoneId) for zoneId, name in zones.items()).get(zoneName, -1))
+
+			if start is not None:
+				conditions.append("taken_at >= ?")
+				parameters.append(int(time.mktime(start.timetuple())))
+
+			if end is not None:
+				conditions.append("taken_at < ?")
+				parameters.append(int(time.mktime(end.timetuple())))
+
+			if len(conditions) > 0:
+				query = query + " WHERE " + " AND ".join(conditions)
+
+			def degrees(value):
+				return None if value is None else value / 10.0
+
+			for row in connection.execute(query + " ORDER BY taken_at", parameters):
+				taken_at, zone, outcome, room, ideal, feelslike, humidity, cool, heat, flags, rules, current_speed, target_speed = row
+
+				yield HistoryRecord(
+					taken_at = datetime.datetime.fromtimestamp(taken_at),
+					zoneName = zones.get(zone),
+					outcome = self.OUTCOMES[outcome],
+					commanded = self.OUTCOMES[outcome] == "change",
+					room_temperature = degrees(room),
+					ideal_temperature = degrees(ideal),
+					feelslike = degrees(feelslike),
+					humidity = degrees(humidity),
+					cool_setpoint = degrees(cool),
+					heat_setpoint = degrees(heat),
+					presence = bool(flags & 1),
+					hvac_running = bool(flags & 2),
+					is_nighttime = bool(flags & 4),
+					someone_home = bool(flags & 8),
+					whoosh = bool(flags & 16),
+					current_speed = current_speed,
+					target_speed = target_speed,
+					rules = set(name for i, name in enumerate(self.RULES) if rules & (1 << i))
+				)
+		finally:
+			connection.close()
+
+######################
+#	Decision kernel.  The rules that pick the target speed of a zone, separate from reading Indigo, the lock logic,
+#	logging and changing the fan, so a decision depends on nothing but its DecisionInputs and the settings of the zone.
+######################
+
+# The values of a ZoneSnapshot that the rules use, with the temperatures and humidity rounded to the precision of the sensors
+DecisionInputs = collections.namedtuple("DecisionInputs", [
+	"is_nighttime",
+	"someone_home",
+	"feelslike",
+	"feelslike_stale",
+	"room_temperature",
+	"ideal_temperature",
+	"humidity",
+	"presence",
+	"cool_setpoint",
+	"heat_setpoint",
+	"hvac_running"
+])
+
+# The target speed picked by the rules, the minimum and maximum it was held to, and the Reasons for it
+Decision = collections.namedtuple("Decision", ["target_speed", "min_target", "max_target", "reasons"])
+
+def Quantize(value, precision):
+	if isinstance(value, float):
+		return round(value, precision)
+
+	return value
+
+def MakeDecisionInputs(snapshot, precision):
+	return DecisionInputs(
+		is_nighttime = snapshot.is_nighttime,
+		someone_home = snapshot.someone_home,
+		feelslike = Quantize(snapshot.feelslike, precision),
+		feelslike_stale = snapshot.feelslike_stale,
+		room_temperature = Quantize(snapshot.room_temperature, precision),
+		ideal_temperature = Quantize(snapshot.ideal_temperature, precision),
+		humidity = Quantize(snapshot.humidity, precision),
+		presence = snapshot.presence,
+		cool_setpoint = Quantize(snapshot.cool_setpoint, precision),
+		heat_setpoint = Quantize(snapshot.heat_setpoint, precision),
+		hvac_running = snapshot.hvac_running
+	)
+
+def MinTarget(fan, inputs, min_target):
+	if inputs.room_temperature > fan.always_on_inside_temp and min_target < 1:
+		min_target = 1
+
+	if not inputs.feelslike_stale and inputs.feelslike > fan.always_on_outside_temp and min_target < 1:
+		min_target = 1
+
+	if inputs.someone_home and inputs.is_nighttime and inputs.feelslike > 69:
+		min_target = 3
+
+	if inputs.someone_home and not inputs.is_nighttime and inputs.feelslike > 80:
+		min_target = 3
+
+	return min_target
+
+def MaxTarget(fan, inputs, min_target, max_target):
+	if inputs.is_nighttime:
+		if fan.bedtimeMaxSpeed is not None:
+			return fan.bedtimeMaxSpeed
+
+		return max_target
+
+	if min_target > max_target:
+		return min_target
+
+	return max_target
+
+def DecideTargetSpeed(fan, config, inputs):
+	# Only reads the settings of the zone and the config.  The "mode" Reasons are always included, EvaluateZones() only
+	# logs them in debug mode.
+	target_speed = 0
+	min_target = fan.min_target
+	max_target = fan.max_target
+	temp_delta = inputs.room_temperature - inputs.ideal_temperature
+	ideal_cooler_than_outside = inputs.ideal_temperature < inputs.feelslike
+	reasons = []
+
+	#################################################################
+	#		HVAC
+	#################################################################
+
+	if Instrumented:
+		StartPhase("hvac")
+
+	if inputs.hvac_running:
+		reasons.append(Reason("hvac_running", zone = fan.zoneName))
+		target_speed = target_speed + 1
+	else:
+		reasons.append(Reason("hvac_not_running"))
+
+	#################################################################
+	#		TEMPERATURE AND SEASON BASED LOGIC
+	#################################################################
+
+	if Instrumented:
+		StartPhase("season")
+
+	# For the summer months
+	if (inputs.cool_setpoint > 0 and (ideal_cooler_than_outside or temp_delta > 0)) or (inputs.cool_setpoint > 0 and inputs.heat_setpoint == 0 and fan.summer_fan_at_bedtime and inputs.is_nighttime):
+		delta_fanspeed_impact = 0
+		reasons.append(Reason("mode", mode = "summer warm day"))
+
+		# Increase when presence is detected
+		if inputs.presence:
+			reasons.append(Reason("presence"))
+			target_speed = target_speed + 1
+
+		# if humidity or temperature are high at night, raise one more level
+		if inputs.is_nighttime and fan.summer_fan_at_bedtime and (inputs.humidity > config.BEDTIME_HIGH_HUMIDITY or inputs.feelslike > config.BEDTIME_HIGH_FEELSLIKE_TEMPERATURE):
+			reasons.append(Reason("bedtime_humidity", humidity = inputs.humidity, feelslike = inputs.feelslike))
+			target_speed = target_speed + 1
+
+		entry = fan.getTempStepTable(inputs.is_nighttime).lookup(temp_delta)
+
+		if entry is not None:
+			if entry.impact is not None:
+				delta_fanspeed_impact = entry.impact
+
+			if entry.max_target is not None:
+				max_target = entry.max_target
+
+			if entry.min_target is not None:
+				min_target = entry.min_target
+
+			reasons.append(Reason("temp_step", step = entry, room_temperature = inputs.room_temperature, temp_delta = temp_delta, ideal_temperature = inputs.ideal_temperature))
+
+		target_speed = target_speed + delta_fanspeed_impact
+
+	# for the cooler days in the early summer.  AC is on, but it's cool outside.
+	elif inputs.cool_setpoint > 0 and inputs.heat_setpoint == 0 and not ideal_cooler_than_outside:
+		reasons.append(Reason("mode", mode = "summer cool day"))
+		max_target = 1
+
+		if MinTarget(fan, inputs, min_target) > 1:
+			min_target = 1
+
+		reasons.append(Reason("summer_cool_day", ideal_temperature = inputs.ideal_temperature, feelslike = inputs.feelslike))
+
+	# Fall, spring, and winter
+	elif inputs.heat_setpoint > 0:
+		reasons.append(Reason("mode", mode = "fall, spring, and winter"))
+		max_target = 1
+		reasons.append(Reason("winter"))
+
+	#################################################################
+	#		Someone is home
+	#################################################################
+
+	if not inputs.someone_home:
+		reasons.append(Reason("nobody_home"))
+		max_target = 1
+
+		if MinTarget(fan, inputs, min_target) > 1:
+			min_target = 1
+
+	#################################################################
+	#		MINIMUM AND MAXIMUM TARGET LOGIC
+	#################################################################
+
+	if Instrumented:
+		StartPhase("min_max")
+
+	# Compare target to the minimum and maximum and make adjustments
+	min_target = MinTarget(fan, inputs, min_target)
+	if target_speed < min_target:
+		reasons.append(Reason("min_target", min_target = min_target))
+		target_speed = min_target
+
+	max_target = MaxTarget(fan, inputs, min_target, max_target)
+	if target_speed > max_target:
+		reasons.append(Reason("max_target", max_target = max_target))
+		target_speed = max_target
+
+	return Decision(target_speed, min_target, max_target, tuple(reasons))
+
+# The most recently used Decisions of a zone, by their DecisionInputs.  Most runs are caused by a change that does not
+# change any of the inputs of the rules (a lock variable, the fan itself, a temperature changing by less than the
+# precision), so their Decision is already known.  Decisions (and their Reasons) are shared, they must not be changed.
+class DecisionMemo(object):
+	def __init__(self, size):
+		self.size = size
+		self.decisions = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, inputs, decide):
+		with self.lock:
+			decision = self.decisions.pop(inputs, None)
+
+			if decision is not None:
+				# moved to the end, as the most recently used
+				self.decisions[inputs] = decision
+				self.hits = self.hits + 1
+
+		if decision is not None:
+			if Instrumented:
+				CountCall("memo_hits")
+
+			return decision
+
+		decision = decide()
+
+		with self.lock:
+			self.misses = self.misses + 1
+			self.decisions[inputs] = decision
+
+			while len(self.decisions) > self.size:
+				self.decisions.popitem(last = False)
+
+		if Instrumented:
+			CountCall("memo_misses")
+
+		return decision
+
+	def getHitRate(self):
+		total = self.hits + self.misses
+
+		if total == 0:
+			return None
+
+		return float(self.hits) / total
+
+# A command for the SenseMe plugin, and what came of it.  status is "ok", "failed", "timed out", or "skipped" when an
+# earlier command for the same fan did not succeed.
+FanCommand = collections.namedtuple("FanCommand", ["zoneName", "fanId", "action", "props"])
+FanCommandResult = collections.namedtuple("FanCommandResult", ["command", "status", "error", "seconds"])
+
+# The new speed (and whoosh mode) of a zone, the commands that set it and its DecisionRecord, from EvaluateZones()
+ZoneChange = collections.namedtuple("ZoneChange", ["fan", "target_speed", "whoosh", "commands", "record"])
+
+# Sends the fan commands of a run to all of the fans at the same time, so one slow or unreachable fan does not hold up
+# the others.  The commands for one fan are sent in order, each one after the previous one has succeeded.  A command
+# that takes longer than the timeout is given up on; the plugin call can not be cancelled, so it may still finish later.
+class FanCommandDispatcher(object):
+	def __init__(self, plugin, timeout, workers):
+		self.plugin = plugin
+		self.timeout = timeout
+		self.workers = max(workers, 1)
+
+	def send(self, commands):
+		chains = collections.OrderedDict()
+		for index, command in enumerate(commands):
+			chains.setdefault(command.fanId, []).append((index, command))
+
+		results = {}
+		slots = threading.Semaphore(self.workers)
+		threads = []
+
+		for chain in chains.values():
+			slots.acquire()
+
+			thread = threading.Thread(target = self.sendChain, args = (chain, results, slots))
+			thread.daemon = True
+			threads.append(thread)
+			thread.start()
+
+		for thread in threads:
+			thread.join()
+
+		return [results[index] for index in range(len(commands))]
+
+	def sendChain(self, chain, results, slots):
+		try:
+			failed = False
+
+			for index, command in chain:
+				if failed:
+					results[index] = FanCommandResult(command, "skipped", None, 0.0)
+					continue
+
+				results[index] = self.sendCommand(command)
+				failed = results[index].status != "ok"
+		finally:
+			slots.release()
+
+	def sendCommand(self, command):
+		outcome = {}
+
+		def call():
+			try:
+				ExecuteAction(self.plugin, command.action, command.fanId, command.props)
+				outcome["status"] = "ok"
+			except Exception as e:
+				outcome["status"] = "failed"
+				outcome["error"] = str(e)
+
+		started = time.time()
+
+		thread = threading.Thread(target = call)
+		thread.daemon = True
+		thread.start()
+		thread.join(self.timeout)
+
+		if thread.is_alive():
+			return FanCommandResult(command, "timed out", None, time.time() - started)
+
+		return FanCommandResult(command, outcome["status"], outcome.get("error"), time.time() - started)
+
+def SendFanCommands(config, senseMePlugin, changes, writes, runStats):
+	commands = [command for change in changes for command in change.commands]
+
+	if len(commands) == 0:
+		return
+
+	tracker = config.getFanTracker()
+	for change in changes:
+		tracker.command(change.fan.fanId, change.target_speed, change.whoosh)
+
+	results = {}
+	for result in FanCommandDispatcher(senseMePlugin, config.FAN_COMMAND_TIMEOUT, config.FAN_COMMAND_WORKERS).send(commands):
+		results.setdefault(result.command.zoneName, []).append(result)
+
+	health = config.getDeviceHealth()
+	store = config.getHistoryStore()
+
+	for change in changes:
+		fan = change.fan
+		stats = None
+
+		if runStats is not None:
+			stats = runStats[fan.zoneName]
+			stats.activate()
+
+		for result in results[fan.zoneName]:
+			if result.status == "ok":
+				health.success(("commands", fan.fanId))
+			elif result.status == "failed":
+				if health.failure(("commands", fan.fanId), fan.zoneName + " fan script: the fan"):
+					indigo.server.log(fan.zoneName + " fan script: the " + result.command.action + " command failed.  error: " + str(result.error))
+			elif result.status == "timed out":
+				if health.failure(("commands", fan.fanId), fan.zoneName + " fan script: the fan"):
+					indigo.server.log(fan.zoneName + " fan script: the fan did not accept the " + result.command.action + " command within " + str(config.FAN_COMMAND_TIMEOUT) + " seconds")
+
+			if stats is not None and result.status != "skipped":
+				stats.count("fan_commands")
+				stats.addPhase("actuation", result.seconds)
+
+		tracker.commandSent(fan.fanId, all(result.status == "ok" for result in results[fan.zoneName]))
+
+		if store is not None:
+			status = results[fan.zoneName][0].status
+			store.add(change.record._replace(outcome = {"ok": "change", "failed": "change failed", "timed out": "change timed out"}[status]))
+
+		# A speed change that timed out is most likely still going to happen.  If it is not saved, the next run would see
+		# the new speed as a change made outside of the script, and lock the fan.
+		if results[fan.zoneName][0].status in ("ok", "timed out"):
+			if stats is not None:
+				stats.startPhase("actuation")
+
+			fan.recordChange(Now())
+
+			writes.update(fan.target_speed_varId, change.target_speed)
+			fan.getLastChangedState().write(writes, Now())
+			writes.flush()
+
+			if stats is not None:
+				stats.stop()
+
+	if runStats is not None:
+		RunStats.deactivate()
+
+def TakeSnapshots(config, fanZones, runStats = None):
+	# values shared by every zone are only read once per run
+	now = Now()
+	is_nighttime = config.isNighttime(now)
+	feelslike = config.getFeelsLikeTemp()
+	feelslike_stale = config.isWeatherStale(now)
+
+	if runStats is None:
+		return [fan.takeSnapshot(config, now, is_nighttime, feelslike, feelslike_stale) for fan in fanZones]
+
+	snapshots = []
+	for fan in fanZones:
+		stats = runStats[fan.zoneName]
+		stats.activate()
+		stats.startPhase("snapshot")
+		snapshots.append(fan.takeSnapshot(config, now, is_nighttime, feelslike, feelslike_stale))
+		stats.stop()
+
+	RunStats.deactivate()
+	return snapshots
+
+def ReportRunStats(config, runStats):
+	for stats in runStats.values():
+		indigo.server.log(stats.getSummary())
+
+	if config.instrumentation_summary_varId is not None:
+		summary = dict((zoneName, stats.asDict()) for zoneName, stats in runStats.items())
+		UpdateVariable(config.instrumentation_summary_varId, value=unicode(json.dumps(summary, sort_keys = True)))
+
 def AutoComfort(config, fanZones):
 	senseMeID = "com.pennypacker.indigoplugin.senseme"
 	senseMePlugin = indigo.server.getPlugin(senseMeID)
 
+	config.readVariables()
+
+	runStats = None
+	if config.instrumentation:
+		runStats = collections.OrderedDict((fan.zoneName, RunStats(fan.zoneName)) for fan in fanZones)
+
+	snapshots = TakeSnapshots(config, fanZones, runStats)
+	writes = VariableWrites()
+
+	try:
+		changes = EvaluateZones(config, fanZones, snapshots, writes, runStats)
+		SendFanCommands(config, senseMePlugin, changes, writes, runStats)
+	finally:
+		# the writes of a zone that failed part of the way through
+		writes.flush()
+
+		# without the AutoComfortEngine, nothing else would save the decision history
+		store = config.getHistoryStore()
+		if store is not None and not store.isStarted():
+			store.flush()
+
+	if runStats is not None:
+		RunStats.deactivate()
+		ReportRunStats(config, runStats)
+
+def EvaluateZones(config, fanZones, snapshots, writes, runStats):
+	# the fan commands are not sent from here, they are returned (as ZoneChanges) so all of the fans can be changed at once
+	changes = []
+	log = config.getEventLog()
+	history = config.getDecisionHistory()
+	store = config.getHistoryStore()
+
 	'''
 
 	LOOP THROUGH FANS
 
 	'''
-	for fan in fanZones:
+	for fan, snapshot in zip(fanZones, snapshots):
 	#	if config.script_debug:
 	#		indigo.server.log(fan.zoneName + ": now processing")
 
-		fan.config = config
+		# the fan is not responding (see DeviceHealth)
+		if snapshot is None:
+			continue
 
-		target_speed = 0
-		temp_delta = fan.getTemperatureDelta()
+		stats = None
+		if runStats is not None:
+			stats = runStats[fan.zoneName]
+			stats.activate()
+			stats.startPhase("lock")
 
-		# A list of the reasons that the script calculates for the speed.  Used for output to the Event Log
-		reasons = []
+		# the values of the variables that are already known, so writing the same value again can be skipped
+		writes.setCurrent(fan.target_speed_varId, snapshot.previous_target_speed)
+		writes.setCurrent(fan.locked_varId, fan.getLockState().value)
 
 	#################################################################
 	#		LOCK LOGIC - WHEN SOMEONE MAKES MANUAL CHANGES
 	#################################################################
 
-		previousTargetSpeed = int(indigo.variables[fan.target_speed_varId].value)
-		if not fan.isLocked() and fan.getCurrentSpeed() != previousTargetSpeed:
-			# woosh mode throws off the detection
-			if not fan.wooshMode():
-				indigo.server.log(fan.zoneName + ": has been changed outside of the auto_fan script (current speed: " + str(fan.getCurrentSpeed()) + ", previous target speed: " + str(previousTargetSpeed) + ").  Will now lock changes for 60 minutes")
-				# Seems that someone has made a change to the fan manually.
-				indigo.variable.updateValue(fan.locked_varId, value=unicode((datetime.datetime.now() + datetime.timedelta(minutes = fan.locktime)).strftime("%Y-%m-%d %H:%M:%S")))
-				indigo.variable.updateValue(fan.target_speed_varId, value=unicode(fan.getCurrentSpeed()))
-
-		if fan.isLocked():
-			indigo.variable.updateValue(fan.target_speed_varId, value=unicode(fan.getCurrentSpeed()))		
+		previousTargetSpeed = snapshot.previous_target_speed
+		locked = snapshot.locked
+		locked_until = snapshot.locked_until
+
+		# Without the change notifications of resident engine mode, a change is detected by comparing the speed with the
+		# last target speed.  woosh mode throws off that detection.  With them, a change made during the change hold
+		# that follows one of the script's own changes still starts the lock (only the lock itself ignores it).
+		if config.getFanTracker().isActive():
+			external = snapshot.manual_change is not None and not fan.isLocked(snapshot.presence, snapshot.lock_expires, snapshot.taken_at)
+		else:
+			external = not locked and snapshot.current_speed != previousTargetSpeed and not snapshot.whoosh
+
+		if external:
+			log.write(fan.zoneName + ": has been changed outside of the auto_fan script (current speed: " + str(snapshot.current_speed) + ", previous target speed: " + str(previousTargetSpeed) + ").  Will now lock changes for 60 minutes", important = True)
+			# Seems that someone has made a change to the fan manually.
+			lock_expires = snapshot.taken_at + datetime.timedelta(minutes = fan.locktime)
+			locked_until = max([lock_expires, snapshot.change_hold_expires])
+			locked = fan.isLocked(snapshot.presence, locked_until, snapshot.taken_at)
+			fan.getLockState().write(writes, lock_expires)
+			writes.update(fan.target_speed_varId, snapshot.current_speed)
+
+		if locked:
+			writes.update(fan.target_speed_varId, snapshot.current_speed)
+			record = DecisionRecord(fan.zoneName, "manual change" if external else "locked", snapshot, None, None, None, (), locked_until)
+			history.add(record)
+
+			if store is not None:
+				store.add(record)
+
 			if config.script_debug:
-				indigo.server.log(fan.zoneName + ": fan is locked (current speed: " + str(fan.getCurrentSpeed()) + ") from changes until " + str(fan.isLockedTime()))
+				log.write(fan.zoneName + ": fan is locked (current speed: " + str(snapshot.current_speed) + ") from changes until " + str(locked_until), important = True)
+
+			writes.flush()
+
+			if stats is not None:
+				stats.stop()
 			continue
 
 	#################################################################
-	#		HVAC
+	#		RULES (see DecideTargetSpeed())
 	#################################################################
 
-		if fan.HVAC_Running():
-			reasons.append(fan.zoneName + " HVAC is running [Impact: +1]")
-			target_speed = target_speed + 1
-		else:
-			reasons.append("HVAC is not running [Impact: 0]")
+		if stats is not None:
+			stats.startPhase("rules")
+
+		inputs = MakeDecisionInputs(snapshot, config.DECISION_PRECISION)
+		decision = fan.getDecisionMemo(config).get(inputs, lambda: DecideTargetSpeed(fan, config, inputs))
+		target_speed = decision.target_speed
+
+		# DecideTargetSpeed() times its own phases when it runs
+		if stats is not None:
+			stats.startPhase("rules")
+
+		# A list of the reasons that the script calculates for the speed.  Used for output to the Event Log
+		reasons = [reason for reason in decision.reasons if config.script_debug or reason.rule != "mode"]
 
 	#################################################################
-	#		TEMPERATURE AND SEASON BASED LOGIC
+	#		OUTPUT TO EVENT LOG
 	#################################################################
 
-		# For the summer months
-		if (fan.getCoolSetpoint() > 0 and (fan.isIdealTempIsCoolerThanOutside() or fan.getTemperatureDelta() > 0)) or (fan.getCoolSetpoint() > 0 and fan.getHeatSetpoint() == 0 and fan.summer_fan_at_bedtime and config.isNighttime()):
-			delta_fanspeed_impact = 0
+		current_speed = snapshot.current_speed
+		changed = target_speed != current_speed
+		outcome = "change" if changed else "no change"
+		expires = None
 
-			if config.script_debug:
-				reasons.append("Mode: summer warm day mode")
-
-			# Increase when presence is detected
-			if fan.getPresence():
-				reasons.append("presence is detected [Impact: +1]")
-				target_speed = target_speed + 1
-
-			# if humidity or temperature are high at night, raise one more level
-			if config.isNighttime() and fan.summer_fan_at_bedtime and (fan.getHumidity() > config.BEDTIME_HIGH_HUMIDITY or config.getFeelsLikeTemp() > config.BEDTIME_HIGH_FEELSLIKE_TEMPERATURE):
-				reasons.append("humidity (" + str(fan.getHumidity()) + "%) or outside feels like temperature (" + str(config.getFeelsLikeTemp()) + "°F) is high during sleeping hours.  [Impact: +1]")
-				target_speed = target_speed + 1
-
-			for entry in fan.temp_steps:
-				triggered = False
-				if entry.min_temp is None:
-					if temp_delta <= entry.max_temp:
-						triggered = True
-				elif entry.max_temp is None:
-					if temp_delta >= entry.min_temp:
-						triggered = True
-				else:
-					if temp_delta > entry.min_temp and temp_delta <= entry.max_temp:
-						triggered = True
-
-				if triggered:
-					impact_statement = ""
-					if entry.impact is not None:
-						delta_fanspeed_impact = entry.impact
-						impact_statement = "target_speed: +" + str(entry.impact) + "  "
-
-					if entry.max_target is not None:
-						fan.max_target = entry.max_target
-						impact_statement = impact_statement + "max_target: " + str(entry.max_target) + "  "
-
-					if entry.min_target is not None:
-						fan.min_target = entry.min_target
-						impact_statement = impact_statement + "min_target: " + str(entry.min_target)
-
-					reasons.append("current temperature (" + str(fan.getCurrentRoomTemperature()) + "°F) is between " + str(entry.min_temp) + "°F and " + str(entry.max_temp) + "°F (" + str(temp_delta) + "°F) from the desired temperature of " + str(fan.getIdealTemperature()) + "°F [Impact: " + impact_statement + "]")
-					break
-			
-			target_speed = target_speed + delta_fanspeed_impact
-		
-		# for the cooler days in the early summer.  AC is on, but it's cool outside.
-		elif fan.getCoolSetpoint() > 0 and fan.getHeatSetpoint() == 0 and not fan.isIdealTempIsCoolerThanOutside():
-			if config.script_debug:
-				reasons.append("Mode: summer cool day mode")
+		if changed:
+			held_until = fan.getChangeHold(snapshot, target_speed)
 
-			fan.max_target = 1
+			if held_until is not None:
+				reasons.append(Reason("change_held", target_speed = target_speed, held_until = held_until))
+				target_speed = current_speed
+				changed = False
+				outcome = "held"
+				expires = held_until
 
-			if fan.getMinTarget() > 1:
-				fan.min_target = 1
+		wooshMode = changed and target_speed >= 2 and fan.enable_woosh_mode_when_present and snapshot.presence and not snapshot.whoosh
 
-			reasons.append("ideal temperature of " + str(fan.getIdealTemperature()) + "°F is warmer than the current outside temperature (" + str(config.getFeelsLikeTemp()) + "°F) [max_target: 0]")
-		
-		# Fall, spring, and winter
-		elif fan.getHeatSetpoint() > 0:
-			if config.script_debug:
-				reasons.append("Mode: fall, spring, and winter mode")
+		if wooshMode:
+			reasons.append(Reason("whoosh"))
+
+		# the text is only built when it is written, which most runs do not do
+		if changed or config.script_debug:
+			if stats is not None:
+				stats.startPhase("strings")
 
-			fan.max_target = 1
-			reasons.append("Fall, spring and winter mode [max_target: 1]")
+			log.write(functools.partial(FormatDecision, fan.zoneName, snapshot, target_speed, tuple(reasons)))
+
+		record = DecisionRecord(fan.zoneName, outcome, snapshot, target_speed, decision.min_target, decision.max_target, tuple(reasons), expires)
+		history.add(record)
 
 	#################################################################
-	#		Someone is home
+	#		SAVE CHANGES TO THE FAN
 	#################################################################
 
-		if not config.someone_home:
-			reasons.append("no one is home [Maximum Target = 1]")
-			fan.max_target = 1
+		# The changes to the fan.  The variables are saved once the fan has accepted the new speed.  The decision is saved
+		# to the history file then too, with how the commands went.
+		if changed:
+			commands = [FanCommand(fan.zoneName, fan.fanId, "fanSpeed", {'speed':str(target_speed)})]
 
-			if fan.getMinTarget() > 1:
-				fan.min_target = 1
+			if wooshMode:
+				commands.append(FanCommand(fan.zoneName, fan.fanId, "whooshOn", {}))
 
-	#################################################################
-	#		MINIMUM AND MAXIMUM TARGET LOGIC
-	#################################################################
+			changes.append(ZoneChange(fan, target_speed, wooshMode or snapshot.whoosh, commands, record))
+		elif store is not None:
+			store.add(record)
 
-		# Compare target to the minimum and maximum and make adjustments
-		if target_speed < fan.getMinTarget():
-			reasons.append("target speed set adjusted for the fan minimum speed [Minimum: " + str(fan.getMinTarget()) + "]")
-			target_speed = fan.getMinTarget()
+		if config.script_debug:
+			if stats is not None:
+				stats.startPhase("debug")
 
-		if target_speed > fan.getMaxTarget():
-			reasons.append("target speed is adjusted for the fan maximum speed [Maximum: " + str(fan.getMaxTarget()) + "]")
+			log.write(functools.partial(FormatDebug, fan.zoneName, snapshot, decision.min_target, decision.max_target, target_speed))
 
-			target_speed = fan.getMaxTarget()
+		writes.flush()
 
-	#################################################################
-	#		CREATE STRINGS FOR OUTPUT TO EVENT LOG
-	#################################################################
+		if stats is not None:
+			stats.stop()
 
-		i = 0
-		reasons_str = ""
-		for reason in reasons:
-			if i == 0:
-				reasons_str = '\n'
+	return changes
 
-			reasons_str = reasons_str + "     " + reason + '\n'
-			i = i + 1
+####################################################################################
+#		RESIDENT ENGINE MODE
+####################################################################################
 
-	#################################################################
-	#		SAVE CHANGES TO THE FAN
-	#################################################################
+# Collapses bursts of changes into one evaluation per zone.  A zone marked dirty is evaluated once its delay has passed,
+# no matter how many times it was marked in the meantime.  A zone is never evaluated twice at the same time; if it is
+# marked dirty while it is being evaluated, it is evaluated again (after its delay) once the current evaluation finishes.
+# (The AutoComfortEngine also keeps different zones from being evaluated at the same time.)
+class ZoneScheduler(object):
+	def __init__(self, evaluateZone):
+		self.evaluateZone = evaluateZone
+		self.lock = threading.Lock()
+		self.dirty = set()
+		self.running = set()
+		self.timers = {}
+		self.delays = {}
+
+	def markDirty(self, zoneName, delay):
+		with self.lock:
+			self.dirty.add(zoneName)
+			self.delays[zoneName] = delay
+
+			if zoneName not in self.running and zoneName not in self.timers:
+				self.schedule(zoneName)
+
+	def schedule(self, zoneName):
+		# must be called while holding self.lock
+		timer = threading.Timer(self.delays[zoneName], self.run, [zoneName])
+		timer.daemon = True
+		self.timers[zoneName] = timer
+		timer.start()
+
+	def run(self, zoneName):
+		with self.lock:
+			self.timers.pop(zoneName, None)
+
+			if zoneName not in self.dirty or zoneName in self.running:
+				return
 
-		if target_speed > fan.getCurrentSpeed():
-			action_str = fan.zoneName + " fan: increasing from " + str(fan.getCurrentSpeed()) + " to " + str(target_speed)
-		elif target_speed == fan.getCurrentSpeed():
-			action_str = fan.zoneName + " fan: no change (current speed: " + str(fan.getCurrentSpeed()) + ")"
-		elif target_speed < fan.getCurrentSpeed():
-			action_str = fan.zoneName + " fan: decreasing from " + str(fan.getCurrentSpeed()) + " to " + str(target_speed)
+			self.dirty.discard(zoneName)
+			self.running.add(zoneName)
 
-		# Make the changes to the fan, save some things to the Indigo variables.  Write the output to the Event Log
-		if target_speed != fan.getCurrentSpeed():
-			wooshMode = target_speed >= 2 and fan.enable_woosh_mode_when_present and fan.getPresence() and not fan.wooshMode()
+		try:
+			self.evaluateZone(zoneName)
+		except Exception as e:
+			indigo.server.log(zoneName + " fan script: evaluation failed.  error: " + str(e))
+		finally:
+			with self.lock:
+				self.running.discard(zoneName)
+
+				if zoneName in self.dirty:
+					self.schedule(zoneName)
+
+	def stop(self):
+		with self.lock:
+			for timer in self.timers.values():
+				timer.cancel()
+
+			self.timers = {}
+			self.dirty = set()
+
+# Evaluates a zone at a given time, when nothing else would: see "Resident engine mode" at the top of this file.  Every
+# zone has at most one wake-up, the earliest one it was given since its last one.  A single thread sleeps until the
+# first one is due.
+class ZoneWakeUps(object):
+	def __init__(self, wake):
+		self.wake = wake
+		self.condition = threading.Condition()
+		self.heap = []
+		self.due = {}
+		self.thread = None
+		self.running = False
+
+	def schedule(self, zoneName, when):
+		with self.condition:
+			if zoneName in self.due and self.due[zoneName] <= when:
+				return
 
-			if wooshMode:
-				reasons_str = reasons_str + "     turned on woosh mode\n"
+			# the earlier entry of the zone stays in the heap, it is skipped since it no longer matches self.due
+			self.due[zoneName] = when
+			heapq.heappush(self.heap, (when, zoneName))
+			self.condition.notify()
 
-			indigo.server.log(fan.zoneName + " fan script: \n\n" + action_str + " due to the change to " + fan.getEventChanged() + ", reasons influencing the target speed: " + reasons_str)
+	def start(self):
+		if self.thread is not None:
+			return
 
-			senseMePlugin.executeAction("fanSpeed", deviceId=fan.fanId, props={'speed':str(target_speed)})
-			indigo.variable.updateValue(fan.target_speed_varId, value=unicode(target_speed))
-			indigo.variable.updateValue(fan.lastchanged_varId, value=unicode(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-			
-			if wooshMode:
-				senseMePlugin.executeAction("whooshOn", deviceId=fan.fanId, props={})
+		self.running = True
+		self.thread = threading.Thread(target = self.run)
+		self.thread.daemon = True
+		self.thread.start()
 
-		else:
-			if config.script_debug:
-				indigo.server.log(fan.zoneName + " fan script: \n\n" + action_str + " due to the change to " + fan.getEventChanged() + ", reasons influencing the target speed: " + reasons_str)
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.heap = []
+			self.due = {}
+			self.condition.notify()
 
-		if config.script_debug:
-			debug_str = "\n\n" + fan.zoneName + "fan script debug: \n\n"
-
-			debug_str = debug_str + " current speed: " + str(fan.getCurrentSpeed()) + "\n"
-			debug_str = debug_str + " min_target speed: " + str(fan.getMinTarget()) + "\n"
-			debug_str = debug_str + " max_target speed: " + str(fan.getMaxTarget()) + "\n"
-			debug_str = debug_str + " target speed: " + str(target_speed) + "\n"
-			debug_str = debug_str + " room temp: " + str(fan.getCurrentRoomTemperature()) + "°F" + "\n"
-			debug_str = debug_str + " outside temp: " + str(config.getFeelsLikeTemp()) + "°F" + "\n"
-			debug_str = debug_str + " ideal temp: " + str(fan.getIdealTemperature()) + "°F" + "\n"
-			debug_str = debug_str + " getCoolSetpoint: " + str(fan.getCoolSetpoint()) + "°F" + "\n"
-			debug_str = debug_str + " getHeatSetpoint: " + str(fan.getHeatSetpoint()) + "°F" + "\n"
-			debug_str = debug_str + " temp delta (current - ideal): " + str(fan.getTemperatureDelta()) + "°F" + "\n"
-			debug_str = debug_str + " isIdealTempIsCoolerThanOutside: " + str(fan.isIdealTempIsCoolerThanOutside()) + "\n"
-
-			debug_str = debug_str + " getPresence: " + str(fan.getPresence()) + "\n"
-			debug_str = debug_str + " is_nighttime: " + str(config.isNighttime()) + "\n"
-			debug_str = debug_str + " fan.HVAC_Running(): " + str(fan.HVAC_Running()) + "\n"
-			debug_str = debug_str + " fan.wooshMode(): " + str(fan.wooshMode()) + "\n"
-
-			indigo.server.log(debug_str)
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def run(self):
+		while True:
+			with self.condition:
+				if not self.running:
+					return
+
+				if len(self.heap) == 0:
+					self.condition.wait()
+					continue
+
+				when, zoneName = self.heap[0]
+				delay = (when - Now()).total_seconds()
+
+				if delay > 0:
+					self.condition.wait(delay)
+					continue
+
+				heapq.heappop(self.heap)
+
+				if self.due.get(zoneName) != when:
+					continue
+
+				del self.due[zoneName]
+
+			try:
+				self.wake(zoneName)
+			except Exception as e:
+				indigo.server.log(zoneName + " fan script: could not schedule the evaluation.  error: " + str(e))
+
+# Maps the ID of every Indigo device and variable used by the config to the names of the zones that depend on it, so a
+# change notification only causes the affected zones to be evaluated.  Inputs shared by all zones (like the weather device)
+# map to every zone.
+class DependencyIndex(object):
+	def __init__(self, config, fanZones):
+		self.zones = {}
+		self.thermostat_ids = dict((fan.zoneName, fan.zone_thermostat_id) for fan in fanZones)
+
+		shared = config.getDependencies()
+
+		for fan in fanZones:
+			for objId in shared | fan.getDependencies():
+				if objId is None or objId == -1:
+					continue
+
+				self.zones.setdefault(objId, set()).add(fan.zoneName)
+
+	def getZones(self, objId):
+		return self.zones.get(objId, set())
+
+	def isCurrent(self, fanZones):
+		# the thermostat IDs can change after the index was built (found for the first time, or re-created by the NEST plugin)
+		return self.thermostat_ids == dict((fan.zoneName, fan.zone_thermostat_id) for fan in fanZones)
+
+# Keeps the config and the FanZone objects (and their caches) loaded between evaluations.  Instead of running this
+# script from an action group, a plugin imports it, creates one engine and forwards its change notifications to it.
+# See "Resident engine mode" at the top of this file.
+class AutoComfortEngine(object):
+	def __init__(self):
+		self.config = AutoConfortConfig()
+		self.config.resident_engine = True
+		self.fanZones = []
+		self.loaded_for = None
+		self.evaluation_lock = threading.Lock()
+		self.scheduler = ZoneScheduler(self.evaluateZone)
+		self.wakeups = ZoneWakeUps(lambda zoneName: self.markDirty([zoneName]))
+		self.dependencies = DependencyIndex(self.config, [])
+		self.fanIds = set()
+
+	def getLoadKey(self):
+		# LoadConfig() picks minimum speeds based on the time of day and month, so it needs to run again when those change
+		return (self.config.isNighttime(), Now().date())
+
+	def load(self):
+		previousZones = dict((fan.zoneName, fan) for fan in self.fanZones)
+
+		self.fanZones = LoadZones(self.config)
+		self.loaded_for = self.getLoadKey()
+
+		for fan in self.fanZones:
+			if fan.zoneName in previousZones:
+				fan.zone_thermostat_id = previousZones[fan.zoneName].zone_thermostat_id
+				fan.change_times = previousZones[fan.zoneName].change_times
+			else:
+				fan.getThermostat(self.config)
+
+		self.dependencies = DependencyIndex(self.config, self.fanZones)
+		self.fanIds = set(fan.fanId for fan in self.fanZones)
+
+	def start(self):
+		with self.evaluation_lock:
+			self.load()
+
+		self.config.getEventLog().start()
+		self.config.getFanTracker().start()
+		self.wakeups.start()
+
+		if self.config.getHistoryStore() is not None:
+			self.config.getHistoryStore().start()
+
+		indigo.devices.subscribeToChanges()
+		indigo.variables.subscribeToChanges()
+
+		self.markDirty([fan.zoneName for fan in self.fanZones])
+
+	def stop(self):
+		self.wakeups.stop()
+		self.scheduler.stop()
+		self.config.getEventLog().stop()
+
+		if self.config.getHistoryStore() is not None:
+			self.config.getHistoryStore().stop()
+
+	def dumpDecisions(self, zoneName, count = 10):
+		DumpDecisions(self.config, zoneName, count)
+
+	def markDirty(self, zoneNames):
+		for fan in self.fanZones:
+			if fan.zoneName in zoneNames:
+				self.scheduler.markDirty(fan.zoneName, fan.evaluation_delay)
+
+	def evaluateZone(self, zoneName):
+		# The zones are evaluated one at a time.  A run changes the config (script_debug, someone_home), the
+		# Instrumented flag and the thermostat index, which the other zones would see half way through their run.
+		with self.evaluation_lock:
+			profiler = self.config.getProfiler()
+			profiling = profiler.startRun()
+
+			if self.loaded_for is None or self.loaded_for != self.getLoadKey():
+				if profiling:
+					profiler.profile("LoadConfig", self.load)
+				else:
+					self.load()
+
+			fanZones = [fan for fan in self.fanZones if fan.zoneName == zoneName]
+
+			try:
+				if profiling:
+					profiler.profile("AutoComfort " + zoneName, AutoComfort, self.config, fanZones)
+				else:
+					AutoComfort(self.config, fanZones)
+			finally:
+				self.scheduleWakeUp(zoneName)
+
+			if not self.dependencies.isCurrent(self.fanZones):
+				self.dependencies = DependencyIndex(self.config, self.fanZones)
+
+	def getWakeUpTime(self, zoneName):
+		# the next moment the decision of the zone can change without any of its inputs changing
+		now = Now()
+		times = [self.config.getNextDaypartChange(now), datetime.datetime.combine(now.date() + datetime.timedelta(days = 1), datetime.time(0, 0))]
+
+		records = self.config.getDecisionHistory().getRecent(zoneName, 1)
+		if len(records) > 0 and records[0].expires is not None and records[0].expires > now:
+			times.append(records[0].expires)
+
+		return min(times)
+
+	def scheduleWakeUp(self, zoneName):
+		self.wakeups.schedule(zoneName, self.getWakeUpTime(zoneName))
+
+	def deviceUpdated(self, origDev, newDev):
+		if newDev.id in self.fanIds:
+			self.config.getFanTracker().notify(newDev.id, newDev.states)
+
+		self.config.sharedInputChanged(newDev.id)
+		zoneNames = self.dependencies.getZones(newDev.id)
+
+		if zoneNames:
+			self.markDirty(zoneNames)
+
+	def variableUpdated(self, origVar, newVar):
+		# the script writes some of its own variables back with the same value, which should not cause another evaluation
+		if origVar.value == newVar.value:
+			return
+
+		self.config.sharedInputChanged(newVar.id)
+		zoneNames = self.dependencies.getZones(newVar.id)
+
+		if zoneNames:
+			self.markDirty(zoneNames)
 
 ####################################################################################
 
-config = AutoConfortConfig()
+if __name__ == "__main__":
+	config = AutoConfortConfig()
+
+	fanZones = LoadZones(config)
+	profiler = config.getProfiler()
 
-fanZones = LoadConfig(config)
-AutoComfort(config, fanZones)
+	# profiling_varId is only known once LoadConfig() has run, so it is run again to profile it
+	if profiler.startRun():
+		fanZones = profiler.profile("LoadConfig", LoadZones, config)
+		profiler.profile("AutoComfort", AutoComfort, config, fanZones)
+	else:
+		AutoComfort(config, fanZones)
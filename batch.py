@@ -0,0 +1,301 @@
+from __future__ import print_function
+
+import datetime
+import random
+import sys
+import time
+
+from simulate import FakeIndigo, LoadAutoFan, SimulatedClock
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+'''
+##############################################################
+Evaluates the target speed rules of auto_fan.py (DecideTargetSpeed()) for many samples at once, with NumPy.
+
+Use this for what-if analysis over a lot of data, like every zone of a house over a year of one-minute samples, where
+calling DecideTargetSpeed() once per zone and sample takes too long.  Requires NumPy, which is not needed by anything
+else (Indigo does not come with it).
+
+Usage:
+
+	python batch.py [samples]
+
+This loads the zones from your config (LoadConfig() or auto_fan.json) against the stand-in for the indigo module that
+simulate.py uses, generates a corpus of samples (300,000 by default) that covers every rule and every TempStep
+boundary, evaluates it with both EvaluateBatch() and DecideTargetSpeed(), and reports any sample where they differ
+along with the time each one took.
+
+From your own script:
+
+	import batch
+	result = batch.EvaluateBatch(fan, config, columns)
+
+columns is a dict of NumPy arrays (or lists), one value per sample, named like the fields of DecisionInputs:
+
+	room_temperature, ideal_temperature, feelslike, humidity, cool_setpoint, heat_setpoint
+	presence, hvac_running, is_nighttime				true / false
+	someone_home, feelslike_stale						optional, true / false (default: true, false)
+
+The values are used as they are: round them to config.DECISION_PRECISION first, like MakeDecisionInputs() does.  The
+result has arrays of target_speed, min_target, max_target and temp_step (the position of the matched TempStep in the
+zone's temp_steps, or night_temp_steps at nighttime, -1 for none), and in "rules" a true / false array for every rule, named like the Reasons.
+
+The settings of the zone are the ones it was loaded with.  LoadConfig() can pick different settings by the time of
+day and the month, so evaluate the samples of each of those periods with the zones loaded for it.
+
+##############################################################
+'''
+
+RULES = ["hvac_running", "summer_warm_day", "presence", "bedtime_humidity", "temp_step", "summer_cool_day", "winter", "nobody_home", "min_target", "max_target"]
+
+def Column(columns, name, count, default, dtype):
+	if name not in columns:
+		return numpy.full(count, default, dtype = dtype)
+
+	return numpy.asarray(columns[name], dtype = dtype)
+
+def LookupTempSteps(table, temp_delta):
+	# TempStepTable.lookup() for every sample: the position of the matched step in table.temp_steps, or -1
+	if len(table.boundaries) == 0:
+		return numpy.full(len(temp_delta), -1, dtype = numpy.int64)
+
+	def index(entry):
+		return -1 if entry is None else table.temp_steps.index(entry)
+
+	boundaries = numpy.asarray(table.boundaries, dtype = numpy.float64)
+	at_boundary = numpy.asarray([index(entry) for entry in table.at_boundary], dtype = numpy.int64)
+	below_boundary = numpy.asarray([index(entry) for entry in table.below_boundary], dtype = numpy.int64)
+
+	i = numpy.searchsorted(boundaries, temp_delta, side = "left")
+	at = numpy.zeros(len(temp_delta), dtype = bool)
+	inside = i < len(boundaries)
+	at[inside] = boundaries[i[inside]] == temp_delta[inside]
+
+	return numpy.where(at, at_boundary[numpy.minimum(i, len(boundaries) - 1)], below_boundary[i])
+
+def StepValues(table, steps, name):
+	# the given TempStep value of every sample's step, and whether it has one (not if it is None, or if steps is
+	# len(table.temp_steps), for no step)
+	values = [getattr(entry, name) for entry in table.temp_steps] + [None]
+	present = numpy.asarray([value is not None for value in values], dtype = bool)
+	values = numpy.asarray([0 if value is None else value for value in values], dtype = numpy.int64)
+
+	return values[steps], present[steps]
+
+def EvaluateBatch(fan, config, columns):
+	if numpy is None:
+		raise ImportError("batch.py needs NumPy: pip install numpy")
+
+	count = len(columns["room_temperature"])
+
+	room_temperature = Column(columns, "room_temperature", count, 0.0, numpy.float64)
+	ideal_temperature = Column(columns, "ideal_temperature", count, 0.0, numpy.float64)
+	feelslike = Column(columns, "feelslike", count, 0.0, numpy.float64)
+	humidity = Column(columns, "humidity", count, -1.0, numpy.float64)
+	cool_setpoint = Column(columns, "cool_setpoint", count, 0.0, numpy.float64)
+	heat_setpoint = Column(columns, "heat_setpoint", count, 0.0, numpy.float64)
+	presence = Column(columns, "presence", count, False, bool)
+	hvac_running = Column(columns, "hvac_running", count, False, bool)
+	is_nighttime = Column(columns, "is_nighttime", count, False, bool)
+	someone_home = Column(columns, "someone_home", count, True, bool)
+	feelslike_stale = Column(columns, "feelslike_stale", count, False, bool)
+
+	temp_delta = room_temperature - ideal_temperature
+	ideal_cooler_than_outside = ideal_temperature < feelslike
+	rules = {}
+
+	def minTarget(min_target):
+		# MinTarget()
+		min_target = numpy.where((room_temperature > fan.always_on_inside_temp) & (min_target < 1), 1, min_target)
+		min_target = numpy.where(~feelslike_stale & (feelslike > fan.always_on_outside_temp) & (min_target < 1), 1, min_target)
+		min_target = numpy.where(someone_home & is_nighttime & (feelslike > 69), 3, min_target)
+		min_target = numpy.where(someone_home & ~is_nighttime & (feelslike > 80), 3, min_target)
+		return min_target
+
+	# HVAC
+	rules["hvac_running"] = hvac_running
+	target_speed = hvac_running.astype(numpy.int64)
+	min_target = numpy.full(count, fan.min_target, dtype = numpy.int64)
+	max_target = numpy.full(count, fan.max_target, dtype = numpy.int64)
+
+	# temperature and season based logic
+	summer_warm_day = ((cool_setpoint > 0) & (ideal_cooler_than_outside | (temp_delta > 0))) | ((cool_setpoint > 0) & (heat_setpoint == 0) & fan.summer_fan_at_bedtime & is_nighttime)
+	summer_cool_day = ~summer_warm_day & (cool_setpoint > 0) & (heat_setpoint == 0) & ~ideal_cooler_than_outside
+	winter = ~summer_warm_day & ~summer_cool_day & (heat_setpoint > 0)
+	rules["summer_warm_day"] = summer_warm_day
+	rules["summer_cool_day"] = summer_cool_day
+	rules["winter"] = winter
+
+	rules["presence"] = summer_warm_day & presence
+	rules["bedtime_humidity"] = summer_warm_day & is_nighttime & fan.summer_fan_at_bedtime & ((humidity > config.BEDTIME_HIGH_HUMIDITY) | (feelslike > config.BEDTIME_HIGH_FEELSLIKE_TEMPERATURE))
+	target_speed = target_speed + rules["presence"] + rules["bedtime_humidity"]
+
+	day = fan.getTempStepTable(False)
+	night = fan.getTempStepTable(True)
+	day_steps = LookupTempSteps(day, temp_delta)
+	night_steps = LookupTempSteps(night, temp_delta)
+
+	# night is the same table as day when the zone has no night_temp_steps
+	if night is day:
+		temp_step = day_steps
+	else:
+		# the steps of the nighttime samples are positions in night.temp_steps, the others in day.temp_steps
+		temp_step = numpy.where(is_nighttime, night_steps, day_steps)
+
+	temp_step = numpy.where(summer_warm_day, temp_step, -1)
+	rules["temp_step"] = temp_step >= 0
+
+	for table, use in [(day, ~is_nighttime | (night is day)), (night, is_nighttime & (night is not day))]:
+		steps = numpy.where(use & rules["temp_step"], temp_step, len(table.temp_steps))
+
+		impact, has_impact = StepValues(table, steps, "impact")
+		step_min_target, has_min_target = StepValues(table, steps, "min_target")
+		step_max_target, has_max_target = StepValues(table, steps, "max_target")
+
+		target_speed = target_speed + numpy.where(has_impact, impact, 0)
+		max_target = numpy.where(has_max_target, step_max_target, max_target)
+		min_target = numpy.where(has_min_target, step_min_target, min_target)
+
+	max_target = numpy.where(summer_cool_day | winter, 1, max_target)
+	min_target = numpy.where(summer_cool_day & (minTarget(min_target) > 1), 1, min_target)
+
+	# someone is home
+	nobody_home = ~someone_home
+	rules["nobody_home"] = nobody_home
+	max_target = numpy.where(nobody_home, 1, max_target)
+	min_target = numpy.where(nobody_home & (minTarget(min_target) > 1), 1, min_target)
+
+	# minimum and maximum target
+	min_target = minTarget(min_target)
+	rules["min_target"] = target_speed < min_target
+	target_speed = numpy.where(rules["min_target"], min_target, target_speed)
+
+	# MaxTarget()
+	if fan.bedtimeMaxSpeed is not None:
+		bedtime_max_target = numpy.full(count, fan.bedtimeMaxSpeed, dtype = numpy.int64)
+	else:
+		bedtime_max_target = max_target
+
+	max_target = numpy.where(is_nighttime, bedtime_max_target, numpy.where(min_target > max_target, min_target, max_target))
+	rules["max_target"] = target_speed > max_target
+	target_speed = numpy.where(rules["max_target"], max_target, target_speed)
+
+	return {
+		"target_speed": target_speed,
+		"min_target": min_target,
+		"max_target": max_target,
+		"temp_step": temp_step,
+		"rules": rules
+	}
+
+######################
+#	Comparing EvaluateBatch() with DecideTargetSpeed()
+######################
+
+def GenerateCorpus(fan, count, seed = 0):
+	# Samples on a 0.1° grid, with every TempStep boundary of the zone (and the values next to it) as a temperature
+	# delta, and every combination of the true / false inputs
+	rng = random.Random(seed)
+
+	deltas = [-3.0, 0.0, 10.0]
+	for table in [fan.getTempStepTable(False), fan.getTempStepTable(True)]:
+		for boundary in table.boundaries:
+			deltas.extend([boundary - 0.1, boundary, boundary + 0.1])
+
+	columns = dict((name, []) for name in ["room_temperature", "ideal_temperature", "feelslike", "humidity", "cool_setpoint", "heat_setpoint", "presence", "hvac_running", "is_nighttime", "someone_home", "feelslike_stale"])
+
+	for i in range(count):
+		ideal_temperature = rng.choice([68.0, 71.0, 72.5, 74.0])
+
+		if rng.random() < 0.5:
+			delta = rng.choice(deltas)
+		else:
+			delta = rng.randint(-60, 100) / 10.0
+
+		season = rng.choice(["summer", "summer", "spring", "winter", "off"])
+
+		columns["ideal_temperature"].append(ideal_temperature)
+		columns["room_temperature"].append(round(ideal_temperature + delta, 1))
+		columns["feelslike"].append(rng.randint(200, 1000) / 10.0)
+		columns["humidity"].append(rng.choice([-1.0, rng.randint(200, 1000) / 10.0]))
+		columns["cool_setpoint"].append(0.0 if season in ("winter", "off") else rng.choice([72.0, 74.0, 76.0]))
+		columns["heat_setpoint"].append(0.0 if season in ("summer", "off") else rng.choice([66.0, 68.0]))
+		columns["presence"].append(rng.random() < 0.5)
+		columns["hvac_running"].append(rng.random() < 0.3)
+		columns["is_nighttime"].append(rng.random() < 0.4)
+		columns["someone_home"].append(rng.random() < 0.8)
+		columns["feelslike_stale"].append(rng.random() < 0.1)
+
+	return columns
+
+def ScalarRules(decision):
+	rules = set(reason.rule for reason in decision.reasons if reason.rule not in ("mode", "hvac_not_running"))
+
+	for reason in decision.reasons:
+		if reason.rule == "mode" and reason.inputs["mode"] == "summer warm day":
+			rules.add("summer_warm_day")
+
+	return rules
+
+def CompareZone(auto_fan, fan, config, count):
+	# returns the number of samples where EvaluateBatch() and DecideTargetSpeed() differ, and the seconds each one took
+	columns = GenerateCorpus(fan, count)
+
+	started = time.time()
+	result = EvaluateBatch(fan, config, columns)
+	batchSeconds = time.time() - started
+
+	started = time.time()
+	decisions = []
+	for i in range(count):
+		inputs = auto_fan.DecisionInputs(**dict((name, values[i]) for name, values in columns.items()))
+		decisions.append(auto_fan.DecideTargetSpeed(fan, config, inputs))
+	scalarSeconds = time.time() - started
+
+	differences = 0
+	for i, decision in enumerate(decisions):
+		batchRules = set(rule for rule in RULES if result["rules"][rule][i])
+
+		if (decision.target_speed, decision.min_target, decision.max_target) != (result["target_speed"][i], result["min_target"][i], result["max_target"][i]) or ScalarRules(decision) != batchRules:
+			if differences < 5:
+				print("  %s sample %d differs: %s, batch: target %d min %d max %d %s" % (fan.zoneName, i, decision[:3], result["target_speed"][i], result["min_target"][i], result["max_target"][i], sorted(batchRules)))
+
+			differences = differences + 1
+
+	return differences, batchSeconds, scalarSeconds
+
+def main(argv):
+	if numpy is None:
+		print("batch.py needs NumPy: pip install numpy")
+		return 2
+
+	count = 300000
+	if len(argv) > 1:
+		count = int(argv[1])
+
+	clock = SimulatedClock(datetime.datetime(2018, 7, 15, 14, 0, 0))
+	fakeIndigo = FakeIndigo(clock)
+	auto_fan = LoadAutoFan(fakeIndigo, clock)
+
+	# the zones only refer to the devices and variables when they are loaded, they do not need to exist
+	fakeIndigo.devices.autocreate = True
+	fakeIndigo.variables.autocreate = True
+
+	config = auto_fan.AutoConfortConfig()
+	fanZones = auto_fan.LoadZones(config)
+
+	failed = False
+	for fan in fanZones:
+		differences, batchSeconds, scalarSeconds = CompareZone(auto_fan, fan, config, count)
+		failed = failed or differences > 0
+
+		print("%s: %d samples, %d differences, batch %.3fs, DecideTargetSpeed() %.3fs" % (fan.zoneName, count, differences, batchSeconds, scalarSeconds))
+
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
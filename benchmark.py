@@ -0,0 +1,351 @@
+from __future__ import print_function
+
+import datetime
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+
+from simulate import FakeDevice, FakeIndigo, FakeSenseMePlugin, FakeVariable, LoadAutoFan, SimulatedClock
+
+'''
+##############################################################
+Benchmarks for auto_fan.py, against the same stand-in for the indigo module that simulate.py uses.
+
+Use this to see how the script scales before adding more fans, and to compare two versions of the script.
+
+Usage:
+
+	python benchmark.py [results.json] [--quick]
+
+For every combination of zone count (1, 10, 100), device count (100, 1,000, 10,000) and path through the rules (locked,
+summer warm day, summer cool day, winter), a house is generated and AutoComfort() is run against it.  100 zones need
+more than 100 devices, so that combination is skipped.  Every run takes the same path: the fans are put back to speed 0
+before each one.  For each combination this records:
+
+	run_seconds					median wall time of one AutoComfort() run over all zones
+	device_reads_per_zone		indigo.devices[...] lookups per zone per run
+	variable_reads_per_zone		indigo.variables[...] lookups per zone per run
+	variable_writes_per_run		indigo.variable.updateValue() calls per run
+	fan_commands_per_run		SenseMe plugin executeAction() calls per run
+	log_lines_per_run			lines written to the Event Log per run
+
+LoadZones() is timed for every zone count, and findThermostat() for every device count, both with an empty thermostat
+index (every device is scanned) and with the index already built.
+
+The results are written as JSON (to results.json if it is given, otherwise to stdout), one object per measurement,
+together with a hash of auto_fan.py so results from different versions can be told apart.  --quick runs fewer
+repetitions, for a fast check.
+
+##############################################################
+'''
+
+ZONE_COUNTS = [1, 10, 100]
+DEVICE_COUNTS = [100, 1000, 10000]
+SCENARIOS = ["locked", "summer_warm", "summer_cool", "winter"]
+
+# 2pm in the summer, so the runs are not affected by the nighttime rules
+BENCHMARK_TIME = datetime.datetime(2018, 7, 15, 14, 0, 0)
+
+# the inputs for each path through the rules
+SCENARIO_INPUTS = {
+	"locked": {"feelslike": 90.0, "room_temperature": 78.0, "cool_setpoint": 74.0, "heat_setpoint": 0, "hvac_state": "cooling", "locked": True},
+	"summer_warm": {"feelslike": 90.0, "room_temperature": 78.0, "cool_setpoint": 74.0, "heat_setpoint": 0, "hvac_state": "cooling", "locked": False},
+	"summer_cool": {"feelslike": 60.0, "room_temperature": 71.0, "cool_setpoint": 74.0, "heat_setpoint": 0, "hvac_state": "idle", "locked": False},
+	"winter": {"feelslike": 30.0, "room_temperature": 69.0, "cool_setpoint": 0, "heat_setpoint": 68.0, "hvac_state": "heating", "locked": False}
+}
+
+def median(values):
+	values = sorted(values)
+	middle = len(values) // 2
+
+	if len(values) % 2 == 1:
+		return values[middle]
+
+	return (values[middle - 1] + values[middle]) / 2.0
+
+def ScriptHash():
+	with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "auto_fan.py"), "rb") as script:
+		return hashlib.sha1(script.read()).hexdigest()
+
+######################
+#	A generated house
+######################
+
+class BenchmarkHouse(object):
+	def __init__(self, zoneCount, deviceCount):
+		self.clock = SimulatedClock(BENCHMARK_TIME)
+		self.indigo = FakeIndigo(self.clock)
+		self.auto_fan = LoadAutoFan(self.indigo, self.clock)
+		self.senseMe = FakeSenseMePlugin(self.indigo.devices, self.clock)
+		self.indigo.server.plugins["com.pennypacker.indigoplugin.senseme"] = self.senseMe
+
+		self.nextId = 1000
+		self.zoneCount = zoneCount
+
+		self.config = self.auto_fan.AutoConfortConfig()
+		self.config.BEDTIME_HIGH_FEELSLIKE_TEMPERATURE = 70
+		self.config.BEDTIME_HIGH_HUMIDITY = 80
+		self.config.NIGHTTIME_START_HOUR = 22
+		self.config.NIGHTTIME_END_HOUR = 8
+		self.config.MINIMUM_CHANGE_FREQUENCY = 2
+		self.config.someone_home_varId = self.addVariable("someone_home", "true").id
+		self.config.script_debug_varId = self.addVariable("script_debug", "false").id
+		self.config.weather_devId = self.addDevice("Weather").id
+
+		self.zones = []
+		for i in range(zoneCount):
+			self.zones.append(self.addZone("Zone " + str(i + 1)))
+
+		# the rest of the Indigo database: devices the script never uses, but findThermostat() has to look through
+		while len(self.indigo.devices) < deviceCount:
+			self.addDevice("Other Device " + str(len(self.indigo.devices)))
+
+	def newId(self):
+		self.nextId = self.nextId + 1
+		return self.nextId
+
+	def addDevice(self, name):
+		return self.indigo.devices.add(FakeDevice(self.newId(), name))
+
+	def addVariable(self, name, value):
+		return self.indigo.variables.add(FakeVariable(self.newId(), name, value))
+
+	def addZone(self, zoneName):
+		neverLocked = self.auto_fan.FormatLockTime(datetime.datetime(2000, 1, 1))
+
+		fanDev = self.addDevice(zoneName + " Fan")
+		fanDev.states.update({"speed": 0, "fan": False, "whoosh": "off"})
+
+		zone = {
+			"name": zoneName,
+			"fan": fanDev,
+			"temperature": self.addDevice(zoneName + " Temperature"),
+			"presence": self.addDevice(zoneName + " Presence"),
+			"humidity": self.addDevice(zoneName + " Humidity"),
+			"thermostat": self.addDevice(zoneName + " Thermostat"),
+			"ideal": self.addVariable(zoneName + " ideal temperature", "72.0"),
+			"target_speed": self.addVariable(zoneName + " target speed", "0"),
+			"locked": self.addVariable(zoneName + " locked", neverLocked),
+			"lastchanged": self.addVariable(zoneName + " last changed", neverLocked),
+			"event": self.addVariable(zoneName + " current event", "benchmark")
+		}
+
+		zone["presence"].states["onOffState"] = True
+		zone["humidity"].sensorValue = 50.0
+		return zone
+
+	def LoadConfig(self, config):
+		# the same kind of zones a user would define in LoadConfig(), one for every generated zone
+		fanZones = []
+
+		for zone in self.zones:
+			fan = self.auto_fan.FanZone(zone["name"], zone["fan"].id)
+			fan.target_speed_varId = zone["target_speed"].id
+			fan.ideal_temperature_varId = zone["ideal"].id
+			fan.temperature_devId = zone["temperature"].id
+			fan.presence_devId = zone["presence"].id
+			fan.humidity_devId = zone["humidity"].id
+			fan.zone_thermostat_name = zone["thermostat"].name
+			fan.locked_varId = zone["locked"].id
+			fan.lastchanged_varId = zone["lastchanged"].id
+			fan.current_event_varId = zone["event"].id
+			fan.always_on_outside_temp = 86
+			fan.always_on_inside_temp = 86
+			fan.enable_woosh_mode_when_present = True
+			fan.temp_steps = [
+				self.auto_fan.TempStep(None, -0.5, None, None, 1),
+				self.auto_fan.TempStep(-0.5, 1.0, 1, None, None),
+				self.auto_fan.TempStep(1.0, 2.5, 1, None, None),
+				self.auto_fan.TempStep(2.5, 3.5, 1, None, None),
+				self.auto_fan.TempStep(3.5, 4.5, 2, None, None),
+				self.auto_fan.TempStep(4.5, 6.0, 3, None, None),
+				self.auto_fan.TempStep(6.0, 7.0, 4, None, None),
+				self.auto_fan.TempStep(7.0, None, 5, None, None)
+			]
+			fanZones.append(fan)
+
+		return fanZones
+
+	def loadZones(self):
+		LoadConfig = self.auto_fan.LoadConfig
+		self.auto_fan.LoadConfig = self.LoadConfig
+
+		try:
+			return self.auto_fan.LoadZones(self.config)
+		finally:
+			self.auto_fan.LoadConfig = LoadConfig
+
+	def setScenario(self, scenario):
+		inputs = SCENARIO_INPUTS[scenario]
+		self.indigo.devices[self.config.weather_devId].states["feelslike"] = inputs["feelslike"]
+		self.config.getSharedInputs().clear()
+
+		lockedUntil = datetime.datetime(2000, 1, 1)
+		if inputs["locked"]:
+			lockedUntil = BENCHMARK_TIME + datetime.timedelta(days = 1)
+
+		for zone in self.zones:
+			zone["temperature"].sensorValue = inputs["room_temperature"]
+			zone["thermostat"].coolSetpoint = inputs["cool_setpoint"]
+			zone["thermostat"].heatSetpoint = inputs["heat_setpoint"]
+			zone["thermostat"].states["hvac_state"] = inputs["hvac_state"]
+			zone["locked"].value = self.auto_fan.FormatLockTime(lockedUntil)
+
+		self.resetFans()
+
+	def resetFans(self):
+		# puts every fan back to where the script left it before the run, so every run takes the same path
+		for zone in self.zones:
+			zone["fan"].states.update({"speed": 0, "fan": False, "whoosh": "off"})
+			zone["target_speed"].value = "0"
+			zone["lastchanged"].value = self.auto_fan.FormatLockTime(datetime.datetime(2000, 1, 1))
+
+######################
+#	The benchmarks
+######################
+
+def BenchmarkRuns(house, fanZones, scenario, repeat):
+	house.setScenario(scenario)
+
+	# the first run finds the thermostats, which is measured separately
+	house.auto_fan.AutoComfort(house.config, fanZones)
+
+	timings = []
+	before = house.indigo.getCounters()
+	commandsBefore = len(house.senseMe.commands)
+	memoBefore = MemoCounts(house, fanZones)
+
+	for i in range(repeat):
+		house.resetFans()
+
+		started = time.time()
+		house.auto_fan.AutoComfort(house.config, fanZones)
+		timings.append(time.time() - started)
+
+	after = house.indigo.getCounters()
+	memoAfter = MemoCounts(house, fanZones)
+	memoLookups = (memoAfter[0] - memoBefore[0]) + (memoAfter[1] - memoBefore[1])
+	runs = float(repeat)
+	zoneRuns = runs * len(fanZones)
+
+	return {
+		"benchmark": "auto_comfort",
+		"scenario": scenario,
+		"zones": len(fanZones),
+		"devices": len(house.indigo.devices),
+		"runs": repeat,
+		"run_seconds": median(timings),
+		"device_reads_per_zone": (after["device_reads"] - before["device_reads"]) / zoneRuns,
+		"variable_reads_per_zone": (after["variable_reads"] - before["variable_reads"]) / zoneRuns,
+		"variable_writes_per_run": (after["variable_writes"] - before["variable_writes"]) / runs,
+		"fan_commands_per_run": (len(house.senseMe.commands) - commandsBefore) / runs,
+		"log_lines_per_run": (after["log_lines"] - before["log_lines"]) / runs,
+		"memo_hit_rate": (memoAfter[0] - memoBefore[0]) / float(memoLookups) if memoLookups > 0 else None
+	}
+
+def MemoCounts(house, fanZones):
+	# the DecisionMemo hits and misses of all of the zones
+	memos = [fan.getDecisionMemo(house.config) for fan in fanZones]
+	return (sum(memo.hits for memo in memos), sum(memo.misses for memo in memos))
+
+def BenchmarkLoadZones(house, repeat):
+	timings = []
+
+	for i in range(repeat):
+		started = time.time()
+		house.loadZones()
+		timings.append(time.time() - started)
+
+	return {
+		"benchmark": "load_zones",
+		"zones": house.zoneCount,
+		"devices": len(house.indigo.devices),
+		"runs": repeat,
+		"run_seconds": median(timings)
+	}
+
+def BenchmarkFindThermostat(house, fanZones, repeat):
+	fan = fanZones[-1]
+	results = []
+
+	for warm in [False, True]:
+		timings = []
+		before = house.indigo.getCounters()
+
+		for i in range(repeat):
+			if not warm:
+				house.config.thermostat_index = None
+
+			fan.zone_thermostat_id = None
+
+			started = time.time()
+			fan.findThermostat(house.config)
+			timings.append(time.time() - started)
+
+		after = house.indigo.getCounters()
+
+		results.append({
+			"benchmark": "find_thermostat",
+			"index": "built" if warm else "empty",
+			"devices": len(house.indigo.devices),
+			"runs": repeat,
+			"run_seconds": median(timings),
+			"devices_scanned_per_call": (after["devices_scanned"] - before["devices_scanned"]) / float(repeat),
+			"device_reads_per_call": (after["device_reads"] - before["device_reads"]) / float(repeat)
+		})
+
+	return results
+
+def RunBenchmarks(quick = False, progress = None):
+	repeat = 3 if quick else 15
+	results = []
+
+	for deviceCount in DEVICE_COUNTS:
+		for zoneCount in ZONE_COUNTS:
+			# a house can not have fewer devices than its zones need
+			if zoneCount * 6 + 1 > deviceCount:
+				continue
+
+			house = BenchmarkHouse(zoneCount, deviceCount)
+			fanZones = house.loadZones()
+
+			if progress is not None:
+				progress(str(zoneCount) + " zones, " + str(len(house.indigo.devices)) + " devices")
+
+			if zoneCount == ZONE_COUNTS[0]:
+				results.extend(BenchmarkFindThermostat(house, fanZones, repeat))
+
+			results.append(BenchmarkLoadZones(house, repeat))
+
+			for scenario in SCENARIOS:
+				results.append(BenchmarkRuns(house, fanZones, scenario, repeat))
+
+	return results
+
+def main(argv):
+	quick = "--quick" in argv
+	paths = [arg for arg in argv[1:] if not arg.startswith("--")]
+
+	def progress(message):
+		sys.stderr.write("benchmarking " + message + "\n")
+
+	results = {
+		"script_sha1": ScriptHash(),
+		"python": platform.python_version(),
+		"quick": quick,
+		"results": RunBenchmarks(quick, progress)
+	}
+
+	if len(paths) > 0:
+		with open(paths[0], "w") as output:
+			json.dump(results, output, indent = 1, sort_keys = True)
+	else:
+		print(json.dumps(results, indent = 1, sort_keys = True))
+
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,438 @@
+from __future__ import print_function
+
+import csv
+import datetime
+import sys
+import time
+
+'''
+##############################################################
+Offline replay of recorded data through auto_fan.py, without Indigo or any fans.
+
+Use this to see what a change to your TempSteps or other settings in LoadConfig() would have done, before putting it
+in front of the real fans.  A day of one-minute samples replays in a few seconds.
+
+Usage:
+
+	python simulate.py recording.csv [decisions.csv]
+
+This loads auto_fan.py (and your LoadConfig()) from the same folder against a stand-in for the indigo module.  The
+devices and variables in your config are created in the stand-in, the recording is replayed one row at a time, and
+every zone is evaluated after each row the same way the resident engine mode would.  The Event Log lines the script
+writes are printed, and the decisions (one line per zone per row) are written to decisions.csv if it is given.
+
+Recording format:
+
+A CSV file with a header row.  "timestamp" is required (YYYY-MM-DD HH:MM:SS), every other column is optional, and
+an empty cell keeps the previous value:
+
+	feelslike				outside feels like temperature
+	someone_home			true / false
+	script_debug			true / false
+	<zone>:room_temperature
+	<zone>:ideal_temperature
+	<zone>:humidity
+	<zone>:presence			true / false
+	<zone>:cool_setpoint
+	<zone>:heat_setpoint
+	<zone>:hvac_state		cooling / heating / idle
+	<zone>:speed			a change made to the fan outside of the script (remote, app)
+	<zone>:whoosh			on / off, outside of the script
+
+<zone> is the zone name given to FanZone() in LoadConfig(), for example "MBR:room_temperature".
+
+##############################################################
+'''
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def parseBool(value):
+	return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+######################
+#	A stand-in for the parts of the indigo module that auto_fan.py uses
+######################
+
+class FakeDevice(object):
+	def __init__(self, devId, name):
+		self.id = devId
+		self.name = name
+		self.states = {}
+		self.sensorValue = None
+		self.onOffState = False
+		self.coolSetpoint = 0
+		self.heatSetpoint = 0
+		self.lastChanged = None
+
+class FakeVariable(object):
+	def __init__(self, varId, name, value = ""):
+		self.id = varId
+		self.name = name
+		self.value = value
+
+	def getValue(self, valueType):
+		if valueType is bool:
+			return parseBool(self.value)
+
+		return valueType(self.value)
+
+# indigo.devices / indigo.variables.  While autocreate is on, looking up an unknown ID creates it; this is only used while
+# discovering which devices and variables the config refers to.
+class FakeObjects(object):
+	def __init__(self, factory):
+		self.factory = factory
+		self.objects = {}
+		self.autocreate = False
+		self.reads = 0
+		self.scanned = 0
+
+	def __getitem__(self, objId):
+		self.reads = self.reads + 1
+
+		if objId not in self.objects:
+			if not self.autocreate:
+				raise KeyError(objId)
+
+			self.add(self.factory(objId, str(objId)))
+
+		return self.objects[objId]
+
+	def __contains__(self, objId):
+		return objId in self.objects
+
+	def __iter__(self):
+		self.scanned = self.scanned + len(self.objects)
+		return iter(list(self.objects.values()))
+
+	def __len__(self):
+		return len(self.objects)
+
+	def add(self, obj):
+		self.objects[obj.id] = obj
+		return obj
+
+	def subscribeToChanges(self):
+		pass
+
+class FakeVariableActions(object):
+	def __init__(self, variables):
+		self.variables = variables
+		self.writes = 0
+
+	def updateValue(self, varId, value = ""):
+		self.writes = self.writes + 1
+		self.variables.objects[varId].value = value
+
+class FakeServer(object):
+	def __init__(self, clock):
+		self.clock = clock
+		self.plugins = {}
+		self.lines = []
+
+	def log(self, message, *args, **kwargs):
+		self.lines.append((self.clock.now(), message))
+
+	def getPlugin(self, pluginId):
+		return self.plugins[pluginId]
+
+# The SenseMe plugin: applies fan commands to the fan devices and keeps a record of them
+class FakeSenseMePlugin(object):
+	def __init__(self, devices, clock):
+		self.devices = devices
+		self.clock = clock
+		self.commands = []
+
+	def executeAction(self, action, deviceId = None, props = None):
+		props = props or {}
+		fanDev = self.devices[deviceId]
+		self.commands.append((self.clock.now(), deviceId, action, dict(props)))
+
+		if action == "fanSpeed":
+			fanDev.states["speed"] = int(props["speed"])
+			fanDev.states["fan"] = int(props["speed"]) > 0
+		elif action == "whooshOn":
+			fanDev.states["whoosh"] = "on"
+		elif action == "whooshOff":
+			fanDev.states["whoosh"] = "off"
+
+class FakeIndigo(object):
+	def __init__(self, clock):
+		self.devices = FakeObjects(FakeDevice)
+		self.variables = FakeObjects(FakeVariable)
+		self.variable = FakeVariableActions(self.variables)
+		self.server = FakeServer(clock)
+
+	def getCounters(self):
+		# the number of Indigo API calls made so far, used by benchmark.py
+		return {
+			"device_reads": self.devices.reads,
+			"devices_scanned": self.devices.scanned,
+			"variable_reads": self.variables.reads,
+			"variable_writes": self.variable.writes,
+			"log_lines": len(self.server.lines)
+		}
+
+class SimulatedClock(object):
+	def __init__(self, now = None):
+		self.current = now or datetime.datetime(2000, 1, 1)
+
+	def now(self):
+		return self.current
+
+def LoadAutoFan(fakeIndigo, clock):
+	# auto_fan.py expects the indigo module (and the python 2 builtins) to already be there, like inside Indigo
+	try:
+		import __builtin__ as builtins
+	except ImportError:
+		import builtins
+
+	builtins.indigo = fakeIndigo
+
+	if not hasattr(builtins, "unicode"):
+		builtins.unicode = str
+
+	if not hasattr(builtins, "basestring"):
+		builtins.basestring = str
+
+	import auto_fan
+	auto_fan.Now = clock.now
+	return auto_fan
+
+######################
+#	The simulation
+######################
+
+class Simulation(object):
+	def __init__(self):
+		self.clock = SimulatedClock()
+		self.indigo = FakeIndigo(self.clock)
+		self.auto_fan = LoadAutoFan(self.indigo, self.clock)
+		self.senseMe = FakeSenseMePlugin(self.indigo.devices, self.clock)
+		self.indigo.server.plugins["com.pennypacker.indigoplugin.senseme"] = self.senseMe
+
+		self.createHouse()
+
+		self.engine = self.auto_fan.AutoComfortEngine()
+		self.last_values = {}
+
+	def createHouse(self):
+		# load the zones once (from LoadConfig() or auto_fan.json) to find out which devices and variables it refers to, then create all of them
+		self.indigo.devices.autocreate = True
+		self.indigo.variables.autocreate = True
+
+		config = self.auto_fan.AutoConfortConfig()
+		fanZones = self.auto_fan.LoadZones(config)
+
+		self.indigo.devices.autocreate = False
+		self.indigo.variables.autocreate = False
+
+		devices = self.indigo.devices
+		variables = self.indigo.variables
+
+		self.weather = devices.add(FakeDevice(config.weather_devId, "Weather"))
+		self.weather.states["feelslike"] = 75.0
+
+		self.someone_home = None
+		if config.someone_home_varId is not None:
+			self.someone_home = variables.add(FakeVariable(config.someone_home_varId, "someone_home", "true"))
+
+		self.script_debug = None
+		if config.script_debug_varId is not None:
+			self.script_debug = variables.add(FakeVariable(config.script_debug_varId, "script_debug", "false"))
+
+		if config.thermostat_index_varId is not None:
+			variables.add(FakeVariable(config.thermostat_index_varId, "thermostat_index", ""))
+
+		self.zones = {}
+		thermostats = {}
+		nextId = max(list(devices.objects.keys()) + list(variables.objects.keys()) + [0]) + 1
+		neverLocked = self.auto_fan.FormatLockTime(datetime.datetime(2000, 1, 1))
+
+		for fan in fanZones:
+			fanDev = devices.add(FakeDevice(fan.fanId, fan.zoneName + " Fan"))
+			fanDev.states.update({"speed": 0, "fan": False, "whoosh": "off"})
+
+			temperature = devices.add(FakeDevice(fan.temperature_devId, fan.zoneName + " Temperature"))
+			temperature.sensorValue = 72.0
+
+			presence = devices.add(FakeDevice(fan.presence_devId, fan.zoneName + " Presence"))
+			presence.states["onOffState"] = False
+
+			humidity = None
+			if fan.humidity_devId != -1:
+				humidity = devices.add(FakeDevice(fan.humidity_devId, fan.zoneName + " Humidity"))
+				humidity.sensorValue = 50.0
+
+			# zones can share a thermostat
+			name = (fan.zone_thermostat_name or "").lower()
+			if name not in thermostats:
+				thermostats[name] = devices.add(FakeDevice(nextId, fan.zone_thermostat_name))
+				thermostats[name].states["hvac_state"] = "idle"
+				nextId = nextId + 1
+
+			ideal = variables.add(FakeVariable(fan.ideal_temperature_varId, fan.zoneName + " ideal temperature", "72.0"))
+			variables.add(FakeVariable(fan.target_speed_varId, fan.zoneName + " target speed", "0"))
+			variables.add(FakeVariable(fan.locked_varId, fan.zoneName + " locked", neverLocked))
+			variables.add(FakeVariable(fan.lastchanged_varId, fan.zoneName + " last changed", neverLocked))
+
+			event = None
+			if fan.current_event_varId is not None:
+				event = variables.add(FakeVariable(fan.current_event_varId, fan.zoneName + " current event", ""))
+
+			self.zones[fan.zoneName] = {
+				"fan": fanDev,
+				"temperature": temperature,
+				"presence": presence,
+				"humidity": humidity,
+				"thermostat": thermostats[name],
+				"ideal": ideal,
+				"target_speed": variables[fan.target_speed_varId],
+				"locked": variables[fan.locked_varId],
+				"event": event
+			}
+
+	def apply(self, column, value):
+		if column == "feelslike":
+			self.weather.states["feelslike"] = float(value)
+			self.weather.lastChanged = self.clock.now()
+			return True
+		elif column == "someone_home":
+			if self.someone_home is not None:
+				self.someone_home.value = "true" if parseBool(value) else "false"
+			return True
+		elif column == "script_debug":
+			if self.script_debug is not None:
+				self.script_debug.value = "true" if parseBool(value) else "false"
+			return True
+
+		if ":" not in column:
+			return False
+
+		zoneName, field = column.split(":", 1)
+		if zoneName not in self.zones:
+			return False
+
+		zone = self.zones[zoneName]
+
+		if field == "room_temperature":
+			zone["temperature"].sensorValue = float(value)
+		elif field == "ideal_temperature":
+			zone["ideal"].value = str(float(value))
+		elif field == "humidity":
+			if zone["humidity"] is not None:
+				zone["humidity"].sensorValue = float(value)
+		elif field == "presence":
+			zone["presence"].states["onOffState"] = parseBool(value)
+			zone["presence"].onOffState = parseBool(value)
+		elif field == "cool_setpoint":
+			zone["thermostat"].coolSetpoint = float(value)
+		elif field == "heat_setpoint":
+			zone["thermostat"].heatSetpoint = float(value)
+		elif field == "hvac_state":
+			zone["thermostat"].states["hvac_state"] = value.strip()
+		elif field == "speed":
+			zone["fan"].states["speed"] = int(float(value))
+			zone["fan"].states["fan"] = int(float(value)) > 0
+		elif field == "whoosh":
+			zone["fan"].states["whoosh"] = "on" if parseBool(value) else "off"
+		else:
+			return False
+
+		return True
+
+	def step(self, timestamp, values):
+		self.clock.current = timestamp
+
+		changed = []
+		for column, value in values.items():
+			if column == "timestamp" or value is None or str(value).strip() == "":
+				continue
+
+			if not self.apply(column, value):
+				raise ValueError("unknown column in the recording: " + column)
+
+			if self.last_values.get(column) != value:
+				self.last_values[column] = value
+				changed.append(column)
+
+		# like the change notifications in the resident engine mode
+		if len(changed) > 0:
+			self.engine.config.getSharedInputs().clear()
+
+		for zoneName, zone in self.zones.items():
+			if zone["event"] is not None:
+				zone["event"].value = ", ".join(sorted(changed)) or "simulation"
+
+		decisions = []
+		for zoneName in sorted(self.zones.keys()):
+			zone = self.zones[zoneName]
+			before = zone["fan"].states["speed"]
+			commands = len(self.senseMe.commands)
+
+			self.engine.evaluateZone(zoneName)
+
+			decisions.append({
+				"timestamp": timestamp.strftime(TIMESTAMP_FORMAT),
+				"zone": zoneName,
+				"speed_before": before,
+				"speed": zone["fan"].states["speed"],
+				"whoosh": zone["fan"].states["whoosh"],
+				"locked_until": self.auto_fan.ParseLockTime(zone["locked"].value).strftime(TIMESTAMP_FORMAT),
+				"commands": len(self.senseMe.commands) - commands
+			})
+
+		return decisions
+
+	def replay(self, rows):
+		for row in rows:
+			timestamp = datetime.datetime.strptime(row["timestamp"].strip(), TIMESTAMP_FORMAT)
+			for decision in self.step(timestamp, row):
+				yield decision
+
+DECISION_FIELDS = ["timestamp", "zone", "speed_before", "speed", "whoosh", "locked_until", "commands"]
+
+def main(argv):
+	if len(argv) < 2:
+		print("usage: python simulate.py recording.csv [decisions.csv]")
+		return 2
+
+	simulation = Simulation()
+
+	output = None
+	writer = None
+	if len(argv) > 2:
+		if sys.version_info[0] < 3:
+			output = open(argv[2], "wb")
+		else:
+			output = open(argv[2], "w", newline = "")
+
+		writer = csv.DictWriter(output, fieldnames = DECISION_FIELDS)
+		writer.writeheader()
+
+	started = time.time()
+	rows = 0
+	changes = {}
+
+	with open(argv[1]) as recording:
+		for decision in simulation.replay(csv.DictReader(recording)):
+			rows = rows + 1
+			changes[decision["zone"]] = changes.get(decision["zone"], 0) + decision["commands"]
+
+			if writer is not None:
+				writer.writerow(decision)
+
+	if output is not None:
+		output.close()
+
+	for logged_at, message in simulation.indigo.server.lines:
+		print(logged_at.strftime(TIMESTAMP_FORMAT) + "  " + message)
+
+	print("")
+	print("replayed " + str(rows // max(len(simulation.zones), 1)) + " samples in " + str(round(time.time() - started, 2)) + " seconds")
+	for zoneName in sorted(changes.keys()):
+		print("  " + zoneName + ": " + str(changes[zoneName]) + " fan commands")
+
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,33 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simulate
+
+@pytest.fixture
+def clock():
+	return simulate.SimulatedClock(datetime.datetime(2020, 7, 1, 14, 0))
+
+@pytest.fixture
+def fakeIndigo(clock):
+	return simulate.FakeIndigo(clock)
+
+@pytest.fixture
+def auto_fan(fakeIndigo, clock):
+	# auto_fan.py with a fake Indigo and the simulated clock, like simulate.py runs it
+	module = simulate.LoadAutoFan(fakeIndigo, clock)
+	module.Instrumented = False
+	return module
+
+@pytest.fixture
+def zones(auto_fan, fakeIndigo):
+	# the config and zones of LoadConfig() (or auto_fan.json), which only refer to the devices and variables
+	fakeIndigo.devices.autocreate = True
+	fakeIndigo.variables.autocreate = True
+
+	config = auto_fan.AutoConfortConfig()
+	return config, auto_fan.LoadZones(config)
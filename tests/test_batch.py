@@ -0,0 +1,11 @@
+import pytest
+
+import batch
+
+@pytest.mark.skipif(batch.numpy is None, reason = "batch.py needs NumPy")
+def test_batch_matches_decide_target_speed(auto_fan, zones):
+	config, fanZones = zones
+
+	for fan in fanZones:
+		differences, batchSeconds, scalarSeconds = batch.CompareZone(auto_fan, fan, config, 5000)
+		assert differences == 0, fan.zoneName
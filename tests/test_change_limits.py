@@ -0,0 +1,56 @@
+import datetime
+
+NOW = datetime.datetime(2020, 7, 1, 14, 0)
+
+def Snapshot(auto_fan, current_speed, last_changed):
+	values = dict((field, None) for field in auto_fan.ZoneSnapshot._fields)
+	values.update(taken_at = NOW, current_speed = current_speed, last_changed = last_changed)
+	return auto_fan.ZoneSnapshot(**values)
+
+def test_no_limits_by_default(auto_fan):
+	fan = auto_fan.FanZone("Test", 1)
+	assert fan.getChangeHold(Snapshot(auto_fan, 2, NOW), 3) is None
+
+def test_dwell_minutes_for_every_speed(auto_fan):
+	fan = auto_fan.FanZone("Test", 1)
+	fan.min_dwell_minutes = 10
+	changed = NOW - datetime.timedelta(minutes = 4)
+
+	assert fan.getChangeHold(Snapshot(auto_fan, 2, changed), 3) == changed + datetime.timedelta(minutes = 10)
+	assert fan.getChangeHold(Snapshot(auto_fan, 2, NOW - datetime.timedelta(minutes = 10)), 3) is None
+
+def test_dwell_minutes_by_speed_and_direction(auto_fan):
+	fan = auto_fan.FanZone("Test", 1)
+	fan.min_dwell_minutes = {1: 5, 2: 10}
+	fan.min_dwell_down_minutes = 20
+	changed = NOW - datetime.timedelta(minutes = 8)
+
+	# up from 1 (5 minutes) and from 2 (10 minutes), and a speed with no entry
+	assert fan.getChangeHold(Snapshot(auto_fan, 1, changed), 2) is None
+	assert fan.getChangeHold(Snapshot(auto_fan, 2, changed), 3) == changed + datetime.timedelta(minutes = 10)
+	assert fan.getChangeHold(Snapshot(auto_fan, 4, changed), 5) is None
+
+	# down
+	assert fan.getChangeHold(Snapshot(auto_fan, 2, changed), 1) == changed + datetime.timedelta(minutes = 20)
+
+def test_changes_per_hour(auto_fan):
+	fan = auto_fan.FanZone("Test", 1)
+	fan.max_changes_per_hour = 2
+	never = datetime.datetime(2000, 1, 1)
+
+	fan.recordChange(NOW - datetime.timedelta(minutes = 70))
+	fan.recordChange(NOW - datetime.timedelta(minutes = 50))
+	assert fan.getChangeHold(Snapshot(auto_fan, 2, never), 3) is None
+
+	# the change 70 minutes ago no longer counts, the one 50 minutes ago does until it is an hour old
+	fan.recordChange(NOW - datetime.timedelta(minutes = 20))
+	assert fan.getChangeHold(Snapshot(auto_fan, 2, never), 3) == NOW + datetime.timedelta(minutes = 10)
+	assert len(fan.change_times) == 2
+
+def test_the_later_of_the_two_limits(auto_fan):
+	fan = auto_fan.FanZone("Test", 1)
+	fan.min_dwell_minutes = 30
+	fan.max_changes_per_hour = 1
+	fan.recordChange(NOW - datetime.timedelta(minutes = 50))
+
+	assert fan.getChangeHold(Snapshot(auto_fan, 2, NOW - datetime.timedelta(minutes = 5)), 3) == NOW + datetime.timedelta(minutes = 25)
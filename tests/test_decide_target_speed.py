@@ -0,0 +1,150 @@
+import batch
+
+def BaselineTargetSpeed(fan, config, inputs):
+	# the rules as the script had them before DecideTargetSpeed(), where getMinTarget() changed the zone's min_target
+	state = {"min_target": fan.min_target, "max_target": fan.max_target}
+
+	def getMinTarget():
+		if inputs.room_temperature > fan.always_on_inside_temp and state["min_target"] < 1:
+			state["min_target"] = 1
+
+		if inputs.feelslike > fan.always_on_outside_temp and state["min_target"] < 1:
+			state["min_target"] = 1
+
+		if inputs.someone_home and inputs.is_nighttime and inputs.feelslike > 69:
+			state["min_target"] = 3
+
+		if inputs.someone_home and not inputs.is_nighttime and inputs.feelslike > 80:
+			state["min_target"] = 3
+
+		return state["min_target"]
+
+	def getMaxTarget():
+		if inputs.is_nighttime:
+			return fan.bedtimeMaxSpeed if fan.bedtimeMaxSpeed is not None else state["max_target"]
+
+		if getMinTarget() > state["max_target"]:
+			return getMinTarget()
+
+		return state["max_target"]
+
+	target_speed = 0
+	temp_delta = inputs.room_temperature - inputs.ideal_temperature
+	ideal_cooler_than_outside = inputs.ideal_temperature < inputs.feelslike
+
+	if inputs.hvac_running:
+		target_speed = target_speed + 1
+
+	if (inputs.cool_setpoint > 0 and (ideal_cooler_than_outside or temp_delta > 0)) or (inputs.cool_setpoint > 0 and inputs.heat_setpoint == 0 and fan.summer_fan_at_bedtime and inputs.is_nighttime):
+		delta_fanspeed_impact = 0
+
+		if inputs.presence:
+			target_speed = target_speed + 1
+
+		if inputs.is_nighttime and fan.summer_fan_at_bedtime and (inputs.humidity > config.BEDTIME_HIGH_HUMIDITY or inputs.feelslike > config.BEDTIME_HIGH_FEELSLIKE_TEMPERATURE):
+			target_speed = target_speed + 1
+
+		for entry in fan.getTempStepTable(inputs.is_nighttime).temp_steps:
+			if entry.min_temp is None:
+				triggered = temp_delta <= entry.max_temp
+			elif entry.max_temp is None:
+				triggered = temp_delta >= entry.min_temp
+			else:
+				triggered = temp_delta > entry.min_temp and temp_delta <= entry.max_temp
+
+			if triggered:
+				if entry.impact is not None:
+					delta_fanspeed_impact = entry.impact
+
+				if entry.max_target is not None:
+					state["max_target"] = entry.max_target
+
+				if entry.min_target is not None:
+					state["min_target"] = entry.min_target
+				break
+
+		target_speed = target_speed + delta_fanspeed_impact
+	elif inputs.cool_setpoint > 0 and inputs.heat_setpoint == 0 and not ideal_cooler_than_outside:
+		state["max_target"] = 1
+
+		if getMinTarget() > 1:
+			state["min_target"] = 1
+	elif inputs.heat_setpoint > 0:
+		state["max_target"] = 1
+
+	if not inputs.someone_home:
+		state["max_target"] = 1
+
+		if getMinTarget() > 1:
+			state["min_target"] = 1
+
+	if target_speed < getMinTarget():
+		target_speed = getMinTarget()
+
+	if target_speed > getMaxTarget():
+		target_speed = getMaxTarget()
+
+	return target_speed
+
+def MakeInputs(auto_fan, **values):
+	inputs = dict(is_nighttime = False, someone_home = True, feelslike = 75.0, feelslike_stale = False, room_temperature = 72.0, ideal_temperature = 72.0,
+		humidity = 50.0, presence = False, cool_setpoint = 74.0, heat_setpoint = 0.0, hvac_running = False)
+	inputs.update(values)
+	return auto_fan.DecisionInputs(**inputs)
+
+def test_matches_the_baseline_rules(auto_fan, zones):
+	config, fanZones = zones
+
+	for fan in fanZones:
+		columns = batch.GenerateCorpus(fan, 3000, seed = 1)
+		# the baseline had no stale weather rule
+		columns["feelslike_stale"] = [False] * 3000
+
+		for i in range(3000):
+			inputs = auto_fan.DecisionInputs(**dict((name, values[i]) for name, values in columns.items()))
+			assert auto_fan.DecideTargetSpeed(fan, config, inputs).target_speed == BaselineTargetSpeed(fan, config, inputs), (fan.zoneName, inputs)
+
+def test_summer_warm_day_adds_presence_and_the_temp_step(auto_fan):
+	fan = auto_fan.FanZone("Test", 1)
+	fan.temp_steps = [auto_fan.TempStep(None, 1.0, 0), auto_fan.TempStep(1.0, 3.0, 1), auto_fan.TempStep(3.0, None, 3)]
+	fan.compileTempSteps()
+	config = auto_fan.AutoConfortConfig()
+
+	decision = auto_fan.DecideTargetSpeed(fan, config, MakeInputs(auto_fan, room_temperature = 74.0, presence = True, hvac_running = True))
+
+	assert decision.target_speed == 3
+	assert [reason.rule for reason in decision.reasons if reason.rule != "mode"] == ["hvac_running", "presence", "temp_step"]
+
+def test_summer_cool_day_and_winter_hold_the_fan_at_one(auto_fan):
+	fan = auto_fan.FanZone("Test", 1)
+	fan.temp_steps = [auto_fan.TempStep(None, None, 4)]
+	fan.compileTempSteps()
+	config = auto_fan.AutoConfortConfig()
+
+	cool_day = auto_fan.DecideTargetSpeed(fan, config, MakeInputs(auto_fan, feelslike = 60.0, room_temperature = 71.0, hvac_running = True))
+	winter = auto_fan.DecideTargetSpeed(fan, config, MakeInputs(auto_fan, feelslike = 30.0, cool_setpoint = 0.0, heat_setpoint = 68.0, hvac_running = True))
+
+	assert (cool_day.target_speed, cool_day.max_target) == (1, 1)
+	assert (winter.target_speed, winter.max_target) == (1, 1)
+
+def test_nobody_home_limits_the_fan_to_one(auto_fan):
+	fan = auto_fan.FanZone("Test", 1)
+	fan.temp_steps = [auto_fan.TempStep(None, None, 4)]
+	fan.compileTempSteps()
+	config = auto_fan.AutoConfortConfig()
+
+	decision = auto_fan.DecideTargetSpeed(fan, config, MakeInputs(auto_fan, someone_home = False, feelslike = 90.0, room_temperature = 80.0))
+
+	assert decision.target_speed == 1
+	assert "nobody_home" in [reason.rule for reason in decision.reasons]
+
+def test_stale_weather_does_not_keep_the_fan_on(auto_fan):
+	fan = auto_fan.FanZone("Test", 1)
+	fan.always_on_outside_temp = 78
+	fan.temp_steps = [auto_fan.TempStep(None, None, 0)]
+	fan.compileTempSteps()
+	config = auto_fan.AutoConfortConfig()
+	inputs = MakeInputs(auto_fan, someone_home = False, feelslike = 79.0, cool_setpoint = 0.0, heat_setpoint = 0.0)
+
+	assert auto_fan.DecideTargetSpeed(fan, config, inputs).target_speed == 1
+	assert auto_fan.DecideTargetSpeed(fan, config, inputs._replace(feelslike_stale = True)).target_speed == 0
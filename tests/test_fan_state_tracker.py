@@ -0,0 +1,71 @@
+import datetime
+
+def States(speed, fan, whoosh = "off"):
+	return {"speed": speed, "fan": fan, "whoosh": whoosh}
+
+def StartedTracker(auto_fan, speed = 0, whoosh = False):
+	tracker = auto_fan.FanStateTracker(settle_seconds = 5)
+	tracker.start()
+	tracker.read(1, speed, whoosh)
+	return tracker
+
+def test_split_notifications_of_a_command_are_not_a_manual_change(auto_fan, clock):
+	tracker = StartedTracker(auto_fan)
+	tracker.command(1, 3, False)
+
+	# the plugin reports "fan" before "speed", which reads as speed 1 in between
+	assert tracker.notify(1, States(0, True)) is None
+	assert tracker.notify(1, States(3, True)) is None
+
+	tracker.commandSent(1, True)
+	assert tracker.getState(1) == (3, False)
+	assert tracker.takeManualChange(1) is None
+
+def test_notifications_arriving_after_the_command_was_sent(auto_fan, clock):
+	tracker = StartedTracker(auto_fan)
+	tracker.command(1, 3, False)
+	tracker.commandSent(1, True)
+
+	clock.current = clock.current + datetime.timedelta(seconds = 1)
+	assert tracker.notify(1, States(0, True)) is None
+	assert tracker.notify(1, States(3, True)) is None
+	assert tracker.takeManualChange(1) is None
+
+def test_change_after_the_settle_window_is_a_manual_change(auto_fan, clock):
+	tracker = StartedTracker(auto_fan)
+	tracker.command(1, 3, False)
+	tracker.commandSent(1, True)
+
+	clock.current = clock.current + datetime.timedelta(minutes = 1)
+	change = tracker.notify(1, States(1, True))
+
+	assert change is not None
+	assert (change.speed_before, change.speed) == (3, 1)
+	assert tracker.takeManualChange(1) == change
+	assert tracker.takeManualChange(1) is None
+
+def test_failed_command_does_not_hide_later_manual_changes(auto_fan, clock):
+	tracker = StartedTracker(auto_fan, speed = 2)
+	tracker.command(1, 3, False)
+	tracker.commandSent(1, False)
+
+	# the state is not known until it is read again
+	assert tracker.getState(1) is None
+	tracker.read(1, 2, False)
+
+	clock.current = clock.current + datetime.timedelta(minutes = 1)
+	assert tracker.notify(1, States(3, True)) is not None
+
+def test_speed_changes_while_whoosh_is_on_are_not_manual(auto_fan, clock):
+	tracker = StartedTracker(auto_fan, speed = 3, whoosh = True)
+
+	assert tracker.notify(1, States(5, True, "on")) is None
+	assert tracker.getState(1) == (5, True)
+
+	# turning whoosh off is
+	assert tracker.notify(1, States(5, True, "off")) is not None
+
+def test_notifications_are_ignored_until_started(auto_fan):
+	tracker = auto_fan.FanStateTracker()
+	assert tracker.notify(1, States(3, True)) is None
+	assert tracker.getState(1) is None
@@ -0,0 +1,35 @@
+import datetime
+
+import simulate
+
+def test_parses_seconds_since_the_epoch(auto_fan):
+	when = datetime.datetime(2020, 7, 1, 14, 30, 5)
+	assert auto_fan.ParseLockTime(auto_fan.FormatLockTime(when)) == when
+
+def test_parses_the_format_of_older_versions(auto_fan):
+	assert auto_fan.ParseLockTime("2018-07-15 14:00:00") == datetime.datetime(2018, 7, 15, 14, 0, 0)
+
+def test_read_only_parses_a_changed_value(auto_fan, fakeIndigo):
+	variable = fakeIndigo.variables.add(simulate.FakeVariable(10, "locked", auto_fan.FormatLockTime(datetime.datetime(2020, 7, 1, 15, 0))))
+	lock = auto_fan.LockTime(10)
+
+	first = lock.read()
+	assert first == datetime.datetime(2020, 7, 1, 15, 0)
+	assert lock.read() is first
+
+	variable.value = "2020-07-01 16:00:00"
+	assert lock.read() == datetime.datetime(2020, 7, 1, 16, 0)
+
+def test_write_goes_through_the_variable_writes(auto_fan, fakeIndigo):
+	variable = fakeIndigo.variables.add(simulate.FakeVariable(10, "locked", "0"))
+	lock = auto_fan.LockTime(10)
+	writes = auto_fan.VariableWrites()
+	when = datetime.datetime(2020, 7, 1, 15, 0)
+
+	lock.write(writes, when)
+	assert lock.time == when
+	assert variable.value == "0"
+
+	writes.flush()
+	assert auto_fan.ParseLockTime(variable.value) == when
+	assert lock.read() == when
@@ -0,0 +1,60 @@
+def BaselineLookup(temp_steps, temp_delta):
+	# the first TempStep that matches, like the script found it before TempStepTable
+	for entry in temp_steps:
+		if entry.min_temp is None:
+			triggered = temp_delta <= entry.max_temp
+		elif entry.max_temp is None:
+			triggered = temp_delta >= entry.min_temp
+		else:
+			triggered = temp_delta > entry.min_temp and temp_delta <= entry.max_temp
+
+		if triggered:
+			return entry
+
+	return None
+
+def Deltas(table):
+	deltas = [x / 10.0 for x in range(-100, 150)]
+	for boundary in table.boundaries:
+		deltas.extend([boundary - 0.01, boundary, boundary + 0.01])
+	return deltas
+
+def test_lookup_matches_the_baseline_for_the_configured_zones(auto_fan, zones):
+	config, fanZones = zones
+
+	for fan in fanZones:
+		for is_nighttime in (False, True):
+			table = fan.getTempStepTable(is_nighttime)
+
+			for temp_delta in Deltas(table):
+				assert table.lookup(temp_delta) is BaselineLookup(table.temp_steps, temp_delta), (fan.zoneName, is_nighttime, temp_delta)
+
+def test_lookup_with_gaps_and_overlaps(auto_fan):
+	TempStep = auto_fan.TempStep
+	temp_steps = [TempStep(-1.0, 1.0, 1), TempStep(0.5, 2.0, 2), TempStep(3.0, None, 3)]
+	table = auto_fan.TempStepTable(temp_steps)
+
+	for temp_delta in Deltas(table):
+		assert table.lookup(temp_delta) is BaselineLookup(temp_steps, temp_delta), temp_delta
+
+	assert any("no TempStep matches" in problem for problem in table.problems)
+	assert any("only the first one is used" in problem for problem in table.problems)
+
+def test_compiled_table_looks_up_the_same_steps(auto_fan, zones):
+	config, fanZones = zones
+
+	for fan in fanZones:
+		table = fan.getTempStepTable(False)
+		compiled = auto_fan.TempStepTable.fromCompiled(table.asCompiled())
+
+		for temp_delta in Deltas(table):
+			expected = table.lookup(temp_delta)
+			found = compiled.lookup(temp_delta)
+
+			if expected is None:
+				assert found is None
+			else:
+				assert table.temp_steps.index(expected) == compiled.temp_steps.index(found)
+
+def test_empty_table(auto_fan):
+	assert auto_fan.TempStepTable([]).lookup(1.0) is None
@@ -0,0 +1,414 @@
+from __future__ import print_function
+
+import copy
+import datetime
+import json
+import multiprocessing
+import random
+import sys
+import time
+
+from simulate import FakeIndigo, LoadAutoFan, SimulatedClock
+
+'''
+##############################################################
+Offline tuning of the TempSteps and comfort thresholds of auto_fan.py, from the decision history.
+
+Use this instead of trying TempSteps one at a time in debug mode.  It needs a decision history (see config.history_file
+in auto_fan.py) with a few weeks of decisions in it.
+
+Usage:
+
+	python tune.py history.sqlite [--zone NAME] [--start YYYY-MM-DD] [--end YYYY-MM-DD] [--candidates 300] [--top 10]
+		[--processes N] [--seed 0] [--cooling-per-speed 0.7] [--command-weight 0.5] [--runtime-weight 0.05] [--output results.json]
+
+For every zone, this tries --candidates variations of its settings (the current ones are always one of them):
+
+	temp_steps							the boundaries scaled and shifted, and the impacts raised or lowered
+	always_on_inside_temp
+	always_on_outside_temp
+	BEDTIME_HIGH_HUMIDITY				these two are the same for every zone in the config, so pick one value for all of them
+	BEDTIME_HIGH_FEELSLIKE_TEMPERATURE
+
+Each candidate is scored by replaying the inputs of every recorded decision of the zone through DecideTargetSpeed(), on
+a pool of --processes processes (one for each core by default).  A fan changes how warm it feels, not the temperature
+of the room, so the recorded temperatures can be replayed as they are, whatever speeds the candidate picks.  The score
+is the sum of:
+
+	comfort			degree-hours between how warm it felt and the ideal temperature, while someone was in the room.  A
+					fan at speed n makes it feel --cooling-per-speed x n degrees cooler than the room temperature.
+	commands		the number of speed changes, times --command-weight
+	runtime			the speed-hours the fan ran (speed 3 for an hour is 3), times --runtime-weight
+
+Each decision counts for the time until the next one of its zone, at most 15 minutes.  The lock and change limit rules
+are not replayed: they depend on what was done to the fan at the time.  The zones are loaded (from LoadConfig() or
+auto_fan.json) for every month and for day and nighttime, so their month and time of day rules apply.
+
+The best --top candidates of every zone are printed, lowest score first, together with where the current settings
+rank.  With --output they are also written as JSON, with the settings of each candidate for the time of day and the
+months that were replayed (the zones can have different settings for them), and the TempSteps in the format of auto_fan.json.
+
+##############################################################
+'''
+
+# the decisions of a zone count for the time until the next one, at most this long
+MAX_SAMPLE_MINUTES = 15
+
+TEMP_STEP_SCALES = [0.8, 0.9, 1.0, 1.1, 1.25]
+TEMP_STEP_OFFSETS = [-1.0, -0.5, 0.0, 0.5, 1.0]
+IMPACT_OFFSETS = [-1, 0, 1]
+ALWAYS_ON_OFFSETS = [-2, -1, 0, 1, 2]
+HUMIDITY_OFFSETS = [-10, -5, 0, 5, 10]
+FEELSLIKE_OFFSETS = [-4, -2, 0, 2, 4]
+
+# the settings of the house, for the current month and time of day
+class House(object):
+	def __init__(self):
+		self.clock = SimulatedClock()
+		self.indigo = FakeIndigo(self.clock)
+		self.auto_fan = LoadAutoFan(self.indigo, self.clock)
+
+		# the zones only refer to the devices and variables when they are loaded, they do not need to exist
+		self.indigo.devices.autocreate = True
+		self.indigo.variables.autocreate = True
+
+		self.loaded = {}
+
+	def getZones(self, is_nighttime, month):
+		# the config and zones (by name), loaded at 2pm or 11pm in the middle of the month
+		key = (is_nighttime, month)
+
+		if key not in self.loaded:
+			self.clock.current = datetime.datetime(2000, month, 15, 23 if is_nighttime else 14, 0)
+			config = self.auto_fan.AutoConfortConfig()
+			fanZones = self.auto_fan.LoadZones(config)
+			self.loaded[key] = (config, dict((fan.zoneName, fan) for fan in fanZones))
+
+		return self.loaded[key]
+
+	def getZoneNames(self):
+		config, zones = self.getZones(False, 1)
+		return sorted(zones.keys())
+
+def LoadSamples(auto_fan, path, zoneName, start, end):
+	# the recorded inputs of the zone, as (month, DecisionInputs, hours) tuples
+	records = list(auto_fan.HistoryStore(path).read(zoneName, start, end))
+	samples = []
+
+	# without the thermostat of the zone there were no setpoints, and how the rules treat None depends on the version of
+	# Python, so those decisions are left out
+	records = [record for record in records if record.cool_setpoint is not None and record.heat_setpoint is not None]
+
+	for i, record in enumerate(records):
+		if i + 1 < len(records):
+			seconds = (records[i + 1].taken_at - record.taken_at).total_seconds()
+		else:
+			seconds = 60
+
+		inputs = auto_fan.DecisionInputs(
+			is_nighttime = record.is_nighttime,
+			someone_home = record.someone_home,
+			feelslike = record.feelslike,
+			feelslike_stale = False,
+			room_temperature = record.room_temperature,
+			ideal_temperature = record.ideal_temperature,
+			humidity = record.humidity,
+			presence = record.presence,
+			cool_setpoint = record.cool_setpoint,
+			heat_setpoint = record.heat_setpoint,
+			hvac_running = record.hvac_running
+		)
+
+		samples.append((record.taken_at.month, inputs, min(seconds, MAX_SAMPLE_MINUTES * 60) / 3600.0))
+
+	return samples
+
+######################
+#	Candidates
+######################
+
+def MakeCandidates(count, seed):
+	# the current settings first, then count - 1 other combinations of the offsets, without repeats
+	current = {"temp_step_scale": 1.0, "temp_step_offset": 0.0, "impact_offset": 0, "inside_offset": 0, "outside_offset": 0, "humidity_offset": 0, "feelslike_offset": 0}
+	grid = [TEMP_STEP_SCALES, TEMP_STEP_OFFSETS, IMPACT_OFFSETS, ALWAYS_ON_OFFSETS, ALWAYS_ON_OFFSETS, HUMIDITY_OFFSETS, FEELSLIKE_OFFSETS]
+	size = 1
+	for values in grid:
+		size = size * len(values)
+
+	rng = random.Random(seed)
+	candidates = [current]
+	seen = set([tuple(sorted(current.items()))])
+
+	while len(candidates) < min(count, size):
+		scale, offset, impact, inside, outside, humidity, feelslike = [rng.choice(values) for values in grid]
+		candidate = {"temp_step_scale": scale, "temp_step_offset": offset, "impact_offset": impact, "inside_offset": inside, "outside_offset": outside, "humidity_offset": humidity, "feelslike_offset": feelslike}
+		key = tuple(sorted(candidate.items()))
+
+		if key not in seen:
+			seen.add(key)
+			candidates.append(candidate)
+
+	return candidates
+
+def AdjustTempSteps(auto_fan, temp_steps, candidate):
+	if temp_steps is None:
+		return None
+
+	def boundary(value):
+		if value is None:
+			return None
+
+		return round(value * candidate["temp_step_scale"] + candidate["temp_step_offset"], 1)
+
+	def impact(value):
+		if value is None:
+			return None
+
+		return max(0, value + candidate["impact_offset"])
+
+	return [auto_fan.TempStep(boundary(entry.min_temp), boundary(entry.max_temp), impact(entry.impact), entry.min_target, entry.max_target) for entry in temp_steps]
+
+def ApplyCandidate(auto_fan, config, fan, candidate):
+	# copies of the config and the zone with the candidate's settings
+	config = copy.copy(config)
+	config.BEDTIME_HIGH_HUMIDITY = config.BEDTIME_HIGH_HUMIDITY + candidate["humidity_offset"]
+	config.BEDTIME_HIGH_FEELSLIKE_TEMPERATURE = config.BEDTIME_HIGH_FEELSLIKE_TEMPERATURE + candidate["feelslike_offset"]
+
+	fan = copy.copy(fan)
+	fan.always_on_inside_temp = fan.always_on_inside_temp + candidate["inside_offset"]
+	fan.always_on_outside_temp = fan.always_on_outside_temp + candidate["outside_offset"]
+	fan.temp_steps = AdjustTempSteps(auto_fan, fan.temp_steps, candidate)
+	fan.night_temp_steps = AdjustTempSteps(auto_fan, fan.night_temp_steps, candidate)
+
+	day = auto_fan.TempStepTable(fan.temp_steps)
+	night = day
+	if fan.night_temp_steps is not None:
+		night = auto_fan.TempStepTable(fan.night_temp_steps)
+
+	fan.temp_step_tables = {False: day, True: night}
+	return config, fan
+
+def DescribeCandidate(config, fan, candidate):
+	# the settings of the candidate, in the format of auto_fan.json
+	def steps(temp_steps):
+		if temp_steps is None:
+			return None
+
+		return [[entry.min_temp, entry.max_temp, entry.impact, entry.min_target, entry.max_target] for entry in temp_steps]
+
+	return {
+		"temp_steps": steps(fan.temp_steps),
+		"night_temp_steps": steps(fan.night_temp_steps),
+		"always_on_inside_temp": fan.always_on_inside_temp,
+		"always_on_outside_temp": fan.always_on_outside_temp,
+		"BEDTIME_HIGH_HUMIDITY": config.BEDTIME_HIGH_HUMIDITY,
+		"BEDTIME_HIGH_FEELSLIKE_TEMPERATURE": config.BEDTIME_HIGH_FEELSLIKE_TEMPERATURE
+	}
+
+def DescribeReplayed(house, zoneName, candidate, variants):
+	# the settings of the candidate for each time of day and month that was replayed, like the overrides in auto_fan.json
+	described = []
+
+	for is_nighttime, month in sorted(variants):
+		config, zones = house.getZones(is_nighttime, month)
+		candidateConfig, fan = ApplyCandidate(house.auto_fan, config, zones[zoneName], candidate)
+		settings = DescribeCandidate(candidateConfig, fan, candidate)
+
+		for entry in described:
+			if entry["nighttime"] == is_nighttime and entry["settings"] == settings:
+				entry["months"].append(month)
+				break
+		else:
+			described.append({"nighttime": is_nighttime, "months": [month], "settings": settings})
+
+	return described
+
+######################
+#	Scoring, in the worker processes
+######################
+
+Worker = None
+
+class TuningWorker(object):
+	def __init__(self, path, start, end, weights):
+		self.house = House()
+		self.path = path
+		self.start = start
+		self.end = end
+		self.weights = weights
+		self.samples = {}
+
+	def getSamples(self, zoneName):
+		if zoneName not in self.samples:
+			self.samples[zoneName] = LoadSamples(self.house.auto_fan, self.path, zoneName, self.start, self.end)
+
+		return self.samples[zoneName]
+
+	def score(self, zoneName, index, candidate):
+		auto_fan = self.house.auto_fan
+		variants = {}
+		decided = {}
+
+		comfort = 0.0
+		commands = 0
+		speed_hours = 0.0
+		previous = None
+
+		for month, inputs, hours in self.getSamples(zoneName):
+			key = (month, inputs)
+
+			# the same inputs come up over and over, like in DecisionMemo
+			if key not in decided:
+				variant = (inputs.is_nighttime, month)
+
+				if variant not in variants:
+					config, zones = self.house.getZones(inputs.is_nighttime, month)
+					variants[variant] = ApplyCandidate(auto_fan, config, zones[zoneName], candidate)
+
+				config, fan = variants[variant]
+				decided[key] = auto_fan.DecideTargetSpeed(fan, config, inputs).target_speed
+
+			speed = decided[key]
+
+			if previous is not None and speed != previous:
+				commands = commands + 1
+			previous = speed
+
+			if inputs.presence:
+				felt_delta = inputs.room_temperature - self.weights["cooling_per_speed"] * speed - inputs.ideal_temperature
+				comfort = comfort + abs(felt_delta) * hours
+
+			speed_hours = speed_hours + speed * hours
+
+		return {
+			"zone": zoneName,
+			"candidate": index,
+			"score": comfort + commands * self.weights["command_weight"] + speed_hours * self.weights["runtime_weight"],
+			"comfort_degree_hours": comfort,
+			"commands": commands,
+			"speed_hours": speed_hours,
+			"samples": len(self.getSamples(zoneName)),
+			"variants": sorted(variants.keys())
+		}
+
+def InitWorker(path, start, end, weights):
+	global Worker
+	Worker = TuningWorker(path, start, end, weights)
+
+def ScoreCandidate(task):
+	zoneName, index, candidate = task
+	return Worker.score(zoneName, index, candidate)
+
+######################
+#	Command line
+######################
+
+def ParseArguments(argv):
+	options = {
+		"path": None,
+		"zone": None,
+		"start": None,
+		"end": None,
+		"candidates": 300,
+		"top": 10,
+		"processes": None,
+		"seed": 0,
+		"cooling_per_speed": 0.7,
+		"command_weight": 0.5,
+		"runtime_weight": 0.05,
+		"output": None
+	}
+
+	names = dict(("--" + name.replace("_", "-"), name) for name in options.keys() if name != "path")
+	arguments = list(argv[1:])
+
+	while len(arguments) > 0:
+		argument = arguments.pop(0)
+
+		if argument not in names:
+			if options["path"] is None and not argument.startswith("--"):
+				options["path"] = argument
+				continue
+
+			raise ValueError("unknown argument: " + argument)
+
+		if len(arguments) == 0:
+			raise ValueError(argument + " needs a value")
+
+		name = names[argument]
+		value = arguments.pop(0)
+
+		if name in ("start", "end"):
+			value = datetime.datetime.strptime(value, "%Y-%m-%d")
+		elif name in ("candidates", "top", "processes", "seed"):
+			value = int(value)
+		elif name in ("cooling_per_speed", "command_weight", "runtime_weight"):
+			value = float(value)
+
+		options[name] = value
+
+	if options["path"] is None:
+		raise ValueError("the decision history file is required")
+
+	return options
+
+def main(argv):
+	try:
+		options = ParseArguments(argv)
+	except ValueError as e:
+		print("tune.py: " + str(e))
+		print("usage: python tune.py history.sqlite [--zone NAME] [--start YYYY-MM-DD] [--end YYYY-MM-DD] [--candidates 300] [--top 10] [--processes N] [--output results.json]")
+		return 2
+
+	weights = dict((name, options[name]) for name in ("cooling_per_speed", "command_weight", "runtime_weight"))
+
+	house = House()
+	zoneNames = house.getZoneNames()
+	if options["zone"] is not None:
+		if options["zone"] not in zoneNames:
+			print("tune.py: there is no zone named " + options["zone"] + " (the zones are: " + ", ".join(zoneNames) + ")")
+			return 2
+
+		zoneNames = [options["zone"]]
+
+	candidates = MakeCandidates(options["candidates"], options["seed"])
+	tasks = [(zoneName, index, candidate) for zoneName in zoneNames for index, candidate in enumerate(candidates)]
+
+	started = time.time()
+	pool = multiprocessing.Pool(options["processes"], InitWorker, (options["path"], options["start"], options["end"], weights))
+
+	try:
+		scores = list(pool.imap_unordered(ScoreCandidate, tasks, chunksize = 4))
+	finally:
+		pool.close()
+		pool.join()
+
+	results = {}
+	for zoneName in zoneNames:
+		ranked = sorted([score for score in scores if score["zone"] == zoneName], key = lambda score: (score["score"], score["candidate"]))
+		current = [rank for rank, score in enumerate(ranked) if score["candidate"] == 0][0]
+
+		best = []
+		for score in ranked[:options["top"]]:
+			best.append(dict(score, settings = DescribeReplayed(house, zoneName, candidates[score["candidate"]], score["variants"])))
+
+		results[zoneName] = {"current": ranked[current], "current_rank": current + 1, "best": best}
+
+		print("%s: %d samples, current settings rank %d of %d (score %.1f)" % (zoneName, ranked[current]["samples"], current + 1, len(ranked), ranked[current]["score"]))
+		for rank, score in enumerate(ranked[:options["top"]]):
+			candidate = candidates[score["candidate"]]
+			print("  %2d. score %8.1f  comfort %8.1f  commands %5d  speed hours %8.1f  steps x%.2f %+.1f impact %+d  always on inside %+d outside %+d  bedtime humidity %+d feels like %+d" % (
+				rank + 1, score["score"], score["comfort_degree_hours"], score["commands"], score["speed_hours"],
+				candidate["temp_step_scale"], candidate["temp_step_offset"], candidate["impact_offset"], candidate["inside_offset"],
+				candidate["outside_offset"], candidate["humidity_offset"], candidate["feelslike_offset"]))
+
+	print("%d candidates in %.1f seconds" % (len(tasks), time.time() - started))
+
+	if options["output"] is not None:
+		with open(options["output"], "w") as output:
+			json.dump(results, output, indent = 2, sort_keys = True)
+
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))